@@ -5,23 +5,197 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datetime import timedelta, timezone, datetime
 from models import sqlalchemy, pydantic
+from dependencies import SessionType
 import settings
 import jwt
 import hmac
+import base64
+import hashlib
+import secrets
+import time
+import logging
+import asyncpg
+import collections
+import events
+from concurrent.futures import ThreadPoolExecutor
 
 SECRET = settings.SECRET_KEY
 DIGEST = 'sha256'
+PASSWORD_HASH_SCHEME = 'scrypt'
+PASSWORD_SALT_SIZE = 16
+PASSWORD_KEY_SIZE = 32
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Токены ссылок подтверждения почты подписываются отдельным ключом и не содержат sub,
+# поэтому не принимаются как токены доступа
+EMAIL_VERIFICATION_SECRET = f'{SECRET}:verify-email'
+EMAIL_VERIFICATION_PURPOSE = 'verify-email'
+
+logger = logging.getLogger(__name__)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def get_user(email: str):
-    return sqlalchemy.User.fetch_one(email=email)
+# Пул потоков для хэширования паролей: hashlib.scrypt отпускает GIL,
+# а ограничение числа потоков не дает всплеску входов занять все ядра.
+password_hash_executor: typing.Optional[ThreadPoolExecutor] = None
+
+
+class VerifiedTokenCache:
+    """
+    Ограниченный LRU-кэш уже проверенных токенов: SHA-256 токена -> его данные.
+    Запись удаляется по истечении exp токена или при отзыве токенов пользователя.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: collections.OrderedDict[bytes, dict] = collections.OrderedDict()
+        self.user_digests: dict[int, set[bytes]] = collections.defaultdict(set)
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token: str) -> typing.Optional[dict]:
+        digest = self.digest(token)
+        payload = self.entries.get(digest)
+
+        if payload is None:
+            return None
+
+        if payload['exp'] <= time.time():
+            self.discard(digest)
+            return None
+
+        self.entries.move_to_end(digest)
+        return payload
+
+    def put(self, token: str, payload: dict) -> None:
+        if 'exp' not in payload or self.max_size <= 0:
+            return
+
+        digest = self.digest(token)
+        self.entries[digest] = payload
+        self.entries.move_to_end(digest)
+
+        if payload.get('uid') is not None:
+            self.user_digests[payload['uid']].add(digest)
+
+        while len(self.entries) > self.max_size:
+            oldest_digest = next(iter(self.entries))
+            self.discard(oldest_digest)
+
+    def discard(self, digest: bytes) -> None:
+        payload = self.entries.pop(digest, None)
+        if payload is None or payload.get('uid') is None:
+            return
+
+        user_digests = self.user_digests.get(payload['uid'])
+        if user_digests is not None:
+            user_digests.discard(digest)
+
+            if not user_digests:
+                del self.user_digests[payload['uid']]
+
+    def invalidate_user(self, user_id: int) -> None:
+        for digest in list(self.user_digests.get(user_id, ())):
+            self.discard(digest)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.user_digests.clear()
+
+
+verified_tokens = VerifiedTokenCache(settings.TOKEN_CACHE_SIZE)
+
+
+class CredentialsVersions:
+    """
+    Ограниченный LRU-кэш версий учетных данных, сверенных с БД: ID пользователя -> версия.
+    Токен с версией из кэша принимается без запроса к БД, остальные сверяются с БД.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: collections.OrderedDict[int, int] = collections.OrderedDict()
+
+    def get(self, user_id: int) -> typing.Optional[int]:
+        version = self.entries.get(user_id)
+
+        if version is not None:
+            self.entries.move_to_end(user_id)
+
+        return version
 
+    def put(self, user_id: int, version: int) -> None:
+        if self.max_size <= 0:
+            return
+
+        # Уведомления из разных процессов могут прийти не по порядку: версия только растет
+        self.entries[user_id] = max(version, self.entries.get(user_id, version))
+        self.entries.move_to_end(user_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+# Последние известные процессу версии учетных данных пользователей.
+# Все процессы узнают о смене версии через канал CREDENTIALS_CHANNEL.
+CREDENTIALS_VERSIONS = CredentialsVersions(settings.CREDENTIALS_CACHE_SIZE)
+
+# Канал PostgreSQL LISTEN/NOTIFY для смены версий учетных данных (сообщение "ID пользователя:версия")
+CREDENTIALS_CHANNEL = 'credentials_versions'
+
+
+def on_credentials_changed(payload: str) -> None:
+    user_id, _, version = payload.partition(':')
+    CREDENTIALS_VERSIONS.put(int(user_id), int(version))
+    verified_tokens.invalidate_user(int(user_id))
+
+
+def reset_credentials_caches() -> None:
+    """
+    Уведомления о смене версий могли быть потеряны: все токены снова сверяются с БД
+    """
+
+    CREDENTIALS_VERSIONS.clear()
+    verified_tokens.clear()
+
+
+credentials_bus = events.BACKENDS[settings.EVENTS_BACKEND](
+    on_credentials_changed,
+    CREDENTIALS_CHANNEL,
+    reset=reset_credentials_caches
+)
+
+
+def decode_token(token: str) -> dict:
+    """
+    Проверяет подпись и срок токена. Повторно предъявленный токен берется из кэша без проверки подписи.
+    """
+
+    payload = verified_tokens.get(token)
+
+    if payload is None:
+        payload = jwt.decode(token, SECRET, algorithms=[ALGORITHM])
+        verified_tokens.put(token, payload)
+
+    return payload
+
+
+async def get_user(session: SessionType, email: str):
+    return await sqlalchemy.User.fetch_one(session, sqlalchemy.User.email_filter(email))
+
+
+def create_legacy_password_hash(password: str):
+    """
+    Хэш пароля старого формата (HMAC-SHA256), нужен только для проверки старых хэшей
+    """
 
-def create_password_hash(password: str):
     secret = SECRET
 
     if isinstance(secret, str):
@@ -33,20 +207,128 @@ def create_password_hash(password: str):
     return hmac.new(secret, password, DIGEST).hexdigest()
 
 
+def create_password_hash(password: str, cost: int = None):
+    """
+    Хэш пароля в формате scrypt$N$r$p$соль$ключ.
+    Стоимость N берется из настроек, если не указана.
+    """
+
+    cost = cost or settings.PASSWORD_HASH_COST
+    block_size = settings.PASSWORD_HASH_BLOCK_SIZE
+    parallelism = settings.PASSWORD_HASH_PARALLELISM
+    salt = secrets.token_bytes(PASSWORD_SALT_SIZE)
+
+    key = hashlib.scrypt(
+        password.encode('utf-8'),
+        salt=salt,
+        n=cost,
+        r=block_size,
+        p=parallelism,
+        maxmem=256 * cost * block_size,
+        dklen=PASSWORD_KEY_SIZE
+    )
+
+    return '$'.join([
+        PASSWORD_HASH_SCHEME,
+        str(cost),
+        str(block_size),
+        str(parallelism),
+        base64.b64encode(salt).decode('ascii'),
+        base64.b64encode(key).decode('ascii'),
+    ])
+
+
 def verify_password(plain_password: str, hashed_password: str):
-    new_hash = create_password_hash(plain_password)
-    return hmac.compare_digest(new_hash, hashed_password)
+    if not hashed_password.startswith(f'{PASSWORD_HASH_SCHEME}$'):
+        new_hash = create_legacy_password_hash(plain_password)
+        return hmac.compare_digest(new_hash, hashed_password)
+
+    _, cost, block_size, parallelism, salt, key = hashed_password.split('$')
+    cost, block_size = int(cost), int(block_size)
+    key = base64.b64decode(key)
+
+    new_key = hashlib.scrypt(
+        plain_password.encode('utf-8'),
+        salt=base64.b64decode(salt),
+        n=cost,
+        r=block_size,
+        p=int(parallelism),
+        maxmem=256 * cost * block_size,
+        dklen=len(key)
+    )
+
+    return hmac.compare_digest(new_key, key)
+
+
+def password_needs_rehash(hashed_password: str):
+    """
+    Хэш старого формата или с параметрами, отличными от текущих настроек
+    """
+
+    current_parameters = [
+        PASSWORD_HASH_SCHEME,
+        str(settings.PASSWORD_HASH_COST),
+        str(settings.PASSWORD_HASH_BLOCK_SIZE),
+        str(settings.PASSWORD_HASH_PARALLELISM),
+    ]
+
+    return hashed_password.split('$')[:4] != current_parameters
+
+
+def get_password_hash_executor() -> ThreadPoolExecutor:
+    global password_hash_executor
+
+    if password_hash_executor is None:
+        password_hash_executor = ThreadPoolExecutor(
+            max_workers=settings.PASSWORD_HASH_WORKERS,
+            thread_name_prefix='password-hash'
+        )
+
+    return password_hash_executor
+
+
+def shutdown_password_hash_executor():
+    global password_hash_executor
+
+    if password_hash_executor is not None:
+        password_hash_executor.shutdown(wait=True)
+        password_hash_executor = None
 
 
-def authenticate_user(email: str, password: str):
-    user = get_user(email=email)
+async def hash_password(password: str, cost: int = None) -> str:
+    """
+    Вычисляет хэш пароля в пуле потоков, не блокируя цикл событий
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_password_hash_executor(), create_password_hash, password, cost)
+
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    """
+    Проверяет пароль в пуле потоков, не блокируя цикл событий
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_password_hash_executor(), verify_password, plain_password, hashed_password)
+
+
+async def authenticate_user(session: SessionType, email: str, password: str):
+    user = await get_user(session, email=email)
     if not user:
         return False
 
-    if not verify_password(password, user.password_hash):
+    if not await check_password(password, user.password_hash):
         return False
 
-    return pydantic.UserModel.model_validate(obj=user.as_dict())
+    if password_needs_rehash(user.password_hash):
+        await sqlalchemy.User.update(
+            session,
+            user.id,
+            password_hash=await hash_password(password)
+        )
+
+    return pydantic.UserModel.model_validate(obj=user)
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -61,7 +343,47 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+def create_email_verification_token(user_id: int, email: str) -> str:
+    """
+    Токен ссылки подтверждения почты. Ссылка действует, пока почта пользователя не изменилась.
+    """
+
+    expire = datetime.now(timezone.utc) + timedelta(hours=settings.EMAIL_VERIFICATION_EXPIRE_HOURS)
+    data = {
+        'purpose': EMAIL_VERIFICATION_PURPOSE,
+        'uid': user_id,
+        'email': email,
+        'exp': expire,
+    }
+
+    return jwt.encode(data, EMAIL_VERIFICATION_SECRET, algorithm=ALGORITHM)
+
+
+def decode_email_verification_token(token: str) -> typing.Optional[typing.Tuple[int, str]]:
+    """
+    Выводит (ID пользователя, почта) из токена подтверждения почты или None, если токен недействителен
+    """
+
+    try:
+        payload = jwt.decode(token, EMAIL_VERIFICATION_SECRET, algorithms=[ALGORITHM])
+    except jwt.exceptions.PyJWTError:
+        return None
+
+    if payload.get('purpose') != EMAIL_VERIFICATION_PURPOSE:
+        return None
+
+    return payload['uid'], payload['email']
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: SessionType):
+    return await user_from_token(session, token)
+
+
+async def user_from_token(session: SessionType, token: str) -> pydantic.UserModel:
+    """
+    Пользователь по токену доступа. Если токен недействителен, выбрасывает HTTPException 401.
+    """
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Не удалось авторизовать пользователя.",
@@ -69,7 +391,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     )
 
     try:
-        payload = jwt.decode(token, SECRET, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         email: str = payload.get("sub")
 
         if email is None:
@@ -78,22 +400,83 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     except jwt.exceptions.PyJWTError:
         raise credentials_exception
 
-    user = get_user(email=email)
+    user_id = payload.get('uid')
+    version = payload.get('ver')
+
+    if user_id is not None and version is not None:
+        if CREDENTIALS_VERSIONS.get(user_id) == version:
+            return user_from_claims(payload)
+
+        user = await sqlalchemy.User.fetch_one(session, id=user_id)
+        if user is None:
+            raise credentials_exception
+
+        CREDENTIALS_VERSIONS.put(user_id, user.credentials_version)
+
+        if user.credentials_version != version:
+            verified_tokens.invalidate_user(user_id)
+            raise credentials_exception
+
+        return pydantic.UserModel.model_validate(obj=user)
+
+    # Токен старого формата без данных пользователя
+    user = await get_user(session, email=email)
     if user is None:
         raise credentials_exception
 
-    return pydantic.UserModel.model_validate(obj=user.as_dict())
+    return pydantic.UserModel.model_validate(obj=user)
+
+
+def user_from_claims(payload: dict) -> pydantic.UserModel:
+    """
+    Собирает пользователя из данных токена без запроса к БД
+    """
+
+    return pydantic.UserModel.model_validate({
+        'id': payload['uid'],
+        'email': payload['sub'],
+        'firstName': payload.get('fn'),
+        'lastName': payload.get('ln'),
+        'emailVerified': payload.get('ev', False),
+        'role': sqlalchemy.UserRoles[payload['role']],
+        'credentialsVersion': payload['ver'],
+    })
 
 
-def create_token(user):
+def create_token(user: pydantic.UserModel):
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    data = {"sub": user.email}
+    data = {
+        "sub": user.email,
+        "uid": user.id,
+        "role": user.role.name,
+        "ver": user.credentials_version,
+        "fn": user.first_name,
+        "ln": user.last_name,
+        "ev": user.email_verified,
+    }
     access_token = create_access_token(
         data=data, expires_delta=access_token_expires
     )
     return {'access_token': access_token, 'token_type': 'bearer'}
 
 
+async def revoke_user_tokens(session: SessionType, user_id: int) -> int:
+    """
+    Отзывает все выданные пользователю токены, увеличивая версию его учетных данных
+    """
+
+    version = await sqlalchemy.User.bump_credentials_version(session, user_id)
+    on_credentials_changed(f'{user_id}:{version}')
+
+    try:
+        await credentials_bus.publish(f'{user_id}:{version}')
+    except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+        # Процессы, не получившие уведомление, до перезапуска канала принимают старые токены из кэша
+        logger.exception('Не удалось разослать новую версию учетных данных пользователя %s', user_id)
+
+    return version
+
+
 def handle_role(user: pydantic.UserModel, role: sqlalchemy.UserRoles):
     role_denied_exception = HTTPException(
         status_code=403,
@@ -0,0 +1,3 @@
+"""
+Нагрузочные замеры. Запуск из корня проекта: python -m benchmarks.<модуль>
+"""
@@ -0,0 +1,117 @@
+"""
+Резервирование остатка одного "горячего" товара BUYERS одновременными покупателями:
+пропускная способность резервов и проверка, что продано не больше остатка.
+
+Сравниваются остаток в строке товара (все покупки блокируют одну строку)
+и остаток, разделенный на шарды (Product.shard_stock).
+Нужна БД из settings с примененными миграциями (python -m migrations upgrade).
+
+    python -m benchmarks.inventory [--buyers 100] [--stock 2000] [--shards 8]
+"""
+
+import time
+import asyncio
+import argparse
+import sqlalchemy as sa
+from models import sqlalchemy
+
+
+async def buyer(product_id: int, sold: list):
+    async with sqlalchemy.async_session_maker() as session:
+        while True:
+            if not await sqlalchemy.Product.reserve(session, product_id, 1):
+                await session.rollback()
+                return
+
+            await session.commit()
+            sold.append(1)
+
+
+async def remaining_stock(product_id: int) -> int:
+    async with sqlalchemy.async_session_maker() as session:
+        shards = await session.scalar(
+            sa.select(sa.func.sum(sqlalchemy.ProductStockShard.quantity))
+            .where(sqlalchemy.ProductStockShard.product_id == product_id)
+        )
+
+        if shards is not None:
+            return shards
+
+        return await session.scalar(
+            sa.select(sqlalchemy.Product.quantity_available).where(sqlalchemy.Product.id == product_id)
+        )
+
+
+async def run(seller_id: int, buyers: int, stock: int, shards: int) -> dict:
+    async with sqlalchemy.async_session_maker() as session:
+        product = await sqlalchemy.Product.create(
+            session,
+            seller_id=seller_id,
+            title='benchmark',
+            price=1,
+            quantity_available=stock
+        )
+
+        if shards:
+            await sqlalchemy.Product.shard_stock(session, product.id, shards)
+
+    sold = []
+    started = time.perf_counter()
+    await asyncio.gather(*[buyer(product.id, sold) for _ in range(buyers)])
+    elapsed = time.perf_counter() - started
+
+    remaining = await remaining_stock(product.id)
+
+    async with sqlalchemy.async_session_maker() as session:
+        await sqlalchemy.Product.delete(session, id=product.id)
+
+    return {
+        'sold': len(sold),
+        'remaining': remaining,
+        'throughput': len(sold) / elapsed,
+        'oversold': len(sold) > stock or len(sold) + remaining != stock,
+    }
+
+
+async def main_async(args):
+    sqlalchemy.get_async_engine()
+
+    async with sqlalchemy.async_session_maker() as session:
+        seller = await sqlalchemy.User.create(
+            session,
+            email=f'inventory-benchmark-{time.time_ns()}@example.com',
+            password_hash='-',
+            first_name='Benchmark'
+        )
+
+    try:
+        for shards in (0, args.shards):
+            result = await run(seller.id, args.buyers, args.stock, shards)
+            title = f'шардов остатка: {shards}' if shards else 'остаток в строке товара'
+
+            print(
+                f'{title:<24} продано {result["sold"]}/{args.stock}, '
+                f'осталось {result["remaining"]}, '
+                f'{result["throughput"]:.0f} резервов/с, '
+                f'{"ПЕРЕПРОДАЖА" if result["oversold"] else "без перепродажи"}'
+            )
+
+    finally:
+        async with sqlalchemy.async_session_maker() as session:
+            await sqlalchemy.User.delete(session, id=seller.id)
+
+        await sqlalchemy.dispose_engines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--buyers', type=int, default=100)
+    parser.add_argument('--stock', type=int, default=2000)
+    parser.add_argument('--shards', type=int, default=8)
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
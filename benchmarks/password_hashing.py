@@ -0,0 +1,78 @@
+"""
+Пропускная способность входа и задержки при разной стоимости scrypt.
+
+Одновременно проверяется LOGINS паролей через пул потоков auth и параллельно
+измеряется задержка цикла событий - то, насколько вход тормозит остальные запросы.
+
+    python -m benchmarks.password_hashing [--logins 200] [--costs 4096 16384 32768]
+"""
+
+import time
+import asyncio
+import argparse
+import statistics
+import auth
+
+
+async def measure_loop_lag(stop: asyncio.Event, lags: list, interval: float = 0.005):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def timed_check(password: str, password_hash: str, latencies: list):
+    started = time.perf_counter()
+    assert await auth.check_password(password, password_hash)
+    latencies.append(time.perf_counter() - started)
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(logins: int, cost: int) -> dict:
+    password = 'correct horse battery staple'
+    password_hash = auth.create_password_hash(password, cost)
+
+    latencies, lags = [], []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop, lags))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[timed_check(password, password_hash, latencies) for _ in range(logins)])
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await lag_task
+
+    return {
+        'cost': cost,
+        'logins_per_second': logins / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_loop_lag_ms': max(lags, default=0) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--costs', type=int, nargs='+', default=[2 ** 12, 2 ** 14, 2 ** 15])
+    args = parser.parse_args()
+
+    print(f'{"N":>8} {"входов/с":>10} {"p50, мс":>9} {"p99, мс":>9} {"лаг цикла, мс":>14}')
+
+    for cost in args.costs:
+        result = asyncio.run(run(args.logins, cost))
+        print(
+            f'{result["cost"]:>8} {result["logins_per_second"]:>10.1f} {result["p50_ms"]:>9.1f} '
+            f'{result["p99_ms"]:>9.1f} {result["max_loop_lag_ms"]:>14.1f}'
+        )
+
+    auth.shutdown_password_hash_executor()
+
+
+if __name__ == '__main__':
+    main()
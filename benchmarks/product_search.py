@@ -0,0 +1,132 @@
+"""
+Задержка полнотекстового поиска товаров (Product.search) на большом каталоге.
+
+Заполняет каталог PRODUCTS товарами из случайных слов (INSERT ... SELECT generate_series
+на стороне БД), затем выполняет поисковые запросы и выводит медиану и 95-й перцентиль
+задержки первой и второй страницы. После замеров товары удаляются, если не указан --keep.
+Нужна БД из settings с примененными миграциями (python -m migrations upgrade).
+
+    python -m benchmarks.product_search [--products 1000000] [--repeats 50] [--keep]
+"""
+
+import time
+import asyncio
+import argparse
+import statistics
+import sqlalchemy as sa
+from models import sqlalchemy
+
+WORDS = [
+    'телефон', 'чехол', 'зарядка', 'наушники', 'ноутбук', 'клавиатура', 'мышь', 'монитор',
+    'кабель', 'колонка', 'часы', 'браслет', 'камера', 'объектив', 'штатив', 'рюкзак',
+    'куртка', 'кроссовки', 'футболка', 'игра', 'консоль', 'геймпад', 'книга', 'лампа',
+    'новый', 'б/у', 'черный', 'белый', 'красный', 'беспроводной', 'игровой', 'кожаный',
+]
+
+QUERIES = [
+    'телефон',
+    'беспроводные наушники',
+    'игровая мышь',
+    '"кожаный чехол"',
+    'ноутбук -игровой',
+    'камера or объектив',
+]
+
+BATCH_SIZE = 100_000
+
+
+async def populate(seller_id: int, products: int):
+    words = ', '.join(f"'{word}'" for word in WORDS)
+    random_word = f'(ARRAY[{words}])[1 + floor(random() * {len(WORDS)})::int]'
+
+    async with sqlalchemy.async_session_maker() as session:
+        for start in range(0, products, BATCH_SIZE):
+            count = min(BATCH_SIZE, products - start)
+
+            await session.execute(sa.text(f'''
+                INSERT INTO products ("sellerId", title, description, price, "quantityAvailable")
+                SELECT
+                    :seller_id,
+                    concat_ws(' ', {random_word}, {random_word}, {random_word}),
+                    concat_ws(' ', {random_word}, {random_word}, {random_word}, {random_word}, {random_word}),
+                    (random() * 100000)::int,
+                    100
+                FROM generate_series(1, :count)
+            '''), {'seller_id': seller_id, 'count': count})
+
+            await session.commit()
+            print(f'добавлено товаров: {start + count}/{products}')
+
+        await session.execute(sa.text('ANALYZE products'))
+        await session.commit()
+
+
+async def measure(text: str, repeats: int, limit: int = 50) -> tuple:
+    first_page, second_page = [], []
+
+    async with sqlalchemy.async_session_maker() as session:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            rows = await sqlalchemy.Product.search(session, text, limit=limit + 1)
+            first_page.append(time.perf_counter() - started)
+
+            if len(rows) <= limit:
+                continue
+
+            after = [rows[limit - 1]['rank'], rows[limit - 1]['id']]
+
+            started = time.perf_counter()
+            await sqlalchemy.Product.search(session, text, limit=limit + 1, after=after)
+            second_page.append(time.perf_counter() - started)
+
+    return first_page, second_page
+
+
+def describe(latencies: list) -> str:
+    if not latencies:
+        return '-'
+
+    ordered = sorted(latencies)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return f'p50 {statistics.median(ordered) * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс'
+
+
+async def main_async(args):
+    sqlalchemy.get_async_engine()
+
+    async with sqlalchemy.async_session_maker() as session:
+        seller = await sqlalchemy.User.create(
+            session,
+            email=f'search-benchmark-{time.time_ns()}@example.com',
+            password_hash='-',
+            first_name='Benchmark'
+        )
+
+    try:
+        await populate(seller.id, args.products)
+
+        for text in QUERIES:
+            first_page, second_page = await measure(text, args.repeats)
+            print(f'{text:<24} 1-я страница: {describe(first_page)}; 2-я страница: {describe(second_page)}')
+
+    finally:
+        if not args.keep:
+            async with sqlalchemy.async_session_maker() as session:
+                await sqlalchemy.Product.delete(session, seller_id=seller.id)
+                await sqlalchemy.User.delete(session, id=seller.id)
+
+        await sqlalchemy.dispose_engines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=1_000_000)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--keep', action='store_true')
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
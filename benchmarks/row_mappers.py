@@ -0,0 +1,53 @@
+"""
+Память и время на перевод строк в результат выборки: прежняя копия __dict__
+каждого объекта ORM против записей Record, генерируемых мапперами моделей.
+
+    python -m benchmarks.row_mappers [--rows 10000]
+"""
+
+import time
+import argparse
+import tracemalloc
+from benchmarks.serialization import make_deals
+
+
+def copy_dicts(deals: list) -> list:
+    return [
+        {key: value for key, value in deal.__dict__.items() if key != '_sa_instance_state'}
+        for deal in deals
+    ]
+
+
+def map_records(deals: list) -> list:
+    memo = {}
+    return [deal.to_record(memo) for deal in deals]
+
+
+def measure(function, deals: list) -> tuple:
+    tracemalloc.start()
+    started = time.perf_counter()
+
+    rows = function(deals)
+
+    elapsed = time.perf_counter() - started
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del rows
+    return elapsed * 1000, allocated / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000)
+    args = parser.parse_args()
+
+    deals = make_deals(args.rows)
+
+    for name, function in [('копия __dict__', copy_dicts), ('записи Record', map_records)]:
+        elapsed_ms, allocated_kb = measure(function, deals)
+        print(f'{name:>15}: {elapsed_ms:8.1f} мс, {allocated_kb:10.1f} КБ на {args.rows} строк')
+
+
+if __name__ == '__main__':
+    main()
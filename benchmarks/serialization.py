@@ -0,0 +1,112 @@
+"""
+CPU на сериализацию списка сделок: прежний путь (копия __dict__ в AttriDict,
+валидация, jsonable_encoder, json.dumps) против нового (записи Record,
+модель собирается из их атрибутов и сериализуется FastJSONResponse).
+
+БД не нужна: объекты ORM собираются в памяти.
+
+    python -m benchmarks.serialization [--rows 500] [--repeat 20]
+"""
+
+import json
+import time
+import argparse
+from fastapi.encoders import jsonable_encoder
+from models import sqlalchemy, pydantic
+from responses import FastJSONResponse
+
+
+def make_deals(rows: int) -> list:
+    seller = sqlalchemy.User(
+        id=1,
+        email='seller@example.com',
+        password_hash='hash',
+        first_name='Продавец',
+        last_name=None,
+        date_joined=None,
+        date_password_changed=None,
+        role=sqlalchemy.UserRoles.USER,
+        email_verified=True,
+        credentials_version=0
+    )
+    consumer = sqlalchemy.User(
+        id=2,
+        email='consumer@example.com',
+        password_hash='hash',
+        first_name='Покупатель',
+        last_name=None,
+        date_joined=None,
+        date_password_changed=None,
+        role=sqlalchemy.UserRoles.USER,
+        email_verified=True,
+        credentials_version=0
+    )
+    product = sqlalchemy.Product(
+        id=1,
+        seller_id=seller.id,
+        seller=seller,
+        title='Товар',
+        description='Описание товара',
+        attachments=['https://example.com/1.png'],
+        price=1000,
+        quantity_available=10
+    )
+
+    return [
+        sqlalchemy.Deal(
+            id=index,
+            seller_id=seller.id,
+            consumer_id=consumer.id,
+            product_id=product.id,
+            seller=seller,
+            consumer=consumer,
+            product=product,
+            quantity=1,
+            status=sqlalchemy.DealStatuses.PAID
+        )
+        for index in range(rows)
+    ]
+
+
+def old_path(deals: list) -> bytes:
+    rows = [
+        {key: value for key, value in deal.__dict__.items() if key != '_sa_instance_state'} | {'price': deal.price}
+        for deal in deals
+    ]
+    validated = pydantic.DealListModel.model_validate(rows)
+    return json.dumps(jsonable_encoder(validated), ensure_ascii=False).encode('utf-8')
+
+
+def new_path(deals: list) -> bytes:
+    memo = {}
+    records = [deal.to_record(memo) for deal in deals]
+    return FastJSONResponse(pydantic.DealListModel.model_validate(records)).body
+
+
+def per_call_ms(function, deals: list, repeat: int) -> float:
+    started = time.perf_counter()
+
+    for _ in range(repeat):
+        function(deals)
+
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    deals = make_deals(args.rows)
+
+    before = per_call_ms(old_path, deals, args.repeat)
+    after = per_call_ms(new_path, deals, args.repeat)
+
+    print(f'{args.rows} сделок, прежний путь: {before:.2f} мс')
+    print(f'{args.rows} сделок, новый путь:   {after:.2f} мс')
+    print(f'ускорение: {before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Стоимость разбора токена доступа на запрос: полная проверка подписи HS256
+против повторного предъявления токена из кэша проверенных токенов.
+
+    python -m benchmarks.token_auth [--requests 100000]
+"""
+
+import time
+import argparse
+import auth
+from models import pydantic, sqlalchemy
+
+
+def make_token() -> str:
+    user = pydantic.UserModel.model_validate({
+        'id': 1,
+        'email': 'user@example.com',
+        'firstName': 'Иван',
+        'role': sqlalchemy.UserRoles.USER,
+    })
+
+    return auth.create_token(user)['access_token']
+
+
+def per_request_us(function, token: str, requests: int) -> float:
+    started = time.perf_counter()
+
+    for _ in range(requests):
+        function(token)
+
+    return (time.perf_counter() - started) / requests * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100_000)
+    args = parser.parse_args()
+
+    token = make_token()
+
+    def without_cache(value):
+        payload = auth.jwt.decode(value, auth.SECRET, algorithms=[auth.ALGORITHM])
+        return auth.user_from_claims(payload)
+
+    def with_cache(value):
+        return auth.user_from_claims(auth.decode_token(value))
+
+    before = per_request_us(without_cache, token, args.requests)
+    after = per_request_us(with_cache, token, args.requests)
+
+    print(f'jwt.decode на каждый запрос: {before:.1f} мкс/запрос')
+    print(f'кэш проверенных токенов:     {after:.1f} мкс/запрос')
+    print(f'ускорение:                   {before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
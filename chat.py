@@ -0,0 +1,197 @@
+import asyncio
+import typing
+import logging
+import collections
+import asyncpg
+from fastapi import WebSocket
+from models import sqlalchemy, pydantic
+import settings
+import events
+
+logger = logging.getLogger(__name__)
+
+# Канал PostgreSQL LISTEN/NOTIFY для сообщений сделок
+DEAL_MESSAGES_CHANNEL = 'deal_messages'
+
+
+class PendingMessage(typing.NamedTuple):
+    values: dict
+    future: asyncio.Future
+
+
+class MessageWriter:
+    """
+    Пакетная запись сообщений сделок. Пока идет запись пакета, новые сообщения копятся в очереди
+    и следующим пакетом записываются одним INSERT ... RETURNING (DealMessage.create_many).
+    Без нагрузки пакет состоит из одного сообщения и не ждет других.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.queue: typing.Optional[asyncio.Queue] = None
+        self.task: typing.Optional[asyncio.Task] = None
+
+    async def write(self, **values) -> sqlalchemy.Record:
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self.run())
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(PendingMessage(values, future))
+        return await future
+
+    async def run(self):
+        while True:
+            pending = await self.queue.get()
+            if pending is None:
+                return
+
+            batch = [pending]
+            closing = False
+
+            while len(batch) < self.batch_size and not self.queue.empty():
+                pending = self.queue.get_nowait()
+
+                if pending is None:
+                    closing = True
+                    break
+
+                batch.append(pending)
+
+            await self.flush(batch)
+
+            if closing:
+                return
+
+    @staticmethod
+    async def flush(batch: typing.List[PendingMessage]):
+        """
+        Записывает пакет одним INSERT. Если он не прошел, сообщения записываются по одному:
+        ошибка одного сообщения (например, нарушение ограничения) достается только его отправителю.
+        """
+
+        try:
+            async with sqlalchemy.async_session_maker() as session:
+                records = await sqlalchemy.DealMessage.create_many(session, [pending.values for pending in batch])
+
+        except Exception as exception:
+            if len(batch) == 1:
+                if not batch[0].future.done():
+                    batch[0].future.set_exception(exception)
+
+                return
+
+            for pending in batch:
+                await MessageWriter.flush([pending])
+
+            return
+
+        for pending, record in zip(batch, records):
+            if not pending.future.done():
+                pending.future.set_result(record)
+
+    async def close(self):
+        """
+        Дописывает сообщения из очереди и останавливает запись
+        """
+
+        if self.task is None:
+            return
+
+        self.queue.put_nowait(None)
+        await self.task
+        self.task = None
+
+
+class ChatHub:
+    """
+    Рассылка сообщений сделки всем подключенным к ней сокетам. Сообщение публикуется через бэкенд
+    шины событий (settings.EVENTS_BACKEND), поэтому доходит до сокетов во всех процессах сервера.
+    Сообщение сериализуется один раз; сокет, не принявший его за CHAT_SEND_TIMEOUT, отключается.
+    """
+
+    def __init__(self, backend: str):
+        self.channels: typing.Dict[int, typing.Set[WebSocket]] = collections.defaultdict(set)
+        self.backend = events.BACKENDS[backend](self.dispatch, DEAL_MESSAGES_CHANNEL)
+        self.broadcasts: typing.Set[asyncio.Task] = set()
+
+    async def start(self):
+        await self.backend.start()
+
+    async def close(self):
+        await self.backend.close()
+
+    def subscribe(self, deal_id: int, websocket: WebSocket) -> None:
+        self.channels[deal_id].add(websocket)
+
+    def unsubscribe(self, deal_id: int, websocket: WebSocket) -> None:
+        sockets = self.channels.get(deal_id)
+        if sockets is None:
+            return
+
+        sockets.discard(websocket)
+        if not sockets:
+            del self.channels[deal_id]
+
+    async def publish(self, deal_id: int, message: pydantic.DealMessageModel) -> None:
+        payload = f'{deal_id}:' + message.__pydantic_serializer__.to_json(message, by_alias=True).decode('utf-8')
+
+        try:
+            await self.backend.publish(payload)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            # Сообщение уже записано: без NOTIFY оно доходит хотя бы до сокетов этого процесса
+            logger.exception('Не удалось опубликовать сообщение сделки')
+            self.dispatch(payload)
+
+    def dispatch(self, payload: str) -> None:
+        deal_id, _, message = payload.partition(':')
+        deal_id = int(deal_id)
+
+        if deal_id not in self.channels:
+            return
+
+        task = asyncio.get_running_loop().create_task(self.broadcast(deal_id, message))
+        self.broadcasts.add(task)
+        task.add_done_callback(self.broadcasts.discard)
+
+    async def broadcast(self, deal_id: int, payload: str) -> None:
+        await asyncio.gather(*[
+            self.send(deal_id, websocket, payload)
+            for websocket in list(self.channels.get(deal_id, ()))
+        ])
+
+    async def send(self, deal_id: int, websocket: WebSocket, payload: str) -> None:
+        try:
+            await asyncio.wait_for(websocket.send_text(payload), settings.CHAT_SEND_TIMEOUT)
+
+        except Exception:
+            self.unsubscribe(deal_id, websocket)
+
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+    def connections(self) -> int:
+        return sum(len(sockets) for sockets in self.channels.values())
+
+
+message_writer = MessageWriter(settings.CHAT_WRITE_BATCH_SIZE)
+chat_hub = ChatHub(settings.EVENTS_BACKEND)
+
+
+async def send_message(deal_id: int, user_id: int, message: pydantic.DealMessageCreateModel) -> pydantic.DealMessageModel:
+    """
+    Записывает сообщение (пакетно с другими) и рассылает его участникам сделки, подключенным к чату
+    """
+
+    record = await message_writer.write(
+        deal_id=deal_id,
+        from_user_id=user_id,
+        message=message.message,
+        attachments=message.attachments
+    )
+
+    message = pydantic.DealMessageModel.model_validate(record)
+    await chat_hub.publish(deal_id, message)
+    return message
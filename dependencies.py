@@ -0,0 +1,40 @@
+import typing
+from typing import Annotated
+from fastapi import Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import sqlalchemy
+import settings
+
+
+SessionType = Annotated[AsyncSession, Depends(sqlalchemy.get_session)]
+
+INVALID_CURSOR_EXCEPTION = HTTPException(
+    status_code=400,
+    detail='Некорректный курсор пагинации.'
+)
+
+
+class Pagination(typing.NamedTuple):
+    """
+    Параметры страницы списка: ключ последней строки предыдущей страницы и размер страницы
+    """
+
+    after: typing.Optional[list]
+    limit: int
+
+
+def get_pagination(
+        cursor: str = None,
+        limit: Annotated[int, Query(ge=1, le=settings.PAGE_SIZE_MAX)] = settings.PAGE_SIZE_DEFAULT
+) -> Pagination:
+    if not cursor:
+        return Pagination(after=None, limit=limit)
+
+    try:
+        return Pagination(after=sqlalchemy.decode_cursor(cursor), limit=limit)
+
+    except ValueError:
+        raise INVALID_CURSOR_EXCEPTION
+
+
+PaginationType = Annotated[Pagination, Depends(get_pagination)]
@@ -0,0 +1,240 @@
+import asyncio
+import typing
+import logging
+import collections
+import asyncpg
+import settings
+from sqlalchemy.engine import make_url
+from models import pydantic
+
+logger = logging.getLogger(__name__)
+
+# Канал PostgreSQL LISTEN/NOTIFY для событий сделок
+DEAL_EVENTS_CHANNEL = 'deal_events'
+
+
+class LocalBackend:
+    """
+    Доставка событий только внутри процесса: для одного процесса и для тестов
+    """
+
+    def __init__(
+            self,
+            dispatch: typing.Callable[[str], None],
+            channel: str,
+            reset: typing.Optional[typing.Callable[[], None]] = None
+    ):
+        self.dispatch = dispatch
+        self.channel = channel
+
+    async def start(self):
+        pass
+
+    async def publish(self, payload: str):
+        self.dispatch(payload)
+
+    async def close(self):
+        pass
+
+
+class PostgresBackend:
+    """
+    Доставка событий всем процессам через PostgreSQL LISTEN/NOTIFY.
+    Процесс держит на канал одно отдельное от пула соединение: оно слушает канал и отправляет NOTIFY.
+    reset вызывается при обрыве соединения и после его восстановления: события за это время потеряны.
+    """
+
+    # Пауза (секунды) между попытками восстановить оборвавшееся соединение
+    RECONNECT_DELAY = 1
+
+    def __init__(
+            self,
+            dispatch: typing.Callable[[str], None],
+            channel: str,
+            reset: typing.Optional[typing.Callable[[], None]] = None
+    ):
+        self.dispatch = dispatch
+        self.channel = channel
+        self.reset = reset
+        self.connection: typing.Optional[asyncpg.Connection] = None
+        self.lock = asyncio.Lock()
+        self.closing = False
+
+    @staticmethod
+    def dsn() -> str:
+        url = make_url(settings.ASYNC_DATABASE_URL)
+        return url.set(drivername='postgresql').render_as_string(hide_password=False)
+
+    def on_notification(self, connection, pid, channel, payload):
+        self.dispatch(payload)
+
+    def on_termination(self, connection):
+        if self.reset is not None:
+            self.reset()
+
+        if not self.closing:
+            asyncio.get_running_loop().create_task(self.reconnect())
+
+    async def connect(self):
+        self.connection = await asyncpg.connect(self.dsn())
+        self.connection.add_termination_listener(self.on_termination)
+        await self.connection.add_listener(self.channel, self.on_notification)
+
+    async def reconnect(self):
+        """
+        Восстанавливает прослушивание канала после обрыва соединения.
+        События, отправленные во время обрыва, этим процессом не будут получены.
+        """
+
+        while not self.closing:
+            try:
+                async with self.lock:
+                    if self.connection is None or self.connection.is_closed():
+                        await self.connect()
+
+                if self.reset is not None:
+                    self.reset()
+
+                return
+
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                logger.exception('Не удалось восстановить соединение канала %s', self.channel)
+                await asyncio.sleep(self.RECONNECT_DELAY)
+
+    async def start(self):
+        async with self.lock:
+            await self.connect()
+
+    async def publish(self, payload: str):
+        async with self.lock:
+            if self.connection is None or self.connection.is_closed():
+                await self.connect()
+
+            await self.connection.execute('SELECT pg_notify($1, $2)', self.channel, payload)
+
+    async def close(self):
+        self.closing = True
+
+        async with self.lock:
+            if self.connection is not None and not self.connection.is_closed():
+                await self.connection.close()
+
+            self.connection = None
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'postgres': PostgresBackend,
+}
+
+
+class EventBus:
+    """
+    Шина событий сделок: событие публикуется через бэкенд (settings.EVENTS_BACKEND)
+    и раздается подпискам продавца и покупателя сделки в каждом процессе.
+    Подписка, не успевающая забирать события (очередь из EVENTS_QUEUE_SIZE заполнена), закрывается.
+    """
+
+    def __init__(self, backend: str):
+        self.subscriptions: typing.Dict[int, typing.Set[asyncio.Queue]] = collections.defaultdict(set)
+        self.backend = BACKENDS[backend](self.dispatch, DEAL_EVENTS_CHANNEL)
+
+    async def start(self):
+        await self.backend.start()
+
+    async def close(self):
+        await self.backend.close()
+
+    async def publish(self, event: pydantic.DealEventModel):
+        payload = event.__pydantic_serializer__.to_json(event, by_alias=True).decode('utf-8')
+
+        try:
+            await self.backend.publish(payload)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            # Событие - подсказка клиенту, а не источник истины: сбой доставки не отменяет перехода сделки
+            logger.exception('Не удалось опубликовать событие сделки')
+
+    def dispatch(self, payload: str):
+        event = pydantic.DealEventModel.model_validate_json(payload)
+
+        for user_id in {event.seller_id, event.consumer_id}:
+            for queue in list(self.subscriptions.get(user_id, ())):
+                try:
+                    queue.put_nowait(payload)
+
+                except asyncio.QueueFull:
+                    self.close_subscription(user_id, queue)
+
+    def close_subscription(self, user_id: int, queue: asyncio.Queue):
+        """
+        Отписывает очередь и завершает ее поток событий
+        """
+
+        self.unsubscribe(user_id, queue)
+
+        while not queue.empty():
+            queue.get_nowait()
+
+        queue.put_nowait(None)
+
+    def close_subscriptions(self):
+        """
+        Завершает все потоки событий процесса: при остановке сервера они иначе
+        держали бы ее до SERVER_GRACEFUL_TIMEOUT (клиенты переподключаются сами)
+        """
+
+        for user_id, queues in list(self.subscriptions.items()):
+            for queue in list(queues):
+                self.close_subscription(user_id, queue)
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=settings.EVENTS_QUEUE_SIZE)
+        self.subscriptions[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        queues = self.subscriptions.get(user_id)
+        if queues is None:
+            return
+
+        queues.discard(queue)
+        if not queues:
+            del self.subscriptions[user_id]
+
+
+event_bus = EventBus(settings.EVENTS_BACKEND)
+
+
+async def publish_deal(deal: typing.Any):
+    """
+    Публикует текущий статус сделки (запись или модель с полями сделки)
+    """
+
+    await event_bus.publish(pydantic.DealEventModel.model_validate(deal))
+
+
+async def stream_events(user_id: int) -> typing.AsyncIterator[str]:
+    """
+    Поток Server-Sent Events со сделками пользователя. Без событий каждые
+    EVENTS_HEARTBEAT_INTERVAL секунд отправляется комментарий, чтобы прокси не закрывали соединение.
+    """
+
+    queue = event_bus.subscribe(user_id)
+
+    try:
+        yield 'retry: 3000\n\n'
+
+        while True:
+            try:
+                payload = await asyncio.wait_for(queue.get(), settings.EVENTS_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ': ping\n\n'
+                continue
+
+            if payload is None:
+                return
+
+            yield f'event: deal\ndata: {payload}\n\n'
+
+    finally:
+        event_bus.unsubscribe(user_id, queue)
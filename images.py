@@ -0,0 +1,211 @@
+import os
+import typing
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from models import sqlalchemy
+import settings
+import storage
+import responses
+
+logger = logging.getLogger(__name__)
+
+# Варианты производных изображений: название -> наибольшие ширина и высота (пропорции сохраняются)
+IMAGE_VARIANTS = {
+    'thumbnail': (320, 320),
+    'web': (1280, 1280),
+}
+
+IMAGE_VARIANT_CONTENT_TYPE = 'image/webp'
+
+
+def render_variant(source_path: str, target_path: str, max_size: typing.Tuple[int, int], quality: int) -> typing.Tuple[str, int]:
+    """
+    Уменьшает изображение до max_size и сохраняет его в WebP. Выполняется в процессе пула.
+    Выводит SHA-256 и размер результата.
+    """
+
+    # Pillow нужен только процессам пула
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+        image.thumbnail(max_size)
+        image.save(target_path, 'WEBP', quality=quality, method=4)
+
+    digest = hashlib.sha256()
+    with open(target_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest(), os.path.getsize(target_path)
+
+
+class ImagePipeline:
+    """
+    Фоновая обработка заданий AttachmentDerivative: процесс приложения забирает задания из БД
+    (SKIP LOCKED, поэтому процессы не берут одно задание дважды) и обрабатывает их
+    в ограниченном пуле процессов, не занимая цикл событий и ядра сверх IMAGE_WORKERS.
+    Пул, сломанный падением дочернего процесса, пересоздается.
+    """
+
+    def __init__(self, workers: int, batch_size: int, poll_interval: float):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.executor: typing.Optional[ProcessPoolExecutor] = None
+        self.task: typing.Optional[asyncio.Task] = None
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        # spawn: дочерние процессы не наследуют цикл событий, потоки и соединения с БД родителя
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+    def replace_executor(self, broken: ProcessPoolExecutor):
+        """
+        Заменяет пул после падения его процесса: сломанный пул (BrokenProcessPool) не принимает задания.
+        Задания одной пачки получают ошибку одновременно, а пул заменяется один раз.
+        """
+
+        if self.executor is not broken:
+            return
+
+        logger.error('Процесс пула обработки изображений завершился аварийно, пул создается заново')
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.create_executor()
+
+    def start(self):
+        self.executor = self.create_executor()
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+            self.task = None
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    async def run(self):
+        while True:
+            try:
+                async with sqlalchemy.async_session_maker() as session:
+                    jobs = await sqlalchemy.AttachmentDerivative.claim(
+                        session,
+                        self.batch_size,
+                        settings.IMAGE_JOB_LEASE
+                    )
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                logger.exception('Не удалось получить задания на обработку изображений')
+                jobs = []
+
+            if not jobs:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            await asyncio.gather(*[self.work(job) for job in jobs])
+
+    async def work(self, job: sqlalchemy.Record):
+        try:
+            await self.process(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Итог задания не записан (например, БД недоступна): его заберут снова после IMAGE_JOB_LEASE
+            logger.exception('Не удалось записать итог обработки изображения %s (%s)', job.source_digest, job.variant)
+
+    async def process(self, job: sqlalchemy.Record):
+        store = storage.attachment_store
+        temporary_path = store.temporary_path()
+        executor = self.executor
+
+        try:
+            await asyncio.to_thread(os.makedirs, os.path.dirname(temporary_path), exist_ok=True)
+
+            digest, size = await asyncio.get_running_loop().run_in_executor(
+                executor,
+                render_variant,
+                store.path(job.source_digest),
+                temporary_path,
+                IMAGE_VARIANTS[job.variant],
+                settings.IMAGE_QUALITY
+            )
+
+            await asyncio.to_thread(store.commit, temporary_path, store.path(digest))
+
+            async with sqlalchemy.async_session_maker() as session:
+                source = await sqlalchemy.Attachment.fetch_one(session, digest=job.source_digest)
+
+                await sqlalchemy.Attachment.register(
+                    session,
+                    digest=digest,
+                    size=size,
+                    content_type=IMAGE_VARIANT_CONTENT_TYPE,
+                    uploader_id=source.uploader_id
+                )
+
+                product_ids = await sqlalchemy.AttachmentDerivative.complete(session, job.id, source.url, digest)
+
+            # Кэши ответов других процессов устаревают по RESPONSE_CACHE_TTL
+            for product_id in product_ids:
+                responses.invalidate_product(product_id)
+
+        except asyncio.CancelledError:
+            raise
+
+        except BrokenProcessPool as exception:
+            # Процесс пула упал (например, завершен по нехватке памяти) - попытка задания не засчитывается
+            self.replace_executor(executor)
+
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+            async with sqlalchemy.async_session_maker() as session:
+                await sqlalchemy.AttachmentDerivative.release(
+                    session,
+                    job,
+                    repr(exception),
+                    settings.IMAGE_JOB_RETRY_DELAY
+                )
+
+        except Exception as exception:
+            logger.exception('Не удалось обработать изображение %s (%s)', job.source_digest, job.variant)
+
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+            async with sqlalchemy.async_session_maker() as session:
+                await sqlalchemy.AttachmentDerivative.fail(
+                    session,
+                    job,
+                    repr(exception),
+                    settings.IMAGE_JOB_MAX_ATTEMPTS,
+                    settings.IMAGE_JOB_RETRY_DELAY
+                )
+
+
+image_pipeline = ImagePipeline(
+    settings.IMAGE_WORKERS,
+    settings.IMAGE_JOB_BATCH_SIZE,
+    settings.IMAGE_JOB_POLL_INTERVAL
+)
@@ -0,0 +1,182 @@
+import typing
+import asyncio
+import logging
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import sqlalchemy
+import settings
+
+logger = logging.getLogger(__name__)
+
+JobHandler = typing.Callable[..., typing.Awaitable[None]]
+
+# Обработчики фоновых заданий: имя задания -> корутина (session, **payload)
+HANDLERS: typing.Dict[str, JobHandler] = {}
+
+
+def handler(name: str) -> typing.Callable[[JobHandler], JobHandler]:
+    """
+    Регистрирует корутину обработчиком заданий name. Аргументы задания должны сериализоваться в JSON.
+    """
+
+    def register(function: JobHandler) -> JobHandler:
+        HANDLERS[name] = function
+        return function
+
+    return register
+
+
+class JobWorker:
+    """
+    Выполнение фоновых заданий в процессе приложения: задания забираются из БД пачками
+    (Job.claim, SKIP LOCKED, поэтому процессы не берут одно задание дважды) и выполняются
+    не более чем concurrency корутинами одновременно. Пачка не больше числа свободных корутин,
+    так что забранные задания не ждут в процессе, пока их могли бы выполнить другие.
+    """
+
+    def __init__(self, concurrency: int, batch_size: int, poll_interval: float):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(concurrency)
+        self.wakeup = asyncio.Event()
+        self.dispatcher: typing.Optional[asyncio.Task] = None
+        self.workers: typing.List[asyncio.Task] = []
+
+    def start(self):
+        self.dispatcher = asyncio.create_task(self.run())
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    def wake(self):
+        """
+        Забрать задания сразу, не дожидаясь poll_interval: вызывается после постановки заданий этим процессом
+        """
+
+        self.wakeup.set()
+
+    async def close(self, timeout: float):
+        """
+        Перестает забирать задания и ждет до timeout секунд завершения уже забранных.
+        Невыполненные задания другие процессы заберут после истечения их JOB_LEASE.
+        """
+
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+
+            self.dispatcher = None
+
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Фоновые задания не завершились за %s с', timeout)
+
+        for worker in self.workers:
+            worker.cancel()
+
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def run(self):
+        while True:
+            await self.slots.acquire()
+
+            # Остальные свободные места берутся без ожидания: пачка не больше их числа
+            free = 1
+            while free < self.batch_size and not self.slots.locked():
+                await self.slots.acquire()
+                free += 1
+
+            try:
+                async with sqlalchemy.async_session_maker() as session:
+                    jobs = await sqlalchemy.Job.claim(session, free, settings.JOB_LEASE)
+
+            except asyncio.CancelledError:
+                for _ in range(free):
+                    self.slots.release()
+                raise
+
+            except Exception:
+                logger.exception('Не удалось получить фоновые задания')
+                jobs = []
+
+            for job in jobs:
+                self.queue.put_nowait(job)
+
+            for _ in range(free - len(jobs)):
+                self.slots.release()
+
+            if len(jobs) < free:
+                self.wakeup.clear()
+
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+
+            try:
+                await self.execute(job)
+            except Exception:
+                # Итог задания не записан (например, БД недоступна): его заберут снова после JOB_LEASE
+                logger.exception('Не удалось записать итог фонового задания %s #%s', job.name, job.id)
+            finally:
+                self.queue.task_done()
+                self.slots.release()
+
+    async def execute(self, job: sqlalchemy.Record):
+        try:
+            job_handler = HANDLERS[job.name]
+
+            async with sqlalchemy.async_session_maker() as session:
+                await asyncio.wait_for(job_handler(session, **job.payload), settings.JOB_LEASE)
+
+            async with sqlalchemy.async_session_maker() as session:
+                await sqlalchemy.Job.complete(session, [job.id])
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as exception:
+            logger.exception('Не удалось выполнить фоновое задание %s #%s', job.name, job.id)
+
+            async with sqlalchemy.async_session_maker() as session:
+                await sqlalchemy.Job.fail(
+                    session,
+                    job,
+                    repr(exception),
+                    settings.JOB_MAX_ATTEMPTS,
+                    settings.JOB_RETRY_DELAY
+                )
+
+
+job_worker = JobWorker(
+    settings.JOB_WORKERS,
+    settings.JOB_BATCH_SIZE,
+    settings.JOB_POLL_INTERVAL
+)
+
+
+async def enqueue_many(session: AsyncSession, name: str, payloads: typing.Sequence[dict]) -> None:
+    """
+    Ставит задания name одним INSERT. Вызывается после commit изменений, от которых зависят задания:
+    иначе обработчик может не увидеть их или выполниться для отмененной транзакции.
+    """
+
+    await sqlalchemy.Job.enqueue(session, name, payloads)
+    job_worker.wake()
+
+
+async def enqueue(session: AsyncSession, name: str, **payload) -> None:
+    """
+    Ставит одно задание name с аргументами payload (см. enqueue_many)
+    """
+
+    await enqueue_many(session, name, [payload])
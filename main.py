@@ -1,19 +1,66 @@
-import uvicorn
+import asyncio
+import contextlib
 import settings
+import server
+import migrations
+import auth
+import chat
+import events
+import images
+import jobs
+import notifications
 from fastapi import FastAPI
-from routes import users, deals, products
+from models import sqlalchemy
+from responses import FastJSONResponse
+from routes import users, deals, messages, products, attachments, service
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Подготовка БД при запуске приложения и закрытие соединений при остановке
+    """
+
+    if settings.DATABASE_BOOTSTRAP_ON_STARTUP:
+        await asyncio.to_thread(migrations.bootstrap)
+
+    sqlalchemy.get_async_engine()
+    await events.event_bus.start()
+    await chat.chat_hub.start()
+    await auth.credentials_bus.start()
+
+    if settings.IMAGE_PIPELINE_ENABLED:
+        images.image_pipeline.start()
+
+    if settings.JOBS_ENABLED:
+        jobs.job_worker.start()
+
+    yield
+    await jobs.job_worker.close(settings.JOB_SHUTDOWN_TIMEOUT)
+    await images.image_pipeline.close()
+    await events.event_bus.close()
+    await chat.message_writer.close()
+    await chat.chat_hub.close()
+    await auth.credentials_bus.close()
+    await sqlalchemy.dispose_engines()
+    auth.shutdown_password_hash_executor()
 
 
 app = FastAPI(
     title='BurimGarant',
     description='Сервис для безопасного обмена товарами между двумя сторонами.',
-    debug=settings.DEBUG
+    debug=settings.DEBUG,
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
 app.include_router(users.router)
 app.include_router(deals.router)
+app.include_router(messages.router)
 app.include_router(products.router)
+app.include_router(attachments.router)
+app.include_router(service.router)
 
 
 if __name__ == '__main__':
-    uvicorn.run(host=settings.HOST, port=settings.PORT, app=app)
+    server.run()
@@ -0,0 +1,171 @@
+"""
+Версионные миграции схемы БД.
+
+Каждая миграция - модуль versions/NNNN_название.py с функциями
+upgrade(connection) и downgrade(connection). Примененные версии
+хранятся в таблице schema_migrations. Миграции с TRANSACTIONAL = False
+выполняются вне транзакции (нужно для CREATE INDEX CONCURRENTLY).
+"""
+
+import types
+import typing
+import pathlib
+import importlib
+import sqlalchemy
+from datetime import datetime
+from models.sqlalchemy import get_engine, create_database_if_missing
+
+
+VERSIONS_PATH = pathlib.Path(__file__).parent / 'versions'
+VERSIONS_PACKAGE = f'{__name__}.versions'
+
+migrations_metadata = sqlalchemy.MetaData()
+
+migrations_table = sqlalchemy.Table(
+    'schema_migrations',
+    migrations_metadata,
+    sqlalchemy.Column('version', sqlalchemy.Integer(), primary_key=True),
+    sqlalchemy.Column('name', sqlalchemy.VARCHAR(255), nullable=False),
+    sqlalchemy.Column('appliedAt', sqlalchemy.DateTime(), nullable=False, default=datetime.now),
+)
+
+
+# Недействительный индекс (indisvalid = false) остается после прерванного CREATE INDEX CONCURRENTLY
+INVALID_INDEX_QUERY = sqlalchemy.text(
+    'SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(:name) AND NOT indisvalid'
+)
+
+
+class Migration(typing.NamedTuple):
+    """
+    Миграция схемы БД
+    """
+
+    version: int
+    name: str
+    module: types.ModuleType
+
+    @property
+    def transactional(self) -> bool:
+        return getattr(self.module, 'TRANSACTIONAL', True)
+
+
+def load_migrations() -> typing.List[Migration]:
+    """
+    Выводит все миграции из каталога versions по возрастанию версии
+    """
+
+    migrations = []
+
+    for path in sorted(VERSIONS_PATH.glob('[0-9]*.py')):
+        version, _, name = path.stem.partition('_')
+        module = importlib.import_module(f'{VERSIONS_PACKAGE}.{path.stem}')
+        migrations.append(Migration(int(version), name, module))
+
+    return migrations
+
+
+def create_index_concurrently(connection: sqlalchemy.Connection, name: str, statement: str) -> None:
+    """
+    Выполняет statement (CREATE INDEX CONCURRENTLY IF NOT EXISTS name ...) в миграции с TRANSACTIONAL = False.
+    Недействительный индекс name после прерванной попытки (например, из-за повторяющихся значений
+    уникального индекса) IF NOT EXISTS пропустил бы, поэтому он удаляется и строится заново.
+    """
+
+    if connection.execute(INVALID_INDEX_QUERY, {'name': name}).first() is not None:
+        connection.execute(sqlalchemy.text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+
+    connection.execute(sqlalchemy.text(statement))
+
+
+def applied_versions() -> typing.Set[int]:
+    """
+    Выводит версии уже примененных миграций
+    """
+
+    with get_engine().begin() as connection:
+        migrations_table.create(connection, checkfirst=True)
+
+        return set(connection.execute(
+            sqlalchemy.select(migrations_table.c.version)
+        ).scalars())
+
+
+def run_migration(migration: Migration, direction: str) -> None:
+    """
+    Выполняет upgrade или downgrade миграции и отмечает это в schema_migrations
+    """
+
+    with get_engine().connect() as connection:
+        if not migration.transactional:
+            connection.execution_options(isolation_level='AUTOCOMMIT')
+
+        getattr(migration.module, direction)(connection)
+
+        if direction == 'upgrade':
+            connection.execute(
+                sqlalchemy.insert(migrations_table).values(
+                    version=migration.version,
+                    name=migration.name
+                )
+            )
+        else:
+            connection.execute(
+                sqlalchemy.delete(migrations_table).where(
+                    migrations_table.c.version == migration.version
+                )
+            )
+
+        connection.commit()
+
+
+def upgrade(target: int = None) -> typing.List[Migration]:
+    """
+    Применяет непримененные миграции до версии target включительно (по умолчанию все)
+    """
+
+    applied = applied_versions()
+    pending = [
+        migration for migration in load_migrations()
+        if migration.version not in applied and (target is None or migration.version <= target)
+    ]
+
+    for migration in pending:
+        run_migration(migration, 'upgrade')
+
+    return pending
+
+
+def downgrade(target: int) -> typing.List[Migration]:
+    """
+    Откатывает примененные миграции с версией больше target
+    """
+
+    applied = applied_versions()
+    reverted = [
+        migration for migration in reversed(load_migrations())
+        if migration.version in applied and migration.version > target
+    ]
+
+    for migration in reverted:
+        run_migration(migration, 'downgrade')
+
+    return reverted
+
+
+def status() -> typing.List[typing.Tuple[Migration, bool]]:
+    """
+    Выводит все миграции с признаком их применения
+    """
+
+    applied = applied_versions()
+    return [(migration, migration.version in applied) for migration in load_migrations()]
+
+
+def bootstrap() -> typing.List[Migration]:
+    """
+    Готовит БД к работе: создает ее при отсутствии и применяет все миграции
+    """
+
+    create_database_if_missing()
+    return upgrade()
@@ -0,0 +1,67 @@
+"""
+Консольная утилита миграций:
+
+    python -m migrations bootstrap
+    python -m migrations upgrade [версия]
+    python -m migrations downgrade <версия>
+    python -m migrations status
+    python -m migrations explain
+"""
+
+import sys
+import argparse
+import migrations
+from migrations import explain
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m migrations', description='Миграции схемы БД')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('bootstrap', help='Создать БД при отсутствии и применить все миграции')
+
+    upgrade_parser = commands.add_parser('upgrade', help='Применить миграции')
+    upgrade_parser.add_argument('target', type=int, nargs='?', default=None)
+
+    downgrade_parser = commands.add_parser('downgrade', help='Откатить миграции до версии')
+    downgrade_parser.add_argument('target', type=int)
+
+    commands.add_parser('status', help='Показать состояние миграций')
+    commands.add_parser('explain', help='Проверить планы горячих запросов')
+
+    args = parser.parse_args()
+
+    if args.command == 'bootstrap':
+        for migration in migrations.bootstrap():
+            print(f'Применена {migration.version:04d}_{migration.name}')
+
+    elif args.command == 'upgrade':
+        for migration in migrations.upgrade(args.target):
+            print(f'Применена {migration.version:04d}_{migration.name}')
+
+    elif args.command == 'downgrade':
+        for migration in migrations.downgrade(args.target):
+            print(f'Откачена {migration.version:04d}_{migration.name}')
+
+    elif args.command == 'status':
+        for migration, applied in migrations.status():
+            mark = 'x' if applied else ' '
+            print(f'[{mark}] {migration.version:04d}_{migration.name}')
+
+    elif args.command == 'explain':
+        failed = False
+
+        for name, tables in explain.check_plans().items():
+            if tables:
+                failed = True
+                print(f'{name}: последовательное сканирование {", ".join(tables)}')
+            else:
+                print(f'{name}: OK')
+
+        return int(failed)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
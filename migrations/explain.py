@@ -0,0 +1,86 @@
+"""
+Проверка планов горячих запросов: каждый из них должен обслуживаться индексом.
+Проверка идет с enable_seqscan = off, поэтому на маленьких таблицах
+последовательное сканирование в плане значит, что подходящего индекса нет.
+"""
+
+import json
+import typing
+import sqlalchemy
+from models.sqlalchemy import get_engine, User, Deal, DealStatuses, Product, DealMessage, SEARCH_CONFIG
+
+
+HOT_QUERIES = {
+    'Поиск пользователя по почте': sqlalchemy.select(User).where(
+        User.email_filter('user@example.com')
+    ),
+    'Сделки пользователя': sqlalchemy.select(Deal).where(
+        Deal.participant_filter(1)
+    ).order_by(Deal.id.desc()),
+    'Продажи по статусу': sqlalchemy.select(Deal).where(
+        Deal.seller_id == 1,
+        Deal.status == DealStatuses.PAID
+    ),
+    'Покупки по статусу': sqlalchemy.select(Deal).where(
+        Deal.consumer_id == 1,
+        Deal.status == DealStatuses.PAID
+    ),
+    'Товары продавца': sqlalchemy.select(Product).where(
+        Product.seller_id == 1
+    ),
+    'Поиск товаров': sqlalchemy.select(Product.id).where(
+        Product.search_vector.bool_op('@@')(
+            sqlalchemy.func.websearch_to_tsquery(sqlalchemy.literal_column(f"'{SEARCH_CONFIG}'"), 'телефон')
+        )
+    ),
+    'История сообщений сделки': sqlalchemy.select(DealMessage).where(
+        DealMessage.deal_id == 1
+    ).order_by(DealMessage.id),
+}
+
+
+def sequential_scans(plan: dict) -> typing.List[str]:
+    """
+    Выводит таблицы, которые план читает последовательным сканированием
+    """
+
+    tables = []
+
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.append(plan['Relation Name'])
+
+    for subplan in plan.get('Plans', []):
+        tables.extend(sequential_scans(subplan))
+
+    return tables
+
+
+def check_plans() -> typing.Dict[str, typing.List[str]]:
+    """
+    Выполняет EXPLAIN для горячих запросов.
+    Выводит для каждого запроса список таблиц без подходящего индекса.
+    """
+
+    result = {}
+
+    with get_engine().connect() as connection:
+        connection.execute(sqlalchemy.text('SET LOCAL enable_seqscan = off'))
+
+        for name, query in HOT_QUERIES.items():
+            compiled = query.compile(
+                dialect=get_engine().dialect,
+                compile_kwargs={'literal_binds': True}
+            )
+
+            plan = connection.execute(
+                sqlalchemy.text(f'EXPLAIN (FORMAT JSON) {compiled}')
+            ).scalar_one()
+
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            result[name] = sequential_scans(plan[0]['Plan'])
+
+        connection.rollback()
+
+    return result
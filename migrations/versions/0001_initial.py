@@ -0,0 +1,82 @@
+"""
+Исходная схема БД, ранее создававшаяся через metadata.create_all.
+IF NOT EXISTS позволяет принять ее как базовую на уже развернутых БД.
+"""
+
+import sqlalchemy
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text('''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'userroles') THEN
+                CREATE TYPE userroles AS ENUM ('USER', 'ADMIN', 'MODERATOR', 'SUPPORT');
+            END IF;
+
+            IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'dealstatuses') THEN
+                CREATE TYPE dealstatuses AS ENUM (
+                    'CREATED',
+                    'PAID',
+                    'PRODUCT_SUPPLIED',
+                    'ARBITRATION',
+                    'CANCELED_BY_SELLER',
+                    'CANCELED_BY_CONSUMER',
+                    'CLOSED_SUCCESSFULLY'
+                );
+            END IF;
+        END
+        $$
+    '''))
+
+    connection.execute(sqlalchemy.text('''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 1 NO CYCLE) PRIMARY KEY,
+            email VARCHAR(255) NOT NULL,
+            "passwordHash" VARCHAR(1000) NOT NULL,
+            "firstName" VARCHAR(50) NOT NULL,
+            "lastName" VARCHAR(50),
+            "dateJoined" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            "datePasswordChanged" TIMESTAMP WITHOUT TIME ZONE,
+            "emailVerified" BOOLEAN NOT NULL,
+            role userroles NOT NULL
+        )
+    '''))
+
+    connection.execute(sqlalchemy.text('''
+        CREATE TABLE IF NOT EXISTS products (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 1 NO CYCLE) PRIMARY KEY,
+            "sellerId" BIGINT NOT NULL REFERENCES users (id),
+            title VARCHAR(256) NOT NULL,
+            description TEXT,
+            attachments VARCHAR(255)[],
+            price INTEGER,
+            "quantityAvailable" INTEGER
+        )
+    '''))
+
+    connection.execute(sqlalchemy.text('''
+        CREATE TABLE IF NOT EXISTS deals (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 1 NO CYCLE) PRIMARY KEY,
+            "sellerId" BIGINT NOT NULL REFERENCES users (id),
+            "consumerId" BIGINT NOT NULL REFERENCES users (id),
+            product_id BIGINT NOT NULL REFERENCES products (id),
+            quantity INTEGER NOT NULL,
+            status dealstatuses NOT NULL
+        )
+    '''))
+
+    connection.execute(sqlalchemy.text('''
+        CREATE TABLE IF NOT EXISTS deal_messages (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 1 NO CYCLE) PRIMARY KEY,
+            "fromUserId" BIGINT NOT NULL REFERENCES users (id),
+            message VARCHAR(256) NOT NULL,
+            "dealId" BIGINT NOT NULL REFERENCES deals (id),
+            attachments VARCHAR(255)[]
+        )
+    '''))
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text('DROP TABLE IF EXISTS deal_messages, deals, products, users'))
+    connection.execute(sqlalchemy.text('DROP TYPE IF EXISTS dealstatuses, userroles'))
@@ -0,0 +1,33 @@
+"""
+Индексы под горячие запросы: поиск пользователя по почте при каждом запросе
+с токеном, списки сделок продавца/покупателя по статусу, товары продавца
+и история сообщений сделки.
+
+Индексы строятся CONCURRENTLY, чтобы не блокировать запись в таблицы,
+поэтому миграция выполняется вне транзакции. Уникальный индекс по lower(email)
+не построится, если в users уже есть почты, отличающиеся только регистром.
+"""
+
+import sqlalchemy
+from migrations import create_index_concurrently
+
+
+TRANSACTIONAL = False
+
+INDEXES = {
+    'ix_users_email_lower': 'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_lower ON users (lower(email))',
+    'ix_deals_seller_status': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_deals_seller_status ON deals ("sellerId", status)',
+    'ix_deals_consumer_status': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_deals_consumer_status ON deals ("consumerId", status)',
+    'ix_products_seller': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_seller ON products ("sellerId")',
+    'ix_deal_messages_deal': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_deal_messages_deal ON deal_messages ("dealId", id)',
+}
+
+
+def upgrade(connection):
+    for index_name, statement in INDEXES.items():
+        create_index_concurrently(connection, index_name, statement)
+
+
+def downgrade(connection):
+    for index_name in INDEXES:
+        connection.execute(sqlalchemy.text(f'DROP INDEX CONCURRENTLY IF EXISTS {index_name}'))
@@ -0,0 +1,16 @@
+"""
+Версия учетных данных пользователя. Записывается в токен доступа;
+увеличивается при выходе со всех устройств и смене пароля, что отзывает выданные токены.
+"""
+
+import sqlalchemy
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS "credentialsVersion" INTEGER NOT NULL DEFAULT 0'
+    ))
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text('ALTER TABLE users DROP COLUMN IF EXISTS "credentialsVersion"'))
@@ -0,0 +1,31 @@
+"""
+Учет остатка товара: шарды остатка для "горячих" товаров, чтобы одновременные
+покупки одного товара не выстраивались в очередь на блокировку одной строки products.
+"""
+
+import sqlalchemy
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE products ADD COLUMN IF NOT EXISTS "stockShards" INTEGER NOT NULL DEFAULT 0'
+    ))
+
+    connection.execute(sqlalchemy.text('''
+        CREATE TABLE IF NOT EXISTS product_stock_shards (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 1 NO CYCLE) PRIMARY KEY,
+            "productId" BIGINT NOT NULL REFERENCES products (id) ON DELETE CASCADE,
+            shard INTEGER NOT NULL,
+            quantity INTEGER NOT NULL CHECK (quantity >= 0)
+        )
+    '''))
+
+    connection.execute(sqlalchemy.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_product_stock_shards_product '
+        'ON product_stock_shards ("productId", shard)'
+    ))
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text('DROP TABLE IF EXISTS product_stock_shards'))
+    connection.execute(sqlalchemy.text('ALTER TABLE products DROP COLUMN IF EXISTS "stockShards"'))
@@ -0,0 +1,20 @@
+"""
+Версия и время изменения товара для условных запросов к каталогу (ETag, Last-Modified)
+"""
+
+import sqlalchemy
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE products ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1'
+    ))
+
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE products ADD COLUMN IF NOT EXISTS "dateUpdated" TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()'
+    ))
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text('ALTER TABLE products DROP COLUMN IF EXISTS "dateUpdated"'))
+    connection.execute(sqlalchemy.text('ALTER TABLE products DROP COLUMN IF EXISTS version'))
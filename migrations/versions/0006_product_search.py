@@ -0,0 +1,35 @@
+"""
+Полнотекстовый поиск товаров: вычисляемый столбец tsvector по заголовку (вес A)
+и описанию (вес B) и GIN-индекс по нему. Столбец пересчитывается самой БД
+при каждой записи товара, поэтому не расходится с данными.
+
+Добавление вычисляемого столбца перезаписывает таблицу products под блокировкой;
+индекс строится CONCURRENTLY, поэтому миграция выполняется вне транзакции.
+"""
+
+import sqlalchemy
+from migrations import create_index_concurrently
+
+
+TRANSACTIONAL = False
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text('''
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS "searchVector" TSVECTOR
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('russian', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('russian', coalesce(description, '')), 'B')
+        ) STORED
+    '''))
+
+    create_index_concurrently(
+        connection,
+        'ix_products_search',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_search ON products USING GIN ("searchVector")'
+    )
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text('DROP INDEX CONCURRENTLY IF EXISTS ix_products_search'))
+    connection.execute(sqlalchemy.text('ALTER TABLE products DROP COLUMN IF EXISTS "searchVector"'))
@@ -0,0 +1,23 @@
+"""
+Загруженные файлы. Содержимое лежит в хранилище на диске под своим SHA-256 (digest),
+таблица хранит тип содержимого и загрузившего пользователя.
+"""
+
+import sqlalchemy
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 1 NO CYCLE) PRIMARY KEY,
+            digest VARCHAR(64) NOT NULL UNIQUE,
+            size BIGINT NOT NULL,
+            "contentType" VARCHAR(255) NOT NULL,
+            "uploaderId" BIGINT NOT NULL REFERENCES users (id),
+            "dateCreated" TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        )
+    '''))
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text('DROP TABLE IF EXISTS attachments'))
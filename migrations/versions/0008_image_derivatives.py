@@ -0,0 +1,61 @@
+"""
+Производные изображения загруженных файлов (миниатюры и облегченные версии для веба):
+таблица заданий и их результатов и GIN-индекс по ссылкам на файлы товаров,
+по которому товары с обработанным файлом получают новую версию.
+
+Индекс по products строится CONCURRENTLY, поэтому миграция выполняется вне транзакции.
+"""
+
+import sqlalchemy
+from migrations import create_index_concurrently
+
+
+TRANSACTIONAL = False
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text('''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'derivativestatuses') THEN
+                CREATE TYPE derivativestatuses AS ENUM ('PENDING', 'RUNNING', 'DONE', 'FAILED');
+            END IF;
+        END
+        $$
+    '''))
+
+    connection.execute(sqlalchemy.text('''
+        CREATE TABLE IF NOT EXISTS attachment_derivatives (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 1 NO CYCLE) PRIMARY KEY,
+            "sourceDigest" VARCHAR(64) NOT NULL,
+            variant VARCHAR(32) NOT NULL,
+            status derivativestatuses NOT NULL,
+            attempts INTEGER NOT NULL,
+            "runAfter" TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            "lockedUntil" TIMESTAMP WITHOUT TIME ZONE,
+            "lastError" TEXT,
+            digest VARCHAR(64)
+        )
+    '''))
+
+    connection.execute(sqlalchemy.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_attachment_derivatives_source '
+        'ON attachment_derivatives ("sourceDigest", variant)'
+    ))
+
+    connection.execute(sqlalchemy.text(
+        'CREATE INDEX IF NOT EXISTS ix_attachment_derivatives_queue '
+        'ON attachment_derivatives (status, "runAfter")'
+    ))
+
+    create_index_concurrently(
+        connection,
+        'ix_products_attachments',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_products_attachments ON products USING GIN (attachments)'
+    )
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text('DROP INDEX CONCURRENTLY IF EXISTS ix_products_attachments'))
+    connection.execute(sqlalchemy.text('DROP TABLE IF EXISTS attachment_derivatives'))
+    connection.execute(sqlalchemy.text('DROP TYPE IF EXISTS derivativestatuses'))
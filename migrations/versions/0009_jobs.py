@@ -0,0 +1,42 @@
+"""
+Очередь фоновых заданий (jobs.JobWorker): письма, уведомления и другие побочные действия,
+которые не должны задерживать ответ. Готовые к выполнению задания выбираются по индексу
+(status, "runAfter").
+"""
+
+import sqlalchemy
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text('''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'jobstatuses') THEN
+                CREATE TYPE jobstatuses AS ENUM ('PENDING', 'RUNNING', 'FAILED');
+            END IF;
+        END
+        $$
+    '''))
+
+    connection.execute(sqlalchemy.text('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 1 NO CYCLE) PRIMARY KEY,
+            name VARCHAR(64) NOT NULL,
+            payload JSONB NOT NULL,
+            status jobstatuses NOT NULL,
+            attempts INTEGER NOT NULL,
+            "runAfter" TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            "lockedUntil" TIMESTAMP WITHOUT TIME ZONE,
+            "lastError" TEXT,
+            "dateCreated" TIMESTAMP WITHOUT TIME ZONE NOT NULL
+        )
+    '''))
+
+    connection.execute(sqlalchemy.text(
+        'CREATE INDEX IF NOT EXISTS ix_jobs_queue ON jobs (status, "runAfter")'
+    ))
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text('DROP TABLE IF EXISTS jobs'))
+    connection.execute(sqlalchemy.text('DROP TYPE IF EXISTS jobstatuses'))
@@ -0,0 +1,17 @@
+"""
+Время изменения товара в UTC: значение по умолчанию не зависит от TimeZone сессии БД
+"""
+
+import sqlalchemy
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE products ALTER COLUMN "dateUpdated" SET DEFAULT timezone(\'utc\', now())'
+    ))
+
+
+def downgrade(connection):
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE products ALTER COLUMN "dateUpdated" SET DEFAULT now()'
+    ))
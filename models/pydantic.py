@@ -1,12 +1,16 @@
 import pydantic
-from typing import Optional, Union
+from typing import Optional, Union, Annotated
 from datetime import datetime
 from . import sqlalchemy
 
+# Ссылка на вложение: в БД массивы attachments хранят VARCHAR(255)
+AttachmentUrl = Annotated[str, pydantic.StringConstraints(max_length=255)]
 
-class PydanticModel(pydantic.BaseModel, extra=pydantic.Extra.ignore):
+
+class PydanticModel(pydantic.BaseModel, extra=pydantic.Extra.ignore, from_attributes=True):
     """
-    Базовая модель Pydantic
+    Базовая модель Pydantic.
+    from_attributes: модели собираются прямо из атрибутов объектов ORM, без промежуточных словарей.
     """
 
 
@@ -57,7 +61,8 @@ class UserRegisterModel(PydanticModel):
 
 class UserModel(PydanticModel):
     """
-    Модель для регистрации пользователя
+    Модель пользователя для ответов и авторизации. Хэша пароля в ней нет,
+    поэтому он не попадает ни в один ответ: пароль проверяется по записи из БД.
     """
 
     id: Optional[int] = pydantic.Field(
@@ -72,12 +77,6 @@ class UserModel(PydanticModel):
         validation_alias=pydantic.AliasChoices('email')
     )
 
-    password_hash: str = pydantic.Field(
-        description='Хэш пароля пользователя',
-        serialization_alias='passwordHash',
-        validation_alias=pydantic.AliasChoices('passwordHash', 'password_hash')
-    )
-
     first_name: str = pydantic.Field(
         description='Имя пользователя',
         serialization_alias='firstName',
@@ -119,6 +118,13 @@ class UserModel(PydanticModel):
         validation_alias=pydantic.AliasChoices('role')
     )
 
+    credentials_version: int = pydantic.Field(
+        description='Версия учетных данных пользователя',
+        default=0,
+        serialization_alias='credentialsVersion',
+        validation_alias=pydantic.AliasChoices('credentialsVersion', 'credentials_version')
+    )
+
 
 class EmailCheckModel(PydanticModel):
     """
@@ -175,7 +181,14 @@ class ProductModel(PydanticModel):
     quantity_left: int = pydantic.Field(
         description='Кол-во оставшегося товара',
         serialization_alias='quantityLeft',
-        validation_alias=pydantic.AliasChoices('quantityLeft', 'quantity_left')
+        validation_alias=pydantic.AliasChoices('quantityLeft', 'quantity_left', 'quantity_available')
+    )
+
+    attachment_variants: dict[str, dict[str, str]] = pydantic.Field(
+        default_factory=dict,
+        description='Ссылки на готовые производные изображения вложений: ссылка на вложение -> вариант -> ссылка',
+        serialization_alias='attachmentVariants',
+        validation_alias=pydantic.AliasChoices('attachmentVariants', 'attachment_variants')
     )
 
     @pydantic.field_validator('quantity_left')
@@ -254,6 +267,36 @@ class DealModel(PydanticModel):
         return value
 
 
+class DealEventModel(PydanticModel):
+    """
+    Модель события изменения статуса сделки
+    """
+
+    deal_id: int = pydantic.Field(
+        description='ID сделки',
+        serialization_alias='dealId',
+        validation_alias=pydantic.AliasChoices('dealId', 'id')
+    )
+
+    status: sqlalchemy.DealStatuses = pydantic.Field(
+        description='Новый статус сделки',
+        serialization_alias='status',
+        validation_alias=pydantic.AliasChoices('status')
+    )
+
+    seller_id: int = pydantic.Field(
+        description='ID продавца',
+        serialization_alias='sellerId',
+        validation_alias=pydantic.AliasChoices('sellerId', 'seller_id')
+    )
+
+    consumer_id: int = pydantic.Field(
+        description='ID покупателя',
+        serialization_alias='consumerId',
+        validation_alias=pydantic.AliasChoices('consumerId', 'consumer_id')
+    )
+
+
 class DealListModel(pydantic.RootModel):
     root: list[DealModel]
 
@@ -262,6 +305,158 @@ class ProductListModel(pydantic.RootModel):
     root: list[ProductModel]
 
 
+class PageModel(PydanticModel):
+    """
+    Базовая модель страницы списка
+    """
+
+    next_cursor: Optional[str] = pydantic.Field(
+        description='Курсор следующей страницы (отсутствует на последней странице)',
+        default=None,
+        serialization_alias='nextCursor',
+        validation_alias=pydantic.AliasChoices('nextCursor', 'next_cursor')
+    )
+
+
+class DealPageModel(PageModel):
+    """
+    Модель страницы списка сделок
+    """
+
+    items: list[DealModel] = pydantic.Field(
+        description='Сделки',
+        serialization_alias='items',
+        validation_alias=pydantic.AliasChoices('items')
+    )
+
+
+class UserDealPageModel(DealPageModel):
+    """
+    Модель страницы сделок пользователя с кол-вом сделок по статусам
+    """
+
+    status_counts: dict[str, int] = pydantic.Field(
+        description='Кол-во сделок пользователя по статусам',
+        default_factory=dict,
+        serialization_alias='statusCounts',
+        validation_alias=pydantic.AliasChoices('statusCounts', 'status_counts')
+    )
+
+
+class ProductPageModel(PageModel):
+    """
+    Модель страницы списка товаров
+    """
+
+    items: list[ProductModel] = pydantic.Field(
+        description='Товары',
+        serialization_alias='items',
+        validation_alias=pydantic.AliasChoices('items')
+    )
+
+
+class AttachmentModel(PydanticModel):
+    """
+    Модель загруженного файла
+    """
+
+    digest: str = pydantic.Field(
+        description='SHA-256 содержимого',
+        serialization_alias='digest',
+        validation_alias=pydantic.AliasChoices('digest')
+    )
+
+    size: int = pydantic.Field(
+        description='Размер в байтах',
+        serialization_alias='size',
+        validation_alias=pydantic.AliasChoices('size')
+    )
+
+    content_type: str = pydantic.Field(
+        description='Тип содержимого',
+        serialization_alias='contentType',
+        validation_alias=pydantic.AliasChoices('contentType', 'content_type')
+    )
+
+    url: str = pydantic.Field(
+        description='Ссылка на файл для массивов attachments',
+        serialization_alias='url',
+        validation_alias=pydantic.AliasChoices('url')
+    )
+
+
+class DealMessageModel(PydanticModel):
+    """
+    Модель сообщения сделки
+    """
+
+    id: int = pydantic.Field(
+        description='ID сообщения',
+        serialization_alias='id',
+        validation_alias=pydantic.AliasChoices('id')
+    )
+
+    deal_id: int = pydantic.Field(
+        description='ID сделки',
+        serialization_alias='dealId',
+        validation_alias=pydantic.AliasChoices('dealId', 'deal_id')
+    )
+
+    from_user_id: int = pydantic.Field(
+        description='ID отправителя',
+        serialization_alias='fromUserId',
+        validation_alias=pydantic.AliasChoices('fromUserId', 'from_user_id')
+    )
+
+    message: str = pydantic.Field(
+        description='Текст сообщения',
+        serialization_alias='message',
+        validation_alias=pydantic.AliasChoices('message')
+    )
+
+    attachments: Optional[list[str]] = pydantic.Field(
+        description='Ссылки на вложения',
+        default=None,
+        serialization_alias='attachments',
+        validation_alias=pydantic.AliasChoices('attachments')
+    )
+
+
+class DealMessageCreateModel(PydanticModel):
+    """
+    Модель для отправки сообщения сделки
+    """
+
+    message: str = pydantic.Field(
+        description='Текст сообщения',
+        min_length=1,
+        max_length=256,
+        serialization_alias='message',
+        validation_alias=pydantic.AliasChoices('message')
+    )
+
+    # Сообщение целиком передается другим процессам через NOTIFY (не более 8000 байт)
+    attachments: Optional[list[AttachmentUrl]] = pydantic.Field(
+        description='Ссылки на вложения',
+        default=None,
+        max_length=10,
+        serialization_alias='attachments',
+        validation_alias=pydantic.AliasChoices('attachments')
+    )
+
+
+class DealMessagePageModel(PageModel):
+    """
+    Модель страницы истории сообщений сделки (новые первыми)
+    """
+
+    items: list[DealMessageModel] = pydantic.Field(
+        description='Сообщения',
+        serialization_alias='items',
+        validation_alias=pydantic.AliasChoices('items')
+    )
+
+
 class ProductCreateModel(PydanticModel):
     """
     Модель для валидации товара
@@ -279,7 +474,7 @@ class ProductCreateModel(PydanticModel):
         validation_alias='description'
     )
 
-    attachments: list[str] = pydantic.Field(
+    attachments: list[AttachmentUrl] = pydantic.Field(
         description='Ссылки на вложения',
         serialization_alias='attachments',
         validation_alias='attachments'
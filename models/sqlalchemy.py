@@ -1,39 +1,162 @@
 import enum
+import os
+import base64
 import typing
 import settings
 import operator
 import sqlalchemy
 import json
-import attridict
 from sqlalchemy.schema import CreateColumn
 from sqlalchemy.ext.compiler import compiles
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy_utils import database_exists, create_database, drop_database
 
 
 DATABASE_CONNECTION_URL = settings.DATABASE_URL
+ASYNC_DATABASE_CONNECTION_URL = settings.ASYNC_DATABASE_URL
+
+# Движки создаются при первом обращении (get_engine/get_async_engine),
+# поэтому импорт моделей не обращается к БД.
+engine: typing.Optional[sqlalchemy.Engine] = None
+async_engine: typing.Optional[AsyncEngine] = None
+async_session_maker: typing.Optional[async_sessionmaker] = None
+
+
+class InstrumentedAsyncPool(sqlalchemy.pool.AsyncAdaptedQueuePool):
+    """
+    Пул соединений, ведущий учет корутин, ожидающих свободное соединение
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+
+    def _do_get(self):
+        self.waiting += 1
+
+        try:
+            return super()._do_get()
+        finally:
+            self.waiting -= 1
+
+
+def create_database_if_missing() -> bool:
+    """
+    Создает БД проекта, если ее еще нет. Выводит True, если БД была создана.
+    """
+
+    if database_exists(DATABASE_CONNECTION_URL):
+        return False
 
-if not database_exists(DATABASE_CONNECTION_URL):
     create_database(DATABASE_CONNECTION_URL)
+    return True
+
+
+def get_engine() -> sqlalchemy.Engine:
+    """
+    Выдает синхронный движок (миграции и служебные команды)
+    """
+
+    global engine
+
+    if engine is None:
+        engine = sqlalchemy.create_engine(DATABASE_CONNECTION_URL)
+
+    return engine
+
+
+def get_async_engine() -> AsyncEngine:
+    """
+    Выдает асинхронный движок, которым обслуживаются запросы
+    """
+
+    global async_engine, async_session_maker
+
+    if async_engine is None:
+        async_engine = create_async_engine(
+            ASYNC_DATABASE_CONNECTION_URL,
+            poolclass=InstrumentedAsyncPool,
+            pool_size=settings.DATABASE_POOL_SIZE,
+            max_overflow=settings.DATABASE_MAX_OVERFLOW,
+            pool_timeout=settings.DATABASE_POOL_TIMEOUT,
+            pool_recycle=settings.DATABASE_POOL_RECYCLE,
+            pool_pre_ping=settings.DATABASE_POOL_PRE_PING,
+            query_cache_size=settings.DATABASE_QUERY_CACHE_SIZE,
+        )
+
+        # expire_on_commit=False: после commit атрибуты объектов не сбрасываются,
+        # иначе повторное обращение к ним вызвало бы неявный запрос вне await.
+        async_session_maker = async_sessionmaker(
+            bind=async_engine,
+            expire_on_commit=False
+        )
+
+    return async_engine
+
+
+async def dispose_engines() -> None:
+    """
+    Закрывает соединения обоих движков при остановке приложения
+    """
+
+    global engine, async_engine, async_session_maker
+
+    if async_engine is not None:
+        await async_engine.dispose()
+
+    if engine is not None:
+        engine.dispose()
+
+    engine = async_engine = async_session_maker = None
+
+def contains_filter(column, value):
+    """
+    Фильтр contains: для массивов - оператор @> (одно значение оборачивается в массив),
+    для остальных колонок - column.contains (LIKE '%значение%'). Базовый ARRAY contains не поддерживает.
+    """
+
+    if isinstance(column.type, sqlalchemy.ARRAY):
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        return column.bool_op('@>')(sqlalchemy.literal(values, column.type))
 
-engine = sqlalchemy.create_engine(DATABASE_CONNECTION_URL)
-session = sqlalchemy.orm.Session(bind=engine)
+    return column.contains(value)
 
+
+# Фильтры вида поле__фильтр=значение. Каждый строит SQL-условие со значением
+# в параметре запроса, поэтому запросы одной формы используют общий
+# скомпилированный SQL из кэша движка.
 FILTER_QUERIES = {
-    'in': operator.contains,
-    'contains': operator.contains,
+    'in': lambda column, value: column.in_(value),
+    'not_in': lambda column, value: column.not_in(value),
+    'contains': contains_filter,
     'eq': operator.eq,
+    'ne': operator.ne,
     'gt': operator.gt,
     'gte': operator.ge,
     'lte': operator.le,
     'lt': operator.lt,
-    'is_not': operator.is_not,
-    'and': operator.and_,
-    'or': operator.or_,
-    'index': operator.indexOf,
+    'is': lambda column, value: column.is_(value),
+    'is_not': lambda column, value: column.is_not(value),
+}
+
+# Разобранные сигнатуры фильтров: (модель, ключи kwargs) -> ((атрибут, фильтр), ...)
+COMPILED_FILTERS: typing.Dict[typing.Tuple[type, typing.Tuple[str, ...]], tuple] = {}
+
+# Стратегии загрузки связей для плана загрузки (параметр load у fetch_one/fetch_all).
+# По умолчанию связи не загружаются вовсе (lazy='raise').
+LOAD_STRATEGIES = {
+    'joined': 'joinedload',
+    'selectin': 'selectinload',
+    'none': 'raiseload',
 }
 
+# Конфигурация полнотекстового поиска PostgreSQL для товаров (словарь и стемминг).
+# Вектор товаров строится с ней миграцией 0006_product_search; смена требует новой миграции.
+SEARCH_CONFIG = 'russian'
+
 
 @compiles(CreateColumn, 'postgresql')
 def use_identity(element, compiler, **kw):
@@ -46,6 +169,178 @@ def get_current_time():
     return datetime.now()
 
 
+def encode_cursor(values: list) -> str:
+    """
+    Упаковывает значения ключа последней строки страницы в непрозрачный курсор
+    """
+
+    raw = json.dumps(values, default=str, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> list:
+    """
+    Распаковывает курсор, выданный encode_cursor.
+    При поврежденном курсоре выбрасывает ValueError.
+    """
+
+    padding = '=' * (-len(cursor) % 4)
+    values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+
+    if not isinstance(values, list) or len(values) != 2 or not isinstance(values[1], int):
+        raise ValueError('Некорректный курсор пагинации.')
+
+    return values
+
+
+def pool_status() -> dict:
+    """
+    Возвращает состояние пула соединений текущего процесса
+    """
+
+    pool = get_async_engine().pool
+
+    return {
+        'size': pool.size(),
+        'checkedOut': pool.checkedout(),
+        'idle': pool.checkedin(),
+        'overflow': pool.overflow(),
+        'waiting': pool.waiting,
+        'timeout': pool.timeout(),
+    }
+
+
+def dispose_engines_after_fork():
+    """
+    Сбрасывает унаследованные от родителя соединения в дочернем процессе.
+    close=False: сокеты принадлежат родителю, закрывать их здесь нельзя.
+    """
+
+    if engine is not None:
+        engine.dispose(close=False)
+
+    if async_engine is not None:
+        async_engine.sync_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=dispose_engines_after_fork)
+
+
+async def get_session() -> typing.AsyncIterator[AsyncSession]:
+    """
+    Выдает отдельную асинхронную сессию БД на время одного запроса
+    """
+
+    get_async_engine()
+
+    async with async_session_maker() as session:
+        yield session
+
+
+class Record:
+    """
+    Компактная запись строки модели (атрибуты в __slots__), которую выдают fetch_one/fetch_all.
+    Типы записей генерируются по одному на модель при настройке мапперов (create_row_mapper).
+    Не загруженные связи в записи отсутствуют, а не равны None.
+    """
+
+    __slots__ = ()
+    __record_fields__: typing.Tuple[str, ...] = ()
+
+    def as_dict(self) -> dict:
+        result = {}
+
+        for key in self.__record_fields__:
+            try:
+                value = getattr(self, key)
+            except AttributeError:
+                continue
+
+            if isinstance(value, Record):
+                value = value.as_dict()
+            elif isinstance(value, list):
+                value = [item.as_dict() if isinstance(item, Record) else item for item in value]
+
+            result[key] = value
+
+        return result
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.as_dict()!r})'
+
+
+def create_row_mapper(model: type) -> typing.Callable:
+    """
+    Генерирует тип записи для модели и метод to_record, переносящий в него загруженное состояние объекта ORM.
+    Свойства (property) модели переносятся в тип записи и считаются по ее полям.
+    """
+
+    mapper = sqlalchemy.inspect(model)
+    column_keys = tuple(attribute.key for attribute in mapper.column_attrs if not attribute.deferred)
+    relationship_keys = tuple(relationship.key for relationship in mapper.relationships)
+
+    properties = {}
+    for klass in reversed(model.__mro__):
+        for name, value in vars(klass).items():
+            if isinstance(value, property) and not name.startswith('_'):
+                properties[name] = value
+
+    record_type = type(f'{model.__name__}Record', (Record,), {
+        '__slots__': column_keys + relationship_keys,
+        '__record_fields__': column_keys + relationship_keys + tuple(properties),
+        '__module__': model.__module__,
+        **properties,
+    })
+
+    # to_record генерируется для модели одной функцией: колонки присваиваются подряд, связи
+    # разбираются по заранее известному виду (объект или список) - без циклов, setattr и isinstance
+    # на каждую строку. Если загружены не все колонки, они переносятся циклом (fill_loaded_columns).
+    lines = [
+        'def to_record(instance, memo=None):',
+        '    if memo is None:',
+        '        memo = {}',
+        '    key = id(instance)',
+        '    record = memo.get(key)',
+        '    if record is not None:',
+        '        return record',
+        '    values = instance.__dict__',
+        '    record = memo[key] = new_record(record_type)',
+        '    try:',
+        *[f'        record.{key} = values[{key!r}]' for key in column_keys],
+        '    except KeyError:',
+        '        fill_loaded_columns(record, values)',
+    ]
+
+    for relationship in mapper.relationships:
+        lines += [
+            f'    related = values.get({relationship.key!r}, MISSING)',
+            '    if related is not MISSING:',
+            f'        record.{relationship.key} = ' + (
+                '[item.to_record(memo) for item in related]' if relationship.uselist
+                else 'None if related is None else related.to_record(memo)'
+            ),
+        ]
+
+    lines.append('    return record')
+
+    def fill_loaded_columns(record, values):
+        for key in column_keys:
+            if key in values:
+                setattr(record, key, values[key])
+
+    namespace = {
+        'new_record': object.__new__,
+        'record_type': record_type,
+        'fill_loaded_columns': fill_loaded_columns,
+        'MISSING': object(),
+    }
+    exec('\n'.join(lines), namespace)
+    to_record = namespace['to_record']
+
+    to_record.record_type = record_type
+    return to_record
+
+
 class SqlAlchemyModel(DeclarativeBase):
     """
     Базовая модель СУБД проекта
@@ -57,23 +352,27 @@ class SqlAlchemyModel(DeclarativeBase):
         primary_key=True
     )
 
-    def as_dict(self):
-        instance_dict = self.__dict__.copy()
-        instance_dict.pop('_sa_instance_state')
+    # Метод to_record(), переводящий объект в запись (Record),
+    # добавляется каждой модели при настройке мапперов, см. create_row_mapper.
 
-        return attridict.AttriDict(instance_dict)
+    def as_dict(self):
+        return self.to_record().as_dict()
 
     def __str__(self):
-        return json.dumps(self.as_dict())
+        return json.dumps(self.as_dict(), default=str, ensure_ascii=False)
 
     def __repr__(self):
-        return json.dumps(self.as_dict())
+        return json.dumps(self.as_dict(), default=str, ensure_ascii=False)
 
     def __json__(self):
         return self.as_dict()
 
     @classmethod
-    def filter_field(cls, key, value):
+    def parse_filter_key(cls, key: str) -> typing.Tuple[typing.Any, typing.Callable]:
+        """
+        Разбирает ключ вида поле__фильтр в пару (атрибут модели, функция фильтра)
+        """
+
         default_filter_name = 'eq'
 
         if key.count('__') > 1:
@@ -93,19 +392,35 @@ class SqlAlchemyModel(DeclarativeBase):
                 f'Фильтра "__{filter_name}" не существует.'
             )
 
-        filter_func = FILTER_QUERIES[filter_name]
-        return filter_func(getattr(cls, key), value)
+        return getattr(cls, key), FILTER_QUERIES[filter_name]
 
     @classmethod
-    def convert_kwargs(cls, **kwargs):
-        new_filters = []
+    def compile_filters(cls, keys: typing.Tuple[str, ...]) -> tuple:
+        """
+        Выдает разобранные фильтры для набора ключей; разбор выполняется один раз на сигнатуру
+        """
 
-        for key, value in kwargs.items():
-            new_filters.append(
-                cls.filter_field(key, value)
-            )
+        signature = (cls, keys)
+        compiled = COMPILED_FILTERS.get(signature)
+
+        if compiled is None:
+            compiled = COMPILED_FILTERS[signature] = tuple(cls.parse_filter_key(key) for key in keys)
+
+        return compiled
 
-        return new_filters
+    @classmethod
+    def filter_field(cls, key, value):
+        column, filter_func = cls.compile_filters((key,))[0]
+        return filter_func(column, value)
+
+    @classmethod
+    def convert_kwargs(cls, **kwargs):
+        compiled = cls.compile_filters(tuple(kwargs))
+
+        return [
+            filter_func(column, value)
+            for (column, filter_func), value in zip(compiled, kwargs.values())
+        ]
 
     @classmethod
     def decompile_filters(cls, **filters):
@@ -121,72 +436,543 @@ class SqlAlchemyModel(DeclarativeBase):
         return result
 
     @classmethod
-    def fetch_one(cls, *filters: typing.Callable, **kwargs: [str, typing.Any]) -> typing.Self:
+    def load_options(cls, load: typing.Dict[str, str] = None) -> list:
+        """
+        Переводит план загрузки вида {'product.seller': 'joined'} в опции запроса.
+        Промежуточные связи пути загружаются по своей стратегии из плана, если она указана.
+        """
+
+        options = []
+
+        for path, strategy in (load or {}).items():
+            if strategy not in LOAD_STRATEGIES:
+                raise RuntimeError(
+                    f'Стратегии загрузки "{strategy}" не существует.'
+                )
+
+            model = cls
+            option = None
+            names = path.split('.')
+
+            for index, name in enumerate(names):
+                attribute = getattr(model, name)
+                loader = LOAD_STRATEGIES[strategy] if index == len(names) - 1 else 'defaultload'
+
+                if option is None:
+                    option = getattr(sqlalchemy.orm, loader)(attribute)
+                else:
+                    option = getattr(option, loader)(attribute)
+
+                model = attribute.property.mapper.class_
+
+            options.append(option)
+
+        return options
+
+    @classmethod
+    async def fetch_one(
+            cls,
+            session: AsyncSession,
+            *filters: typing.Callable,
+            load: typing.Dict[str, str] = None,
+            **kwargs: [str, typing.Any]
+    ) -> typing.Self:
         kwargs_filters = cls.convert_kwargs(**kwargs)
 
-        query = session.execute(
-            sqlalchemy.select(cls).where(*filters, *kwargs_filters).limit(1)
+        query = await session.execute(
+            sqlalchemy.select(cls)
+            .options(*cls.load_options(load))
+            .where(*filters, *kwargs_filters)
+            .limit(1)
         )
 
         response = query.unique().fetchone()
         if not response:
             return None
 
-        return response[0].as_dict()
+        return response[0].to_record()
+
+    @classmethod
+    def keyset_filter(cls, order_by: str, after: list, descending: bool = False) -> typing.Any:
+        """
+        Условие выборки строк, идущих после ключа (значение order_by, id)
+        """
+
+        value, row_id = after
+        compare = operator.lt if descending else operator.gt
+
+        if order_by == 'id':
+            return compare(cls.id, row_id)
+
+        column = getattr(cls, order_by)
+        if isinstance(column.type, sqlalchemy.DateTime) and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+
+        return compare(sqlalchemy.tuple_(column, cls.id), sqlalchemy.tuple_(value, row_id))
+
+    @classmethod
+    def select_query(
+            cls,
+            *filters: typing.Callable,
+            limit: int = None,
+            offset: int = None,
+            after: list = None,
+            order_by: str = 'id',
+            descending: bool = False,
+            load: typing.Dict[str, str] = None,
+            **kwargs: [str, typing.Any]
+    ) -> sqlalchemy.Select:
+        """
+        Собирает SELECT с фильтрами, планом загрузки и сортировкой по ключу (order_by, id)
+        """
+
+        query = sqlalchemy.select(cls).options(*cls.load_options(load))
+
+        return cls.filter_query(
+            query,
+            *filters,
+            limit=limit,
+            offset=offset,
+            after=after,
+            order_by=order_by,
+            descending=descending,
+            **kwargs
+        )
 
     @classmethod
-    def fetch_all(cls, *filters: typing.Callable, **kwargs: [str, typing.Any]) -> typing.List[typing.Self]:
+    def filter_query(
+            cls,
+            query: sqlalchemy.Select,
+            *filters: typing.Callable,
+            limit: int = None,
+            offset: int = None,
+            after: list = None,
+            order_by: str = 'id',
+            descending: bool = False,
+            **kwargs: [str, typing.Any]
+    ) -> sqlalchemy.Select:
+        """
+        Добавляет к SELECT фильтры, ключ страницы, сортировку по (order_by, id), лимит и смещение.
+        order_by вида "-price" сортирует по убыванию.
+        """
+
+        if order_by.startswith('-'):
+            order_by = order_by[1:]
+            descending = not descending
+
         kwargs_filters = cls.convert_kwargs(**kwargs)
 
-        query = session.execute(
-            sqlalchemy.select(cls).where(*filters, *kwargs_filters)
+        if after is not None:
+            kwargs_filters.append(cls.keyset_filter(order_by, after, descending))
+
+        query = query.where(*filters, *kwargs_filters)
+
+        order_columns = [cls.id] if order_by == 'id' else [getattr(cls, order_by), cls.id]
+        if descending:
+            order_columns = [column.desc() for column in order_columns]
+
+        query = query.order_by(*order_columns)
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        if offset is not None:
+            query = query.offset(offset)
+
+        return query
+
+    @classmethod
+    def row_columns(cls, names: typing.Sequence[str] = None) -> typing.List[typing.Tuple[str, sqlalchemy.Column]]:
+        """
+        Выводит пары (имя атрибута, колонка таблицы) для указанных атрибутов (по умолчанию всех не отложенных колонок)
+        """
+
+        mapper = sqlalchemy.inspect(cls)
+        keys = names or [attribute.key for attribute in mapper.column_attrs if not attribute.deferred]
+
+        return [(key, mapper.columns[key]) for key in keys]
+
+    @classmethod
+    async def fetch_rows(
+            cls,
+            session: AsyncSession,
+            *filters: typing.Callable,
+            columns: typing.Sequence[str] = None,
+            join: typing.Dict[str, typing.Sequence[str]] = None,
+            limit: int = None,
+            offset: int = None,
+            after: list = None,
+            order_by: str = 'id',
+            descending: bool = False,
+            **kwargs: [str, typing.Any]
+    ) -> typing.List[dict]:
+        """
+        Режим только для чтения: выбирает указанные колонки (и колонки связей many-to-one из join)
+        запросом Core в обход ORM и выводит строки словарями, связи - вложенными словарями.
+        Пример: Product.fetch_rows(session, columns=['id', 'title'], join={'seller': ['id', 'email']})
+        """
+
+        mapper = sqlalchemy.inspect(cls)
+        column_keys = [key for key, _ in cls.row_columns(columns)]
+        selected = [column.label(key) for key, column in cls.row_columns(columns)]
+
+        from_clause = cls.__table__
+        joined_labels = []
+
+        for name, related_columns in (join or {}).items():
+            relationship = mapper.relationships[name]
+
+            if relationship.uselist:
+                raise RuntimeError(
+                    f'Связь "{name}" не является связью many-to-one.'
+                )
+
+            target = relationship.mapper.local_table.alias(name)
+            pairs = relationship.local_remote_pairs
+
+            from_clause = from_clause.join(
+                target,
+                sqlalchemy.and_(*[local == target.c[remote.key] for local, remote in pairs]),
+                isouter=any(local.nullable for local, _ in pairs)
+            )
+
+            labels = []
+            for key, column in relationship.mapper.class_.row_columns(related_columns):
+                label = f'{name}__{key}'
+                selected.append(target.c[column.key].label(label))
+                labels.append((key, label))
+
+            joined_labels.append((name, labels))
+
+        query = cls.filter_query(
+            sqlalchemy.select(*selected).select_from(from_clause),
+            *filters,
+            limit=limit,
+            offset=offset,
+            after=after,
+            order_by=order_by,
+            descending=descending,
+            **kwargs
+        )
+
+        connection = await session.connection()
+        result = await connection.execute(query)
+
+        rows = []
+        for row in result.mappings():
+            item = {key: row[key] for key in column_keys}
+
+            for name, labels in joined_labels:
+                related = {key: row[label] for key, label in labels}
+                item[name] = related if any(value is not None for value in related.values()) else None
+
+            rows.append(item)
+
+        return rows
+
+    @classmethod
+    async def fetch_all(
+            cls,
+            session: AsyncSession,
+            *filters: typing.Callable,
+            limit: int = None,
+            offset: int = None,
+            after: list = None,
+            order_by: str = 'id',
+            descending: bool = False,
+            load: typing.Dict[str, str] = None,
+            **kwargs: [str, typing.Any]
+    ) -> typing.List[typing.Self]:
+        query = cls.select_query(
+            *filters,
+            limit=limit,
+            offset=offset,
+            after=after,
+            order_by=order_by,
+            descending=descending,
+            load=load,
+            **kwargs
+        )
+
+        result = (await session.execute(query)).unique().fetchall()
+        # Общий memo: связанные объекты, общие для многих строк, переводятся в запись один раз
+        memo = {}
+        return [row[0].to_record(memo) for row in result]
+
+    @classmethod
+    async def fetch_page(
+            cls,
+            session: AsyncSession,
+            *filters: typing.Callable,
+            limit: int,
+            after: list = None,
+            order_by: str = 'id',
+            descending: bool = False,
+            load: typing.Dict[str, str] = None,
+            **kwargs: [str, typing.Any]
+    ) -> typing.Tuple[typing.List[typing.Self], typing.Optional[str]]:
+        """
+        Выводит страницу строк по ключу (order_by, id) и курсор следующей страницы.
+        Курсор равен None, если страница последняя.
+        """
+
+        rows = await cls.fetch_all(
+            session,
+            *filters,
+            limit=limit + 1,
+            after=after,
+            order_by=order_by,
+            descending=descending,
+            load=load,
+            **kwargs
         )
 
-        result = query.unique().fetchall()
-        return [row[0].as_dict() for row in result]
+        return cls.paginate(rows, limit, order_by)
+
+    @classmethod
+    def paginate(cls, rows: list, limit: int, order_by: str = 'id') -> typing.Tuple[list, typing.Optional[str]]:
+        """
+        Обрезает выборку из limit + 1 строк до страницы и выдает курсор следующей страницы
+        """
+
+        if len(rows) <= limit:
+            return rows, None
+
+        rows = rows[:limit]
+        last_row = rows[-1]
+        order_by = order_by.lstrip('-')
+
+        if isinstance(last_row, dict):
+            return rows, encode_cursor([last_row[order_by], last_row['id']])
+
+        return rows, encode_cursor([getattr(last_row, order_by), last_row.id])
 
     @classmethod
-    def create(cls, **kwargs) -> typing.Self:
+    async def execute_returning(
+            cls,
+            session: AsyncSession,
+            statement: typing.Any,
+            parameters: typing.List[dict] = None,
+            load: typing.Dict[str, str] = None
+    ) -> typing.List[Record]:
+        """
+        Выполняет INSERT/UPDATE с RETURNING и выводит затронутые строки записями.
+        С пачкой parameters строки выводятся в порядке параметров.
+        Без плана загрузки это один запрос; связи из плана догружаются вторым запросом по ID.
+        """
+
+        result = await session.execute(
+            statement.returning(cls, sort_by_parameter_order=parameters is not None),
+            parameters,
+            execution_options={'populate_existing': True}
+        )
+
+        instances = result.scalars().all()
+
+        if load and instances:
+            query = cls.select_query(
+                cls.id.in_([instance.id for instance in instances]),
+                load=load
+            ).execution_options(populate_existing=True)
+
+            loaded = {
+                instance.id: instance
+                for instance in (await session.execute(query)).scalars().all()
+            }
+
+            instances = [loaded[instance.id] for instance in instances]
+
+        memo = {}
+        return [instance.to_record(memo) for instance in instances]
+
+    @staticmethod
+    def batches(rows: typing.Sequence[dict], batch_size: int) -> typing.Iterator[typing.Sequence[dict]]:
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+    @classmethod
+    async def create(cls, session: AsyncSession, load: typing.Dict[str, str] = None, **kwargs) -> typing.Self:
         if 'id' in kwargs:
             kwargs.pop('id')
 
-        result = session.execute(
-            sqlalchemy.insert(cls).values(**kwargs)
+        records = await cls.execute_returning(
+            session,
+            sqlalchemy.insert(cls).values(**kwargs),
+            load=load
         )
 
-        session.commit()
-        return cls.fetch_one(id=result.inserted_primary_key)
+        await session.commit()
+        return records[0]
+
+    @classmethod
+    async def create_many(
+            cls,
+            session: AsyncSession,
+            rows: typing.Sequence[dict],
+            batch_size: int = None,
+            load: typing.Dict[str, str] = None
+    ) -> typing.List[Record]:
+        """
+        Создает строки пачками по batch_size одним INSERT ... RETURNING на пачку.
+        Записи выводятся в порядке rows; все пачки выполняются в одной транзакции.
+        """
+
+        batch_size = batch_size or settings.DATABASE_BULK_BATCH_SIZE
+        rows = [{key: value for key, value in row.items() if key != 'id'} for row in rows]
+        records = []
+
+        for batch in cls.batches(rows, batch_size):
+            records.extend(await cls.execute_returning(
+                session,
+                sqlalchemy.insert(cls),
+                list(batch),
+                load=load
+            ))
+
+        await session.commit()
+        return records
 
     @classmethod
-    def fetch_or_create(cls, **kwargs: [str, typing.Any]) -> [typing.Self, bool]:
-        data = cls.fetch_one(**kwargs)
+    async def fetch_or_create(
+            cls,
+            session: AsyncSession,
+            load: typing.Dict[str, str] = None,
+            **kwargs: [str, typing.Any]
+    ) -> [typing.Self, bool]:
+        data = await cls.fetch_one(session, load=load, **kwargs)
 
         if not data:
             kwargs_decompiled = cls.decompile_filters(**kwargs)
-            return [cls.create(**kwargs_decompiled), True]
+            return [await cls.create(session, load=load, **kwargs_decompiled), True]
 
         return [data, False]
 
     @classmethod
-    def delete(cls,  *filters: typing.Callable, **kwargs: [str, typing.Any]) -> None:
+    async def delete(cls, session: AsyncSession, *filters: typing.Callable, **kwargs: [str, typing.Any]) -> None:
         kwargs_filters = cls.convert_kwargs(**kwargs)
 
-        session.execute(
+        await session.execute(
             sqlalchemy.delete(cls).where(*filters, *kwargs_filters)
         )
 
-        return session.commit()
+        return await session.commit()
 
     @classmethod
-    def update(cls, row_id: int, **kwargs) -> typing.Self:
-        filter_query = cls.convert_kwargs(id=row_id)
-
-        query = session.execute(
-            sqlalchemy.update(cls).where(*filter_query).values(**kwargs)
+    async def update(cls, session: AsyncSession, row_id: int, load: typing.Dict[str, str] = None, **kwargs) -> typing.Self:
+        """
+        Обновляет строку и выводит ее новое состояние (None, если строки нет) через UPDATE ... RETURNING
+        """
+
+        records = await cls.execute_returning(
+            session,
+            sqlalchemy.update(cls).where(cls.id == row_id).values(**kwargs),
+            load=load
         )
 
-        session.commit()
-        return cls.fetch_one(id=query.lastrowid)
+        await session.commit()
+        return records[0] if records else None
+
+    @classmethod
+    async def update_many(
+            cls,
+            session: AsyncSession,
+            rows: typing.Sequence[dict],
+            batch_size: int = None,
+            load: typing.Dict[str, str] = None
+    ) -> typing.List[Record]:
+        """
+        Обновляет строки по их ID (ключ 'id' в каждой строке) пачками:
+        один UPDATE ... FROM (VALUES ...) RETURNING на пачку строк с одинаковым набором полей.
+        """
+
+        batch_size = batch_size or settings.DATABASE_BULK_BATCH_SIZE
+        groups: typing.Dict[typing.Tuple[str, ...], list] = {}
+
+        for row in rows:
+            keys = tuple(key for key in row if key != 'id')
+            groups.setdefault(keys, []).append(row)
+
+        records = []
+
+        for keys, group in groups.items():
+            column_types = {key: getattr(cls, key).type for key in keys}
+
+            for batch in cls.batches(group, batch_size):
+                data = sqlalchemy.values(
+                    sqlalchemy.column('id', cls.id.type),
+                    *[sqlalchemy.column(key, column_type) for key, column_type in column_types.items()],
+                    name='data'
+                ).data([(row['id'], *[row[key] for key in keys]) for row in batch])
+
+                # CAST: параметры внутри VALUES иначе приходят в БД как text
+                statement = (
+                    sqlalchemy.update(cls)
+                    .where(cls.id == sqlalchemy.cast(data.c.id, cls.id.type))
+                    .values({
+                        key: sqlalchemy.cast(data.c[key], column_type)
+                        for key, column_type in column_types.items()
+                    })
+                    .execution_options(synchronize_session=False)
+                )
+
+                records.extend(await cls.execute_returning(session, statement, load=load))
+
+        await session.commit()
+        return records
+
+    @classmethod
+    async def upsert(
+            cls,
+            session: AsyncSession,
+            rows: typing.Sequence[dict],
+            conflict: typing.Sequence[typing.Any] = ('id',),
+            update: typing.Sequence[str] = None,
+            batch_size: int = None,
+            load: typing.Dict[str, str] = None
+    ) -> typing.List[Record]:
+        """
+        INSERT ... ON CONFLICT (conflict) DO UPDATE ... RETURNING пачками по batch_size.
+        conflict - колонки или выражения уникального индекса, update - обновляемые поля
+        (по умолчанию все переданные, кроме полей конфликта).
+        ON CONFLICT DO UPDATE не вызывает onupdate колонок, поэтому они добавляются в SET явно
+        (у товаров - version и dateUpdated). Кэши ответов вызывающий сбрасывает сам
+        (для товаров - responses.invalidate_product).
+        """
+
+        batch_size = batch_size or settings.DATABASE_BULK_BATCH_SIZE
+        conflict_elements = [getattr(cls, element) if isinstance(element, str) else element for element in conflict]
+        records = []
+
+        for batch in cls.batches(rows, batch_size):
+            statement = postgresql.insert(cls).values(list(batch))
+
+            update_keys = update or [
+                key for key in batch[0]
+                if key != 'id' and key not in conflict
+            ]
+
+            update_columns = [getattr(cls, key).property.columns[0] for key in update_keys]
+            values = {column: statement.excluded[column.name] for column in update_columns}
+
+            for column in cls.__table__.columns:
+                if column.onupdate is not None and column not in values:
+                    onupdate = column.onupdate
+                    values[column] = onupdate.arg(None) if onupdate.is_callable else onupdate.arg
+
+            statement = statement.on_conflict_do_update(
+                index_elements=conflict_elements,
+                set_=values
+            )
+
+            records.extend(await cls.execute_returning(session, statement, load=load))
+
+        await session.commit()
+        return records
+
+
+@sqlalchemy.event.listens_for(SqlAlchemyModel, 'mapper_configured', propagate=True)
+def attach_row_mapper(mapper, model):
+    model.to_record = create_row_mapper(model)
 
 
 class DealStatuses(enum.Enum):
@@ -203,6 +989,79 @@ class DealStatuses(enum.Enum):
     CLOSED_SUCCESSFULLY = 'Сделка успешно завершена'
 
 
+class DealRoles(enum.Enum):
+    """
+    Enum'ы ролей пользователя в сделке
+    """
+
+    SELLER = 'продавец'
+    CONSUMER = 'покупатель'
+
+
+class DealTransition(typing.NamedTuple):
+    """
+    Переход сделки: статусы, из которых он допустим, и итоговый статус для каждой роли,
+    которой переход разрешен
+    """
+
+    sources: typing.Tuple[DealStatuses, ...]
+    targets: typing.Dict[DealRoles, DealStatuses]
+    releases_stock: bool = False
+
+
+# Таблица переходов сделки между статусами
+DEAL_TRANSITIONS: typing.Dict[str, DealTransition] = {
+    'pay': DealTransition(
+        sources=(DealStatuses.CREATED,),
+        targets={DealRoles.CONSUMER: DealStatuses.PAID}
+    ),
+    'cancel': DealTransition(
+        sources=(DealStatuses.CREATED,),
+        targets={
+            DealRoles.SELLER: DealStatuses.CANCELED_BY_SELLER,
+            DealRoles.CONSUMER: DealStatuses.CANCELED_BY_CONSUMER,
+        },
+        releases_stock=True
+    ),
+    'supply': DealTransition(
+        sources=(DealStatuses.PAID,),
+        targets={DealRoles.SELLER: DealStatuses.PRODUCT_SUPPLIED}
+    ),
+    'submit': DealTransition(
+        sources=(DealStatuses.PRODUCT_SUPPLIED,),
+        targets={DealRoles.CONSUMER: DealStatuses.CLOSED_SUCCESSFULLY}
+    ),
+    'arbitration': DealTransition(
+        sources=(DealStatuses.PRODUCT_SUPPLIED,),
+        targets={
+            DealRoles.SELLER: DealStatuses.ARBITRATION,
+            DealRoles.CONSUMER: DealStatuses.ARBITRATION,
+        }
+    ),
+}
+
+
+class DerivativeStatuses(enum.Enum):
+    """
+    Enum'ы статусов задания на производное изображение
+    """
+
+    PENDING = 'ожидает обработки'
+    RUNNING = 'обрабатывается'
+    DONE = 'готово'
+    FAILED = 'не удалось обработать'
+
+
+class JobStatuses(enum.Enum):
+    """
+    Enum'ы статусов фонового задания (выполненные задания удаляются)
+    """
+
+    PENDING = 'ожидает выполнения'
+    RUNNING = 'выполняется'
+    FAILED = 'не удалось выполнить'
+
+
 class UserRoles(enum.Enum):
     """
     Enum'ы всех ролей пользователя
@@ -270,6 +1129,38 @@ class User(SqlAlchemyModel):
         default=UserRoles.USER
     )
 
+    credentials_version = sqlalchemy.Column(
+        sqlalchemy.Integer(),
+        nullable=False,
+        default=0,
+        server_default='0',
+        name='credentialsVersion'
+    )
+
+    @classmethod
+    def email_filter(cls, email: str):
+        """
+        Условие поиска пользователя по почте без учета регистра (индекс ix_users_email_lower)
+        """
+
+        return sqlalchemy.func.lower(cls.email) == email.lower()
+
+    @classmethod
+    async def bump_credentials_version(cls, session: AsyncSession, user_id: int) -> int:
+        """
+        Увеличивает версию учетных данных пользователя и выводит новую версию
+        """
+
+        result = await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == user_id)
+            .values(credentials_version=cls.credentials_version + 1)
+            .returning(cls.credentials_version)
+        )
+
+        await session.commit()
+        return result.scalar_one()
+
 
 class Product(SqlAlchemyModel):
     """
@@ -286,8 +1177,8 @@ class Product(SqlAlchemyModel):
 
     seller = sqlalchemy.orm.relationship(
         'User',
-        lazy='immediate',
-        backref=sqlalchemy.orm.backref('products')
+        lazy='raise',
+        backref=sqlalchemy.orm.backref('products', lazy='raise')
     )
 
     title = sqlalchemy.Column(
@@ -319,6 +1210,314 @@ class Product(SqlAlchemyModel):
         name='quantityAvailable'
     )
 
+    # Версия и время изменения товара: увеличиваются любым UPDATE строки товара
+    # (onupdate), служат валидаторами ETag/Last-Modified ответов каталога
+    version = sqlalchemy.Column(
+        sqlalchemy.Integer(),
+        nullable=False,
+        default=1,
+        server_default='1',
+        # С именем таблицы: в ON CONFLICT DO UPDATE (upsert) просто version неоднозначна (строка таблицы или excluded)
+        onupdate=sqlalchemy.literal_column('products.version') + 1,
+        name='version'
+    )
+
+    # Время по часам БД в UTC (без часового пояса): одно и то же во всех процессах и при любом TimeZone сессии
+    date_updated = sqlalchemy.Column(
+        sqlalchemy.DateTime(),
+        nullable=False,
+        onupdate=sqlalchemy.literal_column("timezone('utc', now())"),
+        server_default=sqlalchemy.text("timezone('utc', now())"),
+        name='dateUpdated'
+    )
+
+    # Поисковый вектор заголовка (вес A) и описания (вес B). Вычисляется БД при каждой записи товара;
+    # отложен, чтобы не выбираться вместе с товаром.
+    search_vector = sqlalchemy.orm.deferred(sqlalchemy.Column(
+        postgresql.TSVECTOR(),
+        sqlalchemy.Computed(
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(description, '')), 'B')",
+            persisted=True
+        ),
+        name='searchVector'
+    ))
+
+    # Кол-во шардов остатка (ProductStockShard); 0 - остаток хранится в quantityAvailable
+    stock_shards = sqlalchemy.Column(
+        sqlalchemy.Integer(),
+        nullable=False,
+        default=0,
+        server_default='0',
+        name='stockShards'
+    )
+
+    @classmethod
+    async def search(
+            cls,
+            session: AsyncSession,
+            text: str,
+            limit: int,
+            after: list = None,
+            join: typing.Dict[str, typing.Sequence[str]] = None
+    ) -> typing.List[dict]:
+        """
+        Полнотекстовый поиск товаров (синтаксис websearch_to_tsquery: слова, "фраза", -исключение, or).
+        Товары выводятся строками fetch_rows по убыванию релевантности; ключ страницы - (rank, id).
+        Сначала по GIN-индексу выбираются только ID и ранги страницы, затем сами строки по ID.
+        """
+
+        query = sqlalchemy.func.websearch_to_tsquery(sqlalchemy.literal_column(f"'{SEARCH_CONFIG}'"), text)
+        rank = sqlalchemy.func.ts_rank_cd(cls.search_vector, query)
+
+        page = (
+            sqlalchemy.select(cls.id, rank.label('rank'))
+            .where(cls.search_vector.bool_op('@@')(query))
+            .order_by(rank.desc(), cls.id.desc())
+            .limit(limit)
+        )
+
+        if after:
+            page = page.where(sqlalchemy.tuple_(rank, cls.id) < sqlalchemy.tuple_(*after))
+
+        connection = await session.connection()
+        ranks = {row.id: row.rank for row in await connection.execute(page)}
+
+        if not ranks:
+            return []
+
+        rows = await cls.fetch_rows(session, cls.id.in_(list(ranks)), join=join)
+
+        for row in rows:
+            row['rank'] = ranks[row['id']]
+
+        return sorted(rows, key=lambda row: (row['rank'], row['id']), reverse=True)
+
+    @classmethod
+    async def reserve(cls, session: AsyncSession, product_id: int, quantity: int) -> bool:
+        """
+        Резервирует quantity единиц товара атомарным условным уменьшением остатка (остаток >= quantity)
+        без предварительного чтения. Товар без учета остатка (quantityAvailable IS NULL) резервируется всегда.
+        Транзакция не фиксируется: резерв фиксируется вместе с операцией, ради которой он сделан.
+        """
+
+        result = await session.execute(
+            sqlalchemy.update(cls)
+            .where(
+                cls.id == product_id,
+                cls.stock_shards == 0,
+                sqlalchemy.or_(cls.quantity_available.is_(None), cls.quantity_available >= quantity)
+            )
+            .values(quantity_available=cls.quantity_available - quantity)
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        )
+
+        if result.first() is not None:
+            return True
+
+        return await ProductStockShard.reserve(session, product_id, quantity)
+
+    @classmethod
+    async def release(cls, session: AsyncSession, product_id: int, quantity: int) -> None:
+        """
+        Возвращает в остаток quantity зарезервированных единиц товара. Транзакция не фиксируется.
+        """
+
+        result = await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == product_id, cls.stock_shards == 0)
+            .values(quantity_available=cls.quantity_available + quantity)
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        )
+
+        if result.first() is None:
+            await ProductStockShard.release(session, product_id, quantity)
+
+    @classmethod
+    async def shard_stock(cls, session: AsyncSession, product_id: int, shards: int) -> bool:
+        """
+        Делит остаток товара на shards строк ProductStockShard, чтобы одновременные покупки
+        "горячего" товара блокировали разные строки. quantityAvailable товара после этого
+        не меняется при резервировании; точный остаток - сумма шардов (см. unshard_stock).
+        """
+
+        result = await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == product_id, cls.stock_shards == 0, cls.quantity_available.is_not(None))
+            .values(stock_shards=shards)
+            .returning(cls.quantity_available)
+            .execution_options(synchronize_session=False)
+        )
+
+        quantity = result.scalar()
+        if quantity is None:
+            await session.rollback()
+            return False
+
+        await session.execute(sqlalchemy.insert(ProductStockShard), [
+            {
+                'product_id': product_id,
+                'shard': shard,
+                'quantity': quantity // shards + (1 if shard < quantity % shards else 0)
+            }
+            for shard in range(shards)
+        ])
+
+        await session.commit()
+        return True
+
+    @classmethod
+    async def unshard_stock(cls, session: AsyncSession, product_id: int) -> typing.Optional[int]:
+        """
+        Собирает остаток из шардов обратно в quantityAvailable товара и выводит его
+        """
+
+        result = await session.execute(
+            sqlalchemy.delete(ProductStockShard)
+            .where(ProductStockShard.product_id == product_id)
+            .returning(ProductStockShard.quantity)
+            .execution_options(synchronize_session=False)
+        )
+
+        quantities = result.scalars().all()
+        if not quantities:
+            await session.rollback()
+            return None
+
+        quantity = sum(quantities)
+
+        await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == product_id)
+            .values(quantity_available=quantity, stock_shards=0)
+            .execution_options(synchronize_session=False)
+        )
+
+        await session.commit()
+        return quantity
+
+
+class ProductStockShard(SqlAlchemyModel):
+    """
+    Часть остатка товара с разделенным остатком (Product.shard_stock)
+    """
+
+    __tablename__ = 'product_stock_shards'
+
+    product_id = sqlalchemy.Column(
+        sqlalchemy.ForeignKey('products.id', ondelete='CASCADE'),
+        nullable=False,
+        name='productId'
+    )
+
+    shard = sqlalchemy.Column(
+        sqlalchemy.Integer(),
+        nullable=False,
+        name='shard'
+    )
+
+    quantity = sqlalchemy.Column(
+        sqlalchemy.Integer(),
+        nullable=False,
+        name='quantity'
+    )
+
+    @classmethod
+    async def totals(cls, session: AsyncSession, product_ids: typing.Sequence[int]) -> typing.Dict[int, int]:
+        """
+        Остатки товаров с разделенным остатком одним запросом: ID товара -> сумма его шардов
+        """
+
+        if not product_ids:
+            return {}
+
+        result = await session.execute(
+            sqlalchemy.select(cls.product_id, sqlalchemy.func.sum(cls.quantity))
+            .where(cls.product_id.in_(list(product_ids)))
+            .group_by(cls.product_id)
+        )
+
+        return {product_id: int(quantity) for product_id, quantity in result.all()}
+
+    @classmethod
+    async def reserve(cls, session: AsyncSession, product_id: int, quantity: int) -> bool:
+        """
+        Уменьшает остаток случайного шарда товара, которого хватает на quantity и который
+        не заблокирован другой транзакцией (SKIP LOCKED). Если такого нет, резервирует
+        по нескольким шардам под блокировкой всех шардов товара.
+        """
+
+        shard_id = (
+            sqlalchemy.select(cls.id)
+            .where(cls.product_id == product_id, cls.quantity >= quantity)
+            .order_by(sqlalchemy.func.random())
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+
+        result = await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == shard_id, cls.quantity >= quantity)
+            .values(quantity=cls.quantity - quantity)
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        )
+
+        if result.first() is not None:
+            return True
+
+        return await cls.reserve_across_shards(session, product_id, quantity)
+
+    @classmethod
+    async def reserve_across_shards(cls, session: AsyncSession, product_id: int, quantity: int) -> bool:
+        result = await session.execute(
+            sqlalchemy.select(cls.id, cls.quantity)
+            .where(cls.product_id == product_id)
+            .order_by(cls.id)
+            .with_for_update()
+        )
+
+        shards = result.all()
+        if sum(shard_quantity for _, shard_quantity in shards) < quantity:
+            return False
+
+        taken = {}
+        for shard_id, shard_quantity in shards:
+            if quantity <= 0:
+                break
+
+            taken[shard_id] = min(shard_quantity, quantity)
+            quantity -= taken[shard_id]
+
+        await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id.in_(list(taken)))
+            .values(quantity=cls.quantity - sqlalchemy.case(taken, value=cls.id))
+            .execution_options(synchronize_session=False)
+        )
+
+        return True
+
+    @classmethod
+    async def release(cls, session: AsyncSession, product_id: int, quantity: int) -> None:
+        shard_id = (
+            sqlalchemy.select(cls.id)
+            .where(cls.product_id == product_id)
+            .order_by(sqlalchemy.func.random())
+            .limit(1)
+            .scalar_subquery()
+        )
+
+        await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == shard_id)
+            .values(quantity=cls.quantity + quantity)
+            .execution_options(synchronize_session=False)
+        )
+
 
 class Deal(SqlAlchemyModel):
     """
@@ -335,7 +1534,7 @@ class Deal(SqlAlchemyModel):
 
     seller = sqlalchemy.orm.relationship(
         'User',
-        lazy='immediate',
+        lazy='raise',
         foreign_keys=seller_id
     )
 
@@ -347,7 +1546,7 @@ class Deal(SqlAlchemyModel):
 
     consumer = sqlalchemy.orm.relationship(
         'User',
-        lazy='immediate',
+        lazy='raise',
         foreign_keys=consumer_id
     )
 
@@ -358,9 +1557,10 @@ class Deal(SqlAlchemyModel):
 
     product = sqlalchemy.orm.relationship(
         'Product',
-        lazy='immediate',
+        lazy='raise',
         backref=sqlalchemy.orm.backref(
-            'deals'
+            'deals',
+            lazy='raise'
         ),
         foreign_keys=product_id
     )
@@ -375,6 +1575,169 @@ class Deal(SqlAlchemyModel):
         default=DealStatuses.CREATED
     )
 
+    @property
+    def price(self) -> typing.Optional[int]:
+        """
+        Цена сделки: цена товара, умноженная на кол-во. Требует загруженного товара.
+        """
+
+        if self.product.price is None:
+            return None
+
+        return self.product.price * self.quantity
+
+    @classmethod
+    def participant_filter(cls, user_id: int):
+        """
+        Условие выборки сделок, в которых пользователь является продавцом или покупателем
+        """
+
+        return sqlalchemy.or_(cls.seller_id == user_id, cls.consumer_id == user_id)
+
+    @classmethod
+    def role_column(cls, role: DealRoles) -> sqlalchemy.Column:
+        return cls.seller_id if role == DealRoles.SELLER else cls.consumer_id
+
+    @classmethod
+    async def transition(
+            cls,
+            session: AsyncSession,
+            deal_id: int,
+            user_id: int,
+            transition: DealTransition,
+            load: typing.Dict[str, str] = None
+    ) -> typing.Optional[Record]:
+        """
+        Переводит сделку по переходу одним условным UPDATE ... RETURNING: строка меняется,
+        только если ее статус входит в transition.sources, а пользователь участвует в сделке
+        в разрешенной переходу роли. Иначе ничего не меняет и выводит None.
+        """
+
+        actor_conditions = [
+            (cls.role_column(role) == user_id, sqlalchemy.literal(target.name))
+            for role, target in transition.targets.items()
+        ]
+
+        statement = (
+            sqlalchemy.update(cls)
+            .where(
+                cls.id == deal_id,
+                cls.status.in_(transition.sources),
+                sqlalchemy.or_(*[condition for condition, _ in actor_conditions])
+            )
+            .values(status=sqlalchemy.cast(sqlalchemy.case(*actor_conditions), cls.status.type))
+            .execution_options(synchronize_session=False)
+        )
+
+        records = await cls.execute_returning(session, statement, load=load)
+
+        if records and transition.releases_stock:
+            await Product.release(session, records[0].product_id, records[0].quantity)
+
+        await session.commit()
+        return records[0] if records else None
+
+    @classmethod
+    async def open(
+            cls,
+            session: AsyncSession,
+            consumer_id: int,
+            product_id: int,
+            quantity: int,
+            load: typing.Dict[str, str] = None
+    ) -> typing.Optional[Record]:
+        """
+        Создает сделку, резервируя товар в той же транзакции. Продавец берется из товара в БД.
+        Выводит None, если товара нет или его остатка не хватает.
+        """
+
+        if not await Product.reserve(session, product_id, quantity):
+            await session.rollback()
+            return None
+
+        records = await cls.execute_returning(
+            session,
+            sqlalchemy.insert(cls).values(
+                seller_id=sqlalchemy.select(Product.seller_id).where(Product.id == product_id).scalar_subquery(),
+                consumer_id=consumer_id,
+                product_id=product_id,
+                quantity=quantity
+            ),
+            load=load
+        )
+
+        await session.commit()
+        return records[0]
+
+    @classmethod
+    async def fetch_user_deals(
+            cls,
+            session: AsyncSession,
+            user_id: int,
+            limit: int,
+            after: list = None,
+            role: DealRoles = None,
+            status: DealStatuses = None,
+            load: typing.Dict[str, str] = None
+    ) -> typing.Tuple[typing.List[typing.Self], typing.Optional[str], typing.Dict[str, int]]:
+        """
+        Выводит страницу сделок пользователя (новые первыми), курсор следующей страницы
+        и кол-во сделок пользователя по статусам (ключ - значение статуса, как в поле status сделок).
+        Кол-во по статусам считается подзапросом в том же SELECT, что и страница;
+        отдельный запрос нужен только если страница пуста.
+        """
+
+        if role == DealRoles.SELLER:
+            user_filter = cls.seller_id == user_id
+        elif role == DealRoles.CONSUMER:
+            user_filter = cls.consumer_id == user_id
+        else:
+            user_filter = cls.participant_filter(user_id)
+
+        # correlate(None): подзапросы считают по всей таблице сделок,
+        # а не по строке внешнего SELECT той же таблицы.
+        counts = (
+            sqlalchemy.select(cls.status, sqlalchemy.func.count().label('amount'))
+            .where(user_filter)
+            .group_by(cls.status)
+            .correlate(None)
+            .subquery()
+        )
+
+        status_counts = sqlalchemy.select(
+            sqlalchemy.type_coerce(
+                sqlalchemy.func.coalesce(
+                    sqlalchemy.func.json_object_agg(counts.c.status, counts.c.amount),
+                    sqlalchemy.literal_column("'{}'::json")
+                ),
+                sqlalchemy.JSON
+            )
+        ).correlate(None).scalar_subquery()
+
+        status_filter = [cls.status == status] if status else []
+        query = cls.select_query(
+            user_filter,
+            *status_filter,
+            limit=limit + 1,
+            after=after,
+            descending=True,
+            load=load
+        ).add_columns(status_counts.label('status_counts'))
+
+        result = (await session.execute(query)).fetchall()
+
+        memo = {}
+        if result:
+            counts_by_status = result[0][1]
+        else:
+            counts_by_status = (await session.execute(sqlalchemy.select(status_counts))).scalar_one()
+
+        # БД группирует по имени статуса, а в сделках статус выводится значением: ключи приводятся к значениям
+        counts_by_status = {DealStatuses[name].value: amount for name, amount in counts_by_status.items()}
+
+        deals, next_cursor = cls.paginate([row[0].to_record(memo) for row in result], limit)
+        return deals, next_cursor, counts_by_status
+
 
 class DealMessage(SqlAlchemyModel):
     """
@@ -391,9 +1754,10 @@ class DealMessage(SqlAlchemyModel):
 
     from_user = sqlalchemy.orm.relationship(
         'User',
-        lazy='immediate',
+        lazy='raise',
         backref=sqlalchemy.orm.backref(
-            'deal_messages'
+            'deal_messages',
+            lazy='raise'
         )
     )
 
@@ -413,7 +1777,7 @@ class DealMessage(SqlAlchemyModel):
 
     deal = sqlalchemy.orm.relationship(
         'Deal',
-        lazy='immediate'
+        lazy='raise'
     )
 
     attachments = sqlalchemy.Column(
@@ -425,4 +1789,451 @@ class DealMessage(SqlAlchemyModel):
     )
 
 
-SqlAlchemyModel.metadata.create_all(bind=engine)
+class Attachment(SqlAlchemyModel):
+    """
+    Загруженный файл. Содержимое хранится на диске под своим SHA-256 (storage.AttachmentStore),
+    поэтому одинаковые файлы хранятся один раз. Массивы attachments товаров и сообщений
+    ссылаются на файлы по url.
+    """
+
+    __tablename__ = 'attachments'
+
+    digest = sqlalchemy.Column(
+        sqlalchemy.VARCHAR(64),
+        nullable=False,
+        unique=True,
+        name='digest'
+    )
+
+    size = sqlalchemy.Column(
+        sqlalchemy.BigInteger(),
+        nullable=False,
+        name='size'
+    )
+
+    content_type = sqlalchemy.Column(
+        sqlalchemy.VARCHAR(255),
+        nullable=False,
+        name='contentType'
+    )
+
+    uploader_id = sqlalchemy.Column(
+        sqlalchemy.ForeignKey('users.id'),
+        nullable=False,
+        name='uploaderId'
+    )
+
+    date_created = sqlalchemy.Column(
+        sqlalchemy.DateTime(),
+        nullable=False,
+        default=datetime.now,
+        name='dateCreated'
+    )
+
+    @property
+    def url(self) -> str:
+        return f'/attachments/{self.digest}/'
+
+    @classmethod
+    async def register(
+            cls,
+            session: AsyncSession,
+            digest: str,
+            size: int,
+            content_type: str,
+            uploader_id: int
+    ) -> Record:
+        """
+        Записывает файл в БД; для уже загруженного содержимого выводит существующую запись
+        """
+
+        records = await cls.upsert(
+            session,
+            [{'digest': digest, 'size': size, 'content_type': content_type, 'uploader_id': uploader_id}],
+            conflict=('digest',),
+            update=('size',)
+        )
+
+        return records[0]
+
+
+class AttachmentDerivative(SqlAlchemyModel):
+    """
+    Производное изображение загруженного файла (миниатюра, облегченная версия для веба).
+    Строка одновременно задание фоновой обработки (images.ImagePipeline) и ее результат.
+    """
+
+    __tablename__ = 'attachment_derivatives'
+
+    source_digest = sqlalchemy.Column(
+        sqlalchemy.VARCHAR(64),
+        nullable=False,
+        name='sourceDigest'
+    )
+
+    variant = sqlalchemy.Column(
+        sqlalchemy.VARCHAR(32),
+        nullable=False,
+        name='variant'
+    )
+
+    status: sqlalchemy.orm.Mapped[DerivativeStatuses] = sqlalchemy.orm.mapped_column(
+        default=DerivativeStatuses.PENDING
+    )
+
+    attempts = sqlalchemy.Column(
+        sqlalchemy.Integer(),
+        nullable=False,
+        default=0,
+        name='attempts'
+    )
+
+    run_after = sqlalchemy.Column(
+        sqlalchemy.DateTime(),
+        nullable=False,
+        server_default=sqlalchemy.func.now(),
+        name='runAfter'
+    )
+
+    locked_until = sqlalchemy.Column(
+        sqlalchemy.DateTime(),
+        nullable=True,
+        name='lockedUntil'
+    )
+
+    last_error = sqlalchemy.Column(
+        sqlalchemy.Text(),
+        nullable=True,
+        name='lastError'
+    )
+
+    digest = sqlalchemy.Column(
+        sqlalchemy.VARCHAR(64),
+        nullable=True,
+        name='digest'
+    )
+
+    @property
+    def url(self) -> typing.Optional[str]:
+        return f'/attachments/{self.digest}/' if self.digest else None
+
+    @classmethod
+    async def enqueue(cls, session: AsyncSession, source_digest: str, variants: typing.Iterable[str]) -> None:
+        """
+        Ставит задания на производные изображения файла; уже поставленные не дублируются
+        """
+
+        await session.execute(
+            postgresql.insert(cls)
+            .values([{'source_digest': source_digest, 'variant': variant} for variant in variants])
+            .on_conflict_do_nothing(index_elements=[cls.source_digest, cls.variant])
+        )
+
+        await session.commit()
+
+    @classmethod
+    async def claim(cls, session: AsyncSession, limit: int, lease: float) -> typing.List[Record]:
+        """
+        Забирает до limit готовых к обработке заданий, не заблокированных другими процессами (SKIP LOCKED).
+        Задание, не завершенное за lease секунд (процесс упал), снова становится доступным.
+        """
+
+        now = sqlalchemy.func.now()
+
+        claimable = (
+            sqlalchemy.select(cls.id)
+            .where(sqlalchemy.or_(
+                sqlalchemy.and_(cls.status == DerivativeStatuses.PENDING, cls.run_after <= now),
+                sqlalchemy.and_(cls.status == DerivativeStatuses.RUNNING, cls.locked_until < now)
+            ))
+            .order_by(cls.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+
+        records = await cls.execute_returning(
+            session,
+            sqlalchemy.update(cls)
+            .where(cls.id.in_(claimable))
+            .values(
+                status=DerivativeStatuses.RUNNING,
+                attempts=cls.attempts + 1,
+                locked_until=now + timedelta(seconds=lease)
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+        await session.commit()
+        return records
+
+    @classmethod
+    async def complete(cls, session: AsyncSession, job_id: int, source_url: str, digest: str) -> typing.List[int]:
+        """
+        Отмечает задание выполненным и увеличивает версии товаров с исходным файлом,
+        чтобы их ETag сменились и клиенты получили ссылки на производные изображения.
+        Выводит ID этих товаров.
+        """
+
+        await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == job_id)
+            .values(status=DerivativeStatuses.DONE, digest=digest, locked_until=None, last_error=None)
+            .execution_options(synchronize_session=False)
+        )
+
+        result = await session.execute(
+            sqlalchemy.update(Product)
+            .where(Product.attachments.bool_op('@>')(sqlalchemy.literal([source_url], Product.attachments.type)))
+            .values(version=Product.version + 1)
+            .returning(Product.id)
+            .execution_options(synchronize_session=False)
+        )
+
+        product_ids = list(result.scalars())
+        await session.commit()
+        return product_ids
+
+    @classmethod
+    async def fail(cls, session: AsyncSession, job: Record, error: str, max_attempts: int, retry_delay: float) -> None:
+        """
+        Возвращает задание в очередь с задержкой, растущей с каждой попыткой,
+        или отмечает его неудачным после max_attempts попыток
+        """
+
+        if job.attempts >= max_attempts:
+            values = {'status': DerivativeStatuses.FAILED}
+        else:
+            values = {
+                'status': DerivativeStatuses.PENDING,
+                'run_after': sqlalchemy.func.now() + timedelta(seconds=retry_delay * 2 ** (job.attempts - 1)),
+            }
+
+        await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == job.id)
+            .values(locked_until=None, last_error=error, **values)
+            .execution_options(synchronize_session=False)
+        )
+
+        await session.commit()
+
+    @classmethod
+    async def release(cls, session: AsyncSession, job: Record, error: str, retry_delay: float) -> None:
+        """
+        Возвращает задание в очередь через retry_delay секунд, не засчитывая попытку:
+        обработка прервана не из-за самого изображения (упал процесс пула)
+        """
+
+        await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == job.id)
+            .values(
+                status=DerivativeStatuses.PENDING,
+                attempts=cls.attempts - 1,
+                run_after=sqlalchemy.func.now() + timedelta(seconds=retry_delay),
+                locked_until=None,
+                last_error=error
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+        await session.commit()
+
+    @classmethod
+    async def variant_urls(cls, session: AsyncSession, source_digests: typing.Iterable[str]) -> typing.Dict[str, typing.Dict[str, str]]:
+        """
+        Ссылки на готовые производные изображения: исходный digest -> {вариант: ссылка}
+        """
+
+        source_digests = list(set(source_digests))
+        if not source_digests:
+            return {}
+
+        rows = await cls.fetch_rows(
+            session,
+            cls.source_digest.in_(source_digests),
+            columns=['source_digest', 'variant', 'digest'],
+            status=DerivativeStatuses.DONE
+        )
+
+        variants = {}
+        for row in rows:
+            variants.setdefault(row['source_digest'], {})[row['variant']] = f'/attachments/{row["digest"]}/'
+
+        return variants
+
+
+class Job(SqlAlchemyModel):
+    """
+    Фоновое задание (jobs.JobWorker): имя обработчика и его аргументы
+    """
+
+    __tablename__ = 'jobs'
+
+    name = sqlalchemy.Column(
+        sqlalchemy.VARCHAR(64),
+        nullable=False,
+        name='name'
+    )
+
+    payload = sqlalchemy.Column(
+        sqlalchemy.JSON().with_variant(postgresql.JSONB(), 'postgresql'),
+        nullable=False,
+        name='payload'
+    )
+
+    status: sqlalchemy.orm.Mapped[JobStatuses] = sqlalchemy.orm.mapped_column(
+        default=JobStatuses.PENDING
+    )
+
+    attempts = sqlalchemy.Column(
+        sqlalchemy.Integer(),
+        nullable=False,
+        default=0,
+        name='attempts'
+    )
+
+    run_after = sqlalchemy.Column(
+        sqlalchemy.DateTime(),
+        nullable=False,
+        default=datetime.now,
+        name='runAfter'
+    )
+
+    locked_until = sqlalchemy.Column(
+        sqlalchemy.DateTime(),
+        nullable=True,
+        name='lockedUntil'
+    )
+
+    last_error = sqlalchemy.Column(
+        sqlalchemy.Text(),
+        nullable=True,
+        name='lastError'
+    )
+
+    date_created = sqlalchemy.Column(
+        sqlalchemy.DateTime(),
+        nullable=False,
+        default=datetime.now,
+        name='dateCreated'
+    )
+
+    @classmethod
+    async def enqueue(cls, session: AsyncSession, name: str, payloads: typing.Sequence[dict]) -> None:
+        """
+        Ставит задания обработчика name, по одному на каждый набор аргументов, одним INSERT
+        """
+
+        if not payloads:
+            return
+
+        now = datetime.now()
+
+        await session.execute(
+            sqlalchemy.insert(cls),
+            [{'name': name, 'payload': payload, 'run_after': now, 'date_created': now} for payload in payloads]
+        )
+
+        await session.commit()
+
+    @classmethod
+    async def claim(cls, session: AsyncSession, limit: int, lease: float) -> typing.List[Record]:
+        """
+        Забирает до limit готовых заданий, не заблокированных другими процессами (SKIP LOCKED).
+        Задание, не завершенное за lease секунд (процесс упал), снова становится доступным.
+        """
+
+        now = datetime.now()
+
+        claimable = (
+            sqlalchemy.select(cls.id)
+            .where(sqlalchemy.or_(
+                sqlalchemy.and_(cls.status == JobStatuses.PENDING, cls.run_after <= now),
+                sqlalchemy.and_(cls.status == JobStatuses.RUNNING, cls.locked_until < now)
+            ))
+            .order_by(cls.run_after, cls.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+
+        records = await cls.execute_returning(
+            session,
+            sqlalchemy.update(cls)
+            .where(cls.id.in_(claimable))
+            .values(
+                status=JobStatuses.RUNNING,
+                attempts=cls.attempts + 1,
+                locked_until=now + timedelta(seconds=lease)
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+        await session.commit()
+        return records
+
+    @classmethod
+    async def complete(cls, session: AsyncSession, job_ids: typing.Sequence[int]) -> None:
+        """
+        Удаляет выполненные задания одним DELETE
+        """
+
+        await session.execute(
+            sqlalchemy.delete(cls)
+            .where(cls.id.in_(job_ids))
+            .execution_options(synchronize_session=False)
+        )
+
+        await session.commit()
+
+    @classmethod
+    async def fail(cls, session: AsyncSession, job: Record, error: str, max_attempts: int, retry_delay: float) -> None:
+        """
+        Возвращает задание в очередь с задержкой, растущей с каждой попыткой,
+        или отмечает его неудачным после max_attempts попыток
+        """
+
+        if job.attempts >= max_attempts:
+            values = {'status': JobStatuses.FAILED}
+        else:
+            values = {
+                'status': JobStatuses.PENDING,
+                'run_after': datetime.now() + timedelta(seconds=retry_delay * 2 ** (job.attempts - 1)),
+            }
+
+        await session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id == job.id)
+            .values(locked_until=None, last_error=error, **values)
+            .execution_options(synchronize_session=False)
+        )
+
+        await session.commit()
+
+
+# Индексы создаются миграцией 0002_hot_path_indexes, здесь они описаны,
+# чтобы метаданные моделей совпадали со схемой БД.
+sqlalchemy.Index('ix_users_email_lower', sqlalchemy.func.lower(User.email), unique=True)
+sqlalchemy.Index('ix_deals_seller_status', Deal.seller_id, Deal.status)
+sqlalchemy.Index('ix_deals_consumer_status', Deal.consumer_id, Deal.status)
+sqlalchemy.Index('ix_products_seller', Product.seller_id)
+sqlalchemy.Index('ix_deal_messages_deal', DealMessage.deal_id, DealMessage.id)
+
+# Создается миграцией 0004_inventory_reservation
+sqlalchemy.Index('ix_product_stock_shards_product', ProductStockShard.product_id, ProductStockShard.shard, unique=True)
+
+# Создается миграцией 0006_product_search
+sqlalchemy.Index('ix_products_search', Product.search_vector, postgresql_using='gin')
+
+# Создаются миграцией 0008_image_derivatives
+sqlalchemy.Index(
+    'ix_attachment_derivatives_source',
+    AttachmentDerivative.source_digest,
+    AttachmentDerivative.variant,
+    unique=True
+)
+sqlalchemy.Index('ix_attachment_derivatives_queue', AttachmentDerivative.status, AttachmentDerivative.run_after)
+sqlalchemy.Index('ix_products_attachments', Product.attachments, postgresql_using='gin')
+
+# Создается миграцией 0009_jobs
+sqlalchemy.Index('ix_jobs_queue', Job.status, Job.run_after)
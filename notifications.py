@@ -0,0 +1,96 @@
+import asyncio
+import smtplib
+import logging
+from urllib.parse import urlencode
+from email.message import EmailMessage
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import sqlalchemy
+import settings
+import auth
+import jobs
+
+logger = logging.getLogger(__name__)
+
+# План загрузки сделки для уведомлений: участники и товар одним запросом
+DEAL_NOTIFICATION_LOAD_PLAN = {
+    'seller': 'joined',
+    'consumer': 'joined',
+    'product': 'joined',
+}
+
+
+def deliver_email(message: EmailMessage) -> None:
+    with smtplib.SMTP(settings.SMTP_HOST, settings.SMTP_PORT, timeout=settings.JOB_LEASE) as smtp:
+        smtp.starttls()
+
+        if settings.SMTP_USER:
+            smtp.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
+
+        smtp.send_message(message)
+
+
+async def send_email(to: str, subject: str, text: str) -> None:
+    """
+    Отправляет письмо через SMTP_HOST в потоке, не занимая цикл событий.
+    Без SMTP_HOST (разработка) письмо только пишется в лог.
+    """
+
+    if not settings.SMTP_HOST:
+        logger.info('Письмо для %s: %s\n%s', to, subject, text)
+        return
+
+    message = EmailMessage()
+    message['From'] = settings.SMTP_FROM
+    message['To'] = to
+    message['Subject'] = subject
+    message.set_content(text)
+
+    await asyncio.to_thread(deliver_email, message)
+
+
+@jobs.handler('send_verification_email')
+async def send_verification_email(session: AsyncSession, user_id: int):
+    """
+    Письмо со ссылкой подтверждения почты пользователя
+    """
+
+    user = await sqlalchemy.User.fetch_one(session, id=user_id)
+
+    if user is None or user.email_verified:
+        return
+
+    token = auth.create_email_verification_token(user.id, user.email)
+    link = f'{settings.PUBLIC_URL}/users/email/verify/?{urlencode({"token": token})}'
+
+    await send_email(
+        user.email,
+        'Подтверждение почты',
+        f'Здравствуйте, {user.first_name}!\n\n'
+        f'Чтобы подтвердить почту, перейдите по ссылке:\n{link}\n\n'
+        f'Ссылка действует {settings.EMAIL_VERIFICATION_EXPIRE_HOURS} ч.'
+    )
+
+
+@jobs.handler('notify_deal_status')
+async def notify_deal_status(session: AsyncSession, deal_id: int, status: str, actor_id: int):
+    """
+    Письмо участникам сделки, кроме сменившего статус, о новом статусе сделки
+    """
+
+    deal = await sqlalchemy.Deal.fetch_one(session, id=deal_id, load=DEAL_NOTIFICATION_LOAD_PLAN)
+
+    if deal is None:
+        return
+
+    status = sqlalchemy.DealStatuses[status]
+
+    for user in (deal.seller, deal.consumer):
+        if user.id == actor_id:
+            continue
+
+        await send_email(
+            user.email,
+            f'Сделка #{deal.id}: {status.value}',
+            f'Здравствуйте, {user.first_name}!\n\n'
+            f'Статус сделки #{deal.id} по товару "{deal.product.title}": {status.value}.'
+        )
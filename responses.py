@@ -0,0 +1,213 @@
+import time
+import typing
+import hashlib
+import collections
+import orjson
+import pydantic
+import settings
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request
+from fastapi.responses import Response
+
+
+class FastJSONResponse(Response):
+    """
+    JSON-ответ без jsonable_encoder: модели Pydantic сериализуются своим
+    сериализатором (model_dump_json), остальное - через orjson.
+
+    Чтобы FastAPI не прогонял результат через jsonable_encoder,
+    обработчик должен вернуть сам объект ответа.
+    """
+
+    media_type = 'application/json'
+
+    def render(self, content: typing.Any) -> bytes:
+        if isinstance(content, pydantic.BaseModel):
+            return content.__pydantic_serializer__.to_json(content, by_alias=True)
+
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+class CachedResponse(typing.NamedTuple):
+    """
+    Готовое тело ответа с валидаторами для условных запросов
+    """
+
+    body: bytes
+    etag: str
+    last_modified: typing.Optional[datetime]
+    expires: float
+    tags: frozenset
+
+
+class ResponseCache:
+    """
+    Ограниченный LRU-кэш тел ответов процесса: ключ запроса -> CachedResponse.
+    Запись удаляется по истечении ttl секунд (это ограничивает устаревание из-за записей
+    в других процессах) или при инвалидации любой из ее меток записями в этом процессе.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: collections.OrderedDict[str, CachedResponse] = collections.OrderedDict()
+        self.tag_keys: dict[typing.Hashable, set[str]] = collections.defaultdict(set)
+
+    def get(self, key: str) -> typing.Optional[CachedResponse]:
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        if entry.expires <= time.monotonic():
+            self.discard(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(
+            self,
+            key: str,
+            body: bytes,
+            etag: str = None,
+            last_modified: datetime = None,
+            tags: typing.Iterable[typing.Hashable] = ()
+    ) -> CachedResponse:
+        entry = CachedResponse(
+            body=body,
+            etag=etag or make_etag(body),
+            last_modified=last_modified,
+            expires=time.monotonic() + self.ttl,
+            tags=frozenset(tags)
+        )
+
+        if self.max_size <= 0:
+            return entry
+
+        self.discard(key)
+        self.entries[key] = entry
+
+        for tag in entry.tags:
+            self.tag_keys[tag].add(key)
+
+        while len(self.entries) > self.max_size:
+            self.discard(next(iter(self.entries)))
+
+        return entry
+
+    def discard(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        for tag in entry.tags:
+            tag_keys = self.tag_keys.get(tag)
+            if tag_keys is None:
+                continue
+
+            tag_keys.discard(key)
+            if not tag_keys:
+                del self.tag_keys[tag]
+
+    def invalidate(self, *tags: typing.Hashable) -> None:
+        for tag in tags:
+            for key in list(self.tag_keys.get(tag, ())):
+                self.discard(key)
+
+
+def make_etag(body: bytes) -> str:
+    """
+    Сильный ETag по содержимому тела ответа
+    """
+
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def as_utc(value: datetime) -> datetime:
+    # Даты в БД хранятся без часового пояса, в UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+
+    return value.astimezone(timezone.utc)
+
+
+def http_date(value: datetime) -> str:
+    return format_datetime(as_utc(value), usegmt=True)
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime = None) -> bool:
+    """
+    Проверяет If-None-Match (а без него - If-Modified-Since) запроса по валидаторам ответа
+    """
+
+    if_none_match = request.headers.get('if-none-match')
+
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+
+        candidates = [candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')]
+        return etag in candidates
+
+    if_modified_since = request.headers.get('if-modified-since')
+
+    if if_modified_since is None or last_modified is None:
+        return False
+
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+    if since.tzinfo is None:
+        return False
+
+    return as_utc(last_modified).replace(microsecond=0) <= since
+
+
+def cache_headers(etag: str, last_modified: datetime = None, max_age: int = None) -> dict:
+    max_age = settings.HTTP_CACHE_MAX_AGE if max_age is None else max_age
+
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={max_age}',
+    }
+
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    return headers
+
+
+def not_modified_response(etag: str, last_modified: datetime = None) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag, last_modified))
+
+
+def conditional_response(request: Request, entry: CachedResponse) -> Response:
+    """
+    Ответ 304 без тела, если у клиента актуальная версия, иначе готовое тело из кэша
+    """
+
+    if is_not_modified(request, entry.etag, entry.last_modified):
+        return not_modified_response(entry.etag, entry.last_modified)
+
+    return Response(
+        content=entry.body,
+        media_type=FastJSONResponse.media_type,
+        headers=cache_headers(entry.etag, entry.last_modified)
+    )
+
+
+# Тела ответов каталога товаров. Метки: ID товара и PRODUCT_LIST_TAG для страниц списка.
+PRODUCT_LIST_TAG = 'products'
+product_responses = ResponseCache(settings.RESPONSE_CACHE_SIZE, settings.RESPONSE_CACHE_TTL)
+
+
+def invalidate_product(product_id: int) -> None:
+    """
+    Удаляет из кэша ответы, которые могли измениться после записи товара
+    """
+
+    product_responses.invalidate(PRODUCT_LIST_TAG, product_id)
@@ -0,0 +1,143 @@
+import fastapi
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from models import sqlalchemy, pydantic
+from dependencies import SessionType
+from auth import UserType
+from responses import FastJSONResponse, is_not_modified
+import settings
+import storage
+import images
+
+router = fastapi.APIRouter(
+    prefix='/attachments',
+    tags=['Файлы']
+)
+
+ATTACHMENT_NOT_FOUND = fastapi.HTTPException(
+    status_code=404,
+    detail='Файл не найден!'
+)
+
+ATTACHMENT_TOO_LARGE = fastapi.HTTPException(
+    status_code=413,
+    detail=f'Размер файла превышает {settings.ATTACHMENT_MAX_SIZE} байт.'
+)
+
+EMPTY_ATTACHMENT = fastapi.HTTPException(
+    status_code=400,
+    detail='Файл пуст.'
+)
+
+# Содержимое по ссылке никогда не меняется: ссылка - хэш содержимого
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+@router.post('/', name='Загрузка файла')
+async def upload_attachment_endpoint(request: fastapi.Request, session: SessionType, user: UserType):
+    """
+    Загружает файл, переданный телом запроса как есть (не multipart); тип содержимого берется из Content-Type.
+    Тело пишется на диск по мере получения. Выводит ссылку на файл для массивов attachments.
+    Для изображений ставятся задания на производные изображения.
+    """
+
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > settings.ATTACHMENT_MAX_SIZE:
+        raise ATTACHMENT_TOO_LARGE
+
+    if content_length == '0':
+        raise EMPTY_ATTACHMENT
+
+    try:
+        blob = await storage.attachment_store.save(request.stream(), settings.ATTACHMENT_MAX_SIZE)
+    except storage.AttachmentTooLarge:
+        raise ATTACHMENT_TOO_LARGE
+    except storage.EmptyAttachment:
+        raise EMPTY_ATTACHMENT
+
+    attachment = await sqlalchemy.Attachment.register(
+        session,
+        digest=blob.digest,
+        size=blob.size,
+        content_type=storage.normalize_content_type(request.headers.get('content-type')),
+        uploader_id=user.id
+    )
+
+    # Миниатюры и версии для веба строятся в фоне (images.ImagePipeline)
+    if attachment.content_type in storage.INLINE_CONTENT_TYPES:
+        await sqlalchemy.AttachmentDerivative.enqueue(session, blob.digest, images.IMAGE_VARIANTS)
+
+    return FastJSONResponse(pydantic.AttachmentModel.model_validate(attachment), status_code=201)
+
+
+@router.get('/{digest}/', name='Скачивание файла')
+async def download_attachment_endpoint(request: fastapi.Request, session: SessionType, digest: str):
+    """
+    Отдает файл целиком или диапазон байт (Range, If-Range). Ответ с ETag кэшируется без срока.
+    Показываются в браузере только изображения из INLINE_CONTENT_TYPES, остальное отдается на скачивание.
+    """
+
+    if not storage.DIGEST_PATTERN.match(digest):
+        raise ATTACHMENT_NOT_FOUND
+
+    rows = await sqlalchemy.Attachment.fetch_rows(
+        session,
+        columns=['digest', 'size', 'content_type'],
+        limit=1,
+        digest=digest
+    )
+
+    # Запрос к БД закончен: соединение не должно удерживаться на время отдачи файла
+    await session.close()
+
+    if not rows:
+        raise ATTACHMENT_NOT_FOUND
+
+    attachment = rows[0]
+    etag = f'"{digest}"'
+    size = attachment['size']
+
+    headers = {
+        'ETag': etag,
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+        # Браузер не угадывает тип по содержимому, а документ файла не может выполнять код
+        'X-Content-Type-Options': 'nosniff',
+        'Content-Security-Policy': "default-src 'none'; sandbox",
+    }
+
+    if attachment['content_type'] not in storage.INLINE_CONTENT_TYPES:
+        headers['Content-Disposition'] = f'attachment; filename="{digest}"'
+
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = storage.parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+
+    if byte_range is None:
+        # FileResponse отдает файл через http.response.pathsend, если сервер это поддерживает
+        return FileResponse(
+            storage.attachment_store.path(digest),
+            media_type=attachment['content_type'],
+            headers=headers
+        )
+
+    start, end = byte_range
+
+    return StreamingResponse(
+        storage.attachment_store.read(digest, start, end),
+        status_code=206,
+        media_type=attachment['content_type'],
+        headers={
+            **headers,
+            'Content-Range': f'bytes {start}-{end}/{size}',
+            'Content-Length': str(end - start + 1),
+        }
+    )
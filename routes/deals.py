@@ -2,7 +2,11 @@
 
 import fastapi
 from models import sqlalchemy, pydantic
+from dependencies import SessionType, PaginationType
 from auth import UserType
+from responses import FastJSONResponse, invalidate_product
+import events
+import jobs
 
 router = fastapi.APIRouter(
     prefix='/deals',
@@ -49,12 +53,55 @@ PRODUCT_IS_NOT_SUPPLIED = fastapi.HTTPException(
     detail='Товар еще не был отправлен покупателю.'
 )
 
+PRODUCT_OUT_OF_STOCK = fastapi.HTTPException(
+    status_code=409,
+    detail='Товар не найден, или его недостаточно для сделки.'
+)
+
+DEAL_STATUS_CHANGED = fastapi.HTTPException(
+    status_code=409,
+    detail='Статус сделки изменился, повторите запрос.'
+)
+
 BLOCKED_DEAL_STATUSES = [
     sqlalchemy.DealStatuses.ARBITRATION,
     sqlalchemy.DealStatuses.CANCELED_BY_CONSUMER,
     sqlalchemy.DealStatuses.CANCELED_BY_SELLER
 ]
 
+# Причины отказа в переходе сделки по ее текущему статусу
+TRANSITION_STATUS_EXCEPTIONS = {
+    'pay': {
+        sqlalchemy.DealStatuses.PAID: DEAL_IS_ALREADY_PAID,
+        sqlalchemy.DealStatuses.PRODUCT_SUPPLIED: DEAL_IS_ALREADY_PAID,
+    },
+    'cancel': {
+        sqlalchemy.DealStatuses.PAID: DEAL_IS_ALREADY_PAID,
+        sqlalchemy.DealStatuses.PRODUCT_SUPPLIED: DEAL_IS_ALREADY_PAID,
+    },
+    'supply': {
+        sqlalchemy.DealStatuses.CREATED: DEAL_IS_NOT_PAID,
+        sqlalchemy.DealStatuses.PRODUCT_SUPPLIED: PRODUCT_ALREADY_SUPPLIED,
+    },
+    'submit': {
+        sqlalchemy.DealStatuses.CREATED: PRODUCT_IS_NOT_SUPPLIED,
+        sqlalchemy.DealStatuses.PAID: PRODUCT_IS_NOT_SUPPLIED,
+    },
+    'arbitration': {
+        sqlalchemy.DealStatuses.CREATED: PRODUCT_IS_NOT_SUPPLIED,
+        sqlalchemy.DealStatuses.PAID: PRODUCT_IS_NOT_SUPPLIED,
+    },
+}
+
+# План загрузки связей сделки для ответов по модели DealModel:
+# все связи many-to-one, поэтому вся сделка собирается одним запросом с JOIN.
+DEAL_LOAD_PLAN = {
+    'seller': 'joined',
+    'consumer': 'joined',
+    'product': 'joined',
+    'product.seller': 'joined',
+}
+
 
 def user_in_deal(user: pydantic.UserModel, deal: pydantic.DealModel):
     user_id = user.id
@@ -65,184 +112,131 @@ def user_in_deal(user: pydantic.UserModel, deal: pydantic.DealModel):
     return True
 
 
-def user_is_seller(user: pydantic.UserModel, deal: pydantic.DealModel):
-    return user.id == deal.seller.id
-
-
-def user_is_consumer(user: pydantic.UserModel, deal: pydantic.DealModel):
-    return user.id == deal.consumer.id
-
-
 @router.get('/create/', name='Создание сделки')
-async def create_deal_endpoint(user: UserType, deal: pydantic.DealCreateModel):
-    seller = deal.product.seller
-    consumer = user
-    quantity = deal.quantity
-    product = deal.product
-
-    deal = sqlalchemy.Deal.create(
-        seller_id=seller.id,
-        consumer_id=consumer.id,
-        product_id=product.id,
-        quantity=quantity,
+async def create_deal_endpoint(session: SessionType, user: UserType, deal: pydantic.DealCreateModel):
+    deal = await sqlalchemy.Deal.open(
+        session,
+        consumer_id=user.id,
+        product_id=deal.product.id,
+        quantity=deal.quantity,
+        load=DEAL_LOAD_PLAN
     )
 
-    return pydantic.DealModel.model_validate(deal)
-
-
-@router.get('/{deal_id}/', name='Просмотр данных сделки')
-async def get_deal_info_endpoint(user: UserType, deal_id: int):
-    deal = sqlalchemy.Deal.fetch_one(id=deal_id)
-
-    if not deal:
-        raise DEAL_NOT_FOUND_EXCEPTION
-
-    deal = pydantic.DealModel.model_validate(deal)
-
-    if not user_in_deal(user, deal):
-        raise DEAL_NOT_FOUND_EXCEPTION
-
-    elif user.role not in [sqlalchemy.UserRoles.ADMIN, sqlalchemy.UserRoles.MODERATOR]:
-        raise DEAL_NOT_FOUND_EXCEPTION
-
-    return pydantic.DealModel.model_validate(deal)
-
-
-@router.post('/{deal_id}/pay-for-product/', name='Перевод сделки в статус "Оплачен"')
-async def pay_for_product_endpoint(user: UserType, deal_id: int):
-    deal = sqlalchemy.Deal.fetch_one(id=deal_id)
-
     if not deal:
-        raise DEAL_NOT_FOUND_EXCEPTION
+        raise PRODUCT_OUT_OF_STOCK
 
-    deal = pydantic.DealModel.model_validate(deal)
+    invalidate_product(deal.product_id)
+    await events.publish_deal(deal)
+    await jobs.enqueue(session, 'notify_deal_status', deal_id=deal.id, status=deal.status.name, actor_id=user.id)
 
-    if not user_in_deal(user, deal):
-        raise DEAL_NOT_FOUND_EXCEPTION
+    return FastJSONResponse(pydantic.DealModel.model_validate(deal))
 
-    elif not user_is_consumer(user, deal):
-        raise NOT_A_CONSUMER_EXCEPTION
 
-    elif deal.status in BLOCKED_DEAL_STATUSES:
-        raise DEAL_IS_PAUSED
+@router.get('/events/', name='Поток событий сделок авторизованного пользователя')
+async def deal_events_endpoint(user: UserType):
+    """
+    Server-Sent Events: новые сделки пользователя и смены их статусов в формате DealEventModel
+    (событие deal). Заменяет периодический опрос сделок.
+    """
 
-    elif deal.status in [
-        sqlalchemy.DealStatuses.PRODUCT_SUPPLIED,
-        sqlalchemy.DealStatuses.PAID
-    ]:
-        raise DEAL_IS_ALREADY_PAID
+    return fastapi.responses.StreamingResponse(
+        events.stream_events(user.id),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        }
+    )
 
-    deal = sqlalchemy.Deal.update(deal.id, status=sqlalchemy.DealStatuses.PAID)
-    return pydantic.DealModel.model_validate(deal)
 
+async def transition_rejection(session: SessionType, user: UserType, deal_id: int, name: str) -> fastapi.HTTPException:
+    """
+    Причина отказа в переходе сделки. Вычисляется только после того, как условный UPDATE не изменил ни одной строки.
+    """
 
-@router.post('/{deal_id}/cancel/', name='Отмена сделки')
-async def cancel_deal_endpoint(user: UserType, deal_id: int):
-    deal = sqlalchemy.Deal.fetch_one(id=deal_id)
+    deal = await sqlalchemy.Deal.fetch_one(session, id=deal_id)
 
     if not deal:
-        raise DEAL_NOT_FOUND_EXCEPTION
+        return DEAL_NOT_FOUND_EXCEPTION
 
-    deal = pydantic.DealModel.model_validate(deal)
-
-    if not user_in_deal(user, deal):
-        raise DEAL_NOT_FOUND_EXCEPTION
+    user_roles = set()
 
-    elif deal.status in BLOCKED_DEAL_STATUSES:
-        raise DEAL_IS_PAUSED
+    if deal.seller_id == user.id:
+        user_roles.add(sqlalchemy.DealRoles.SELLER)
 
-    elif deal.status in [
-        sqlalchemy.DealStatuses.PRODUCT_SUPPLIED,
-        sqlalchemy.DealStatuses.PAID
-    ]:
-        raise DEAL_IS_ALREADY_PAID
+    if deal.consumer_id == user.id:
+        user_roles.add(sqlalchemy.DealRoles.CONSUMER)
 
-    if user_is_consumer(user, deal):
-        deal = sqlalchemy.Deal.update(deal.id, status=sqlalchemy.DealStatuses.CANCELED_BY_CONSUMER)
+    if not user_roles:
+        return DEAL_NOT_FOUND_EXCEPTION
 
-    elif user_is_seller(user, deal):
-        deal = sqlalchemy.Deal.update(deal.id, status=sqlalchemy.DealStatuses.CANCELED_BY_SELLER)
+    allowed_roles = sqlalchemy.DEAL_TRANSITIONS[name].targets
 
-    return pydantic.DealModel.model_validate(deal)
+    if not user_roles.intersection(allowed_roles):
+        return NOT_A_SELLER_EXCEPTION if sqlalchemy.DealRoles.SELLER in allowed_roles else NOT_A_CONSUMER_EXCEPTION
 
+    if deal.status in BLOCKED_DEAL_STATUSES or deal.status == sqlalchemy.DealStatuses.CLOSED_SUCCESSFULLY:
+        return DEAL_IS_PAUSED
 
-@router.post('/{deal_id}/supply-product/', name='Отправка товара сделки покупателю')
-async def attach_product_to_deal_endpoint(user: UserType, deal_id: int):
-    deal = sqlalchemy.Deal.fetch_one(id=deal_id)
-
-    if not deal:
-        raise DEAL_NOT_FOUND_EXCEPTION
-
-    deal = pydantic.DealModel.model_validate(deal)
-
-    if not user_in_deal(user, deal):
-        raise DEAL_NOT_FOUND_EXCEPTION
+    # Статус мог смениться между UPDATE и этой выборкой
+    return TRANSITION_STATUS_EXCEPTIONS[name].get(deal.status, DEAL_STATUS_CHANGED)
 
-    elif not user_is_seller(user, deal):
-        raise NOT_A_SELLER_EXCEPTION
 
-    elif deal.status in BLOCKED_DEAL_STATUSES:
-        raise DEAL_IS_PAUSED
+async def transition_deal(session: SessionType, user: UserType, deal_id: int, name: str) -> FastJSONResponse:
+    transition = sqlalchemy.DEAL_TRANSITIONS[name]
 
-    elif deal.status == sqlalchemy.DealStatuses.PRODUCT_SUPPLIED:
-        raise PRODUCT_ALREADY_SUPPLIED
-
-    elif not deal.status == sqlalchemy.DealStatuses.PAID:
-        raise DEAL_IS_NOT_PAID
-
-    deal = sqlalchemy.Deal.update(deal.id, status=sqlalchemy.DealStatuses.PRODUCT_SUPPLIED)
-    return pydantic.DealModel.model_validate(deal)
-
-
-@router.post('/{deal_id}/submit/', name='Подтверждение окончания сделки')
-async def submit_deal_endpoint(user: UserType, deal_id: int):
-    deal = sqlalchemy.Deal.fetch_one(id=deal_id)
+    deal = await sqlalchemy.Deal.transition(
+        session,
+        deal_id,
+        user.id,
+        transition,
+        load=DEAL_LOAD_PLAN
+    )
 
     if not deal:
-        raise DEAL_NOT_FOUND_EXCEPTION
+        raise await transition_rejection(session, user, deal_id, name)
 
-    deal = pydantic.DealModel.model_validate(deal)
+    if transition.releases_stock:
+        invalidate_product(deal.product_id)
 
-    if not user_in_deal(user, deal):
-        raise DEAL_NOT_FOUND_EXCEPTION
+    await events.publish_deal(deal)
+    await jobs.enqueue(session, 'notify_deal_status', deal_id=deal.id, status=deal.status.name, actor_id=user.id)
 
-    elif not user_is_consumer(user, deal):
-        raise NOT_A_CONSUMER_EXCEPTION
+    return FastJSONResponse(pydantic.DealModel.model_validate(deal))
 
-    elif deal.status in BLOCKED_DEAL_STATUSES:
-        raise DEAL_IS_PAUSED
 
-    elif not deal.status == sqlalchemy.DealStatuses.PRODUCT_SUPPLIED:
-        raise PRODUCT_IS_NOT_SUPPLIED
-
-    deal = sqlalchemy.Deal.update(deal.id, status=sqlalchemy.DealStatuses.CLOSED_SUCCESSFULLY)
-    return pydantic.DealModel.model_validate(deal)
+@router.post('/{deal_id}/pay-for-product/', name='Перевод сделки в статус "Оплачен"')
+async def pay_for_product_endpoint(session: SessionType, user: UserType, deal_id: int):
+    return await transition_deal(session, user, deal_id, 'pay')
 
 
-@router.post('/{deal_id}/arbitration/', name='Перевод сделки в статус арбитража')
-async def set_deal_to_arbitration_endpoint(user: UserType, deal_id: int):
-    deal = sqlalchemy.Deal.fetch_one(id=deal_id)
+@router.post('/{deal_id}/cancel/', name='Отмена сделки')
+async def cancel_deal_endpoint(session: SessionType, user: UserType, deal_id: int):
+    return await transition_deal(session, user, deal_id, 'cancel')
 
-    if not deal:
-        raise DEAL_NOT_FOUND_EXCEPTION
 
-    deal = pydantic.DealModel.model_validate(deal)
+@router.post('/{deal_id}/supply-product/', name='Отправка товара сделки покупателю')
+async def attach_product_to_deal_endpoint(session: SessionType, user: UserType, deal_id: int):
+    return await transition_deal(session, user, deal_id, 'supply')
 
-    if not user_in_deal(user, deal):
-        raise DEAL_NOT_FOUND_EXCEPTION
 
-    elif deal.status in BLOCKED_DEAL_STATUSES:
-        raise DEAL_IS_PAUSED
+@router.post('/{deal_id}/submit/', name='Подтверждение окончания сделки')
+async def submit_deal_endpoint(session: SessionType, user: UserType, deal_id: int):
+    return await transition_deal(session, user, deal_id, 'submit')
 
-    elif not deal.status == sqlalchemy.DealStatuses.PRODUCT_SUPPLIED:
-        raise PRODUCT_IS_NOT_SUPPLIED
 
-    deal = sqlalchemy.Deal.update(deal.id, status=sqlalchemy.DealStatuses.CLOSED_SUCCESSFULLY)
-    return pydantic.DealModel.model_validate(deal)
+@router.post('/{deal_id}/arbitration/', name='Перевод сделки в статус арбитража')
+async def set_deal_to_arbitration_endpoint(session: SessionType, user: UserType, deal_id: int):
+    return await transition_deal(session, user, deal_id, 'arbitration')
 
 
 @router.get('/sells/', name='Просмотр продаж авторизованного пользователя')
-async def get_list_of_deals(user: UserType, status: sqlalchemy.DealStatuses = None):
+async def get_list_of_sells(
+        session: SessionType,
+        user: UserType,
+        pagination: PaginationType,
+        status: sqlalchemy.DealStatuses = None
+):
     kwargs = {
         'seller_id': user.id
     }
@@ -250,12 +244,24 @@ async def get_list_of_deals(user: UserType, status: sqlalchemy.DealStatuses = No
     if status:
         kwargs['status'] = status
 
-    deals = sqlalchemy.Deal.fetch_all(**kwargs)
-    return pydantic.DealListModel.model_validate(deals)
+    deals, next_cursor = await sqlalchemy.Deal.fetch_page(
+        session,
+        limit=pagination.limit,
+        after=pagination.after,
+        load=DEAL_LOAD_PLAN,
+        **kwargs
+    )
+
+    return FastJSONResponse(pydantic.DealPageModel(items=deals, next_cursor=next_cursor))
 
 
 @router.get('/purchases/', name='Просмотр покупок авторизованного пользователя')
-async def get_list_of_purchases(user: UserType, status: sqlalchemy.DealStatuses = None):
+async def get_list_of_purchases(
+        session: SessionType,
+        user: UserType,
+        pagination: PaginationType,
+        status: sqlalchemy.DealStatuses = None
+):
     kwargs = {
         'consumer_id': user.id
     }
@@ -263,22 +269,58 @@ async def get_list_of_purchases(user: UserType, status: sqlalchemy.DealStatuses
     if status:
         kwargs['status'] = status
 
-    deals = sqlalchemy.Deal.fetch_all(**kwargs)
-    return pydantic.DealListModel.model_validate(deals)
+    deals, next_cursor = await sqlalchemy.Deal.fetch_page(
+        session,
+        limit=pagination.limit,
+        after=pagination.after,
+        load=DEAL_LOAD_PLAN,
+        **kwargs
+    )
 
+    return FastJSONResponse(pydantic.DealPageModel(items=deals, next_cursor=next_cursor))
 
-@router.get('/', name='Просмотр всех сделок авторизованного пользователя')
-async def get_list_of_deals(user: UserType, status: sqlalchemy.DealStatuses = None):
-    kwargs = {}
-    if status:
-        kwargs['status'] = status
 
-    deals = sqlalchemy.Deal.fetch_all(
-        consumer_id=user.id,
-        **kwargs
-    ) + sqlalchemy.Deal.fetch_all(
-        seller_id=user.id,
-        **kwargs
+@router.get('/', name='Просмотр всех сделок авторизованного пользователя')
+async def get_list_of_deals(
+        session: SessionType,
+        user: UserType,
+        pagination: PaginationType,
+        role: sqlalchemy.DealRoles = None,
+        status: sqlalchemy.DealStatuses = None
+):
+    """
+    Выводит сделки пользователя (новые первыми) одним запросом
+    вместе с кол-вом его сделок по статусам.
+    """
+
+    deals, next_cursor, status_counts = await sqlalchemy.Deal.fetch_user_deals(
+        session,
+        user.id,
+        limit=pagination.limit,
+        after=pagination.after,
+        role=role,
+        status=status,
+        load=DEAL_LOAD_PLAN
     )
 
-    return pydantic.DealListModel.model_validate(deals)
+    return FastJSONResponse(pydantic.UserDealPageModel(
+        items=deals,
+        next_cursor=next_cursor,
+        status_counts=status_counts
+    ))
+
+
+# Регистрируется после /sells/ и /purchases/: иначе эти пути совпали бы с /{deal_id}/
+@router.get('/{deal_id}/', name='Просмотр данных сделки')
+async def get_deal_info_endpoint(session: SessionType, user: UserType, deal_id: int):
+    deal = await sqlalchemy.Deal.fetch_one(session, id=deal_id, load=DEAL_LOAD_PLAN)
+
+    if not deal:
+        raise DEAL_NOT_FOUND_EXCEPTION
+
+    deal = pydantic.DealModel.model_validate(deal)
+
+    if not user_in_deal(user, deal) and user.role not in [sqlalchemy.UserRoles.ADMIN, sqlalchemy.UserRoles.MODERATOR]:
+        raise DEAL_NOT_FOUND_EXCEPTION
+
+    return FastJSONResponse(deal)
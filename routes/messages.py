@@ -0,0 +1,107 @@
+import fastapi
+from pydantic import ValidationError
+from models import sqlalchemy, pydantic
+from dependencies import SessionType, PaginationType
+from auth import UserType, user_from_token
+from responses import FastJSONResponse
+from routes.deals import DEAL_NOT_FOUND_EXCEPTION
+import chat
+
+router = fastapi.APIRouter(
+    prefix='/deals',
+    tags=['Сообщения сделок']
+)
+
+
+async def fetch_participant_deal(session: SessionType, user: pydantic.UserModel, deal_id: int):
+    """
+    Сделка, в которой пользователь является продавцом или покупателем
+    """
+
+    return await sqlalchemy.Deal.fetch_one(session, sqlalchemy.Deal.participant_filter(user.id), id=deal_id)
+
+
+@router.get('/{deal_id}/messages/', name='История сообщений сделки')
+async def get_deal_messages_endpoint(session: SessionType, user: UserType, pagination: PaginationType, deal_id: int):
+    """
+    Выводит страницу сообщений сделки, новые первыми.
+    Более старые сообщения запрашиваются по курсору nextCursor.
+    """
+
+    if not await fetch_participant_deal(session, user, deal_id):
+        raise DEAL_NOT_FOUND_EXCEPTION
+
+    rows = await sqlalchemy.DealMessage.fetch_rows(
+        session,
+        limit=pagination.limit + 1,
+        after=pagination.after,
+        descending=True,
+        deal_id=deal_id
+    )
+
+    messages, next_cursor = sqlalchemy.DealMessage.paginate(rows, pagination.limit)
+
+    return FastJSONResponse(pydantic.DealMessagePageModel(items=messages, next_cursor=next_cursor))
+
+
+@router.post('/{deal_id}/messages/', name='Отправка сообщения сделки')
+async def send_deal_message_endpoint(
+        session: SessionType,
+        user: UserType,
+        deal_id: int,
+        message: pydantic.DealMessageCreateModel
+):
+    """
+    Отправляет сообщение в сделку; оно также рассылается в открытые сокеты чата сделки
+    """
+
+    if not await fetch_participant_deal(session, user, deal_id):
+        raise DEAL_NOT_FOUND_EXCEPTION
+
+    # Соединение сессии не должно удерживаться, пока сообщение ждет пакетной записи
+    await session.close()
+
+    return FastJSONResponse(await chat.send_message(deal_id, user.id, message))
+
+
+@router.websocket('/{deal_id}/messages/ws/')
+async def deal_chat_websocket(websocket: fastapi.WebSocket, deal_id: int, token: str = None):
+    """
+    Чат сделки. Токен доступа передается параметром token или заголовком Authorization.
+    Клиент отправляет сообщения в формате DealMessageCreateModel и получает все новые
+    сообщения сделки (включая свои) в формате DealMessageModel.
+    """
+
+    authorization = websocket.headers.get('authorization', '')
+    token = token or authorization.removeprefix('Bearer ').strip()
+
+    # Сессия нужна только для проверки доступа: открытый сокет не держит соединение с БД
+    async with sqlalchemy.async_session_maker() as session:
+        try:
+            user = await user_from_token(session, token)
+        except fastapi.HTTPException:
+            raise fastapi.WebSocketException(code=fastapi.status.WS_1008_POLICY_VIOLATION)
+
+        if not await fetch_participant_deal(session, user, deal_id):
+            raise fastapi.WebSocketException(code=fastapi.status.WS_1008_POLICY_VIOLATION)
+
+    await websocket.accept()
+    chat.chat_hub.subscribe(deal_id, websocket)
+
+    try:
+        while True:
+            data = await websocket.receive_text()
+
+            try:
+                message = pydantic.DealMessageCreateModel.model_validate_json(data)
+            except ValidationError as error:
+                await websocket.send_json({'detail': error.errors(include_url=False, include_context=False)})
+                continue
+
+            await chat.send_message(deal_id, user.id, message)
+
+    except fastapi.WebSocketDisconnect:
+        pass
+
+    finally:
+        chat.chat_hub.unsubscribe(deal_id, websocket)
@@ -1,6 +1,12 @@
+import typing
 import fastapi
+from datetime import datetime
 from models import pydantic, sqlalchemy
+from dependencies import SessionType, PaginationType, INVALID_CURSOR_EXCEPTION
 from auth import UserType
+from responses import FastJSONResponse
+import responses
+import storage
 
 router = fastapi.APIRouter(
     prefix='/products',
@@ -17,6 +23,148 @@ IS_NOT_PRODUCT_OWNER = fastapi.HTTPException(
     detail='Вы не являетесь создателем товара.'
 )
 
+STOCK_IS_SHARDED = fastapi.HTTPException(
+    status_code=409,
+    detail='Остаток товара разделен на шарды: объедините его перед изменением кол-ва.'
+)
+
+STOCK_CANNOT_BE_SHARDED = fastapi.HTTPException(
+    status_code=409,
+    detail='Остаток товара уже разделен или не учитывается.'
+)
+
+STOCK_IS_NOT_SHARDED = fastapi.HTTPException(
+    status_code=409,
+    detail='Остаток товара не разделен на шарды.'
+)
+
+# Наибольшее кол-во шардов остатка одного товара
+MAX_STOCK_SHARDS = 64
+
+# План загрузки связей товара для ответов по модели ProductModel
+PRODUCT_LOAD_PLAN = {
+    'seller': 'joined',
+}
+
+# Колонки продавца для чтения товаров в режиме строк (fetch_rows): поля UserModel (без хэша пароля)
+SELLER_ROW_COLUMNS = [
+    'id',
+    'email',
+    'first_name',
+    'last_name',
+    'date_joined',
+    'date_password_changed',
+    'email_verified',
+    'role',
+    'credentials_version',
+]
+
+
+def product_etag(product: dict) -> str:
+    """
+    Сильный ETag товара по его версии: проверяется по БД без выборки продавца и сериализации.
+    Покупки товара с разделенным остатком не меняют его строку (и версию), поэтому в его ETag входит и остаток.
+    """
+
+    if product['stock_shards']:
+        return f'"product-{product["id"]}-{product["version"]}-{product["quantity_available"]}"'
+
+    return f'"product-{product["id"]}-{product["version"]}"'
+
+
+def product_last_modified(product: dict) -> typing.Optional[datetime]:
+    """
+    Время изменения товара для Last-Modified. У товара с разделенным остатком его нет:
+    покупки меняют только шарды, а не dateUpdated товара.
+    """
+
+    return None if product['stock_shards'] else product['date_updated']
+
+
+def product_values(product: pydantic.ProductCreateModel, **kwargs) -> dict:
+    """
+    Значения колонок товара из модели запроса: quantityLeft хранится в колонке quantityAvailable
+    """
+
+    values = product.model_dump(**kwargs)
+
+    if 'quantity_left' in values:
+        values['quantity_available'] = values.pop('quantity_left')
+
+    return values
+
+
+async def attach_stock(session: SessionType, products: typing.List[dict]) -> None:
+    """
+    Заменяет остаток товаров с разделенным остатком суммой их шардов одним запросом:
+    quantityAvailable такого товара при покупках не меняется
+    """
+
+    sharded = [product for product in products if product['stock_shards']]
+    if not sharded:
+        return
+
+    totals = await sqlalchemy.ProductStockShard.totals(session, [product['id'] for product in sharded])
+
+    for product in sharded:
+        product['quantity_available'] = totals.get(product['id'], 0)
+
+
+async def product_model(session: SessionType, product: sqlalchemy.Record) -> pydantic.ProductModel:
+    """
+    Модель ответа по записи товара (fetch_one) с остатком по шардам
+    """
+
+    model = pydantic.ProductModel.model_validate(product)
+
+    if product.stock_shards:
+        totals = await sqlalchemy.ProductStockShard.totals(session, [product.id])
+        model.quantity_left = totals.get(product.id, 0)
+
+    return model
+
+
+async def fetch_product_row(session: SessionType, product_id: int) -> typing.Optional[dict]:
+    """
+    Строка товара с продавцом, остатком и производными изображений для ответа по модели ProductModel
+    """
+
+    rows = await sqlalchemy.Product.fetch_rows(
+        session,
+        join={'seller': SELLER_ROW_COLUMNS},
+        limit=1,
+        id=product_id
+    )
+
+    if not rows:
+        return None
+
+    await attach_stock(session, rows)
+    await attach_variants(session, rows)
+    return rows[0]
+
+
+async def attach_variants(session: SessionType, products: typing.List[dict]) -> None:
+    """
+    Добавляет к строкам товаров ссылки на готовые производные изображения вложений одним запросом
+    """
+
+    digests = {}
+    for product in products:
+        for url in product['attachments']:
+            digest = storage.digest_from_url(url)
+            if digest is not None:
+                digests[url] = digest
+
+    variants = await sqlalchemy.AttachmentDerivative.variant_urls(session, digests.values())
+
+    for product in products:
+        product['attachment_variants'] = {
+            url: variants[digests[url]]
+            for url in product['attachments']
+            if digests.get(url) in variants
+        }
+
 
 def user_is_product_creator(user: pydantic.UserModel, product: pydantic.ProductModel):
     """
@@ -26,71 +174,175 @@ def user_is_product_creator(user: pydantic.UserModel, product: pydantic.ProductM
     return product.seller.id == user.id
 
 
+async def fetch_managed_product(session: SessionType, user: UserType, product_id: int) -> sqlalchemy.Record:
+    """
+    Товар, остатком которого может управлять пользователь: владелец товара или администратор
+    """
+
+    product = await sqlalchemy.Product.fetch_one(session, id=product_id, load=PRODUCT_LOAD_PLAN)
+
+    if not product:
+        raise PRODUCT_NOT_FOUND
+
+    if product.seller.id != user.id and user.role != sqlalchemy.UserRoles.ADMIN:
+        raise IS_NOT_PRODUCT_OWNER
+
+    return product
+
+
 @router.get('/', name='Просмотр товаров')
-async def get_products_endpoint():
+async def get_products_endpoint(request: fastapi.Request, session: SessionType, pagination: PaginationType):
     """
-    Выводит список всех товаров.
+    Выводит страницу списка товаров.
+    Следующая страница запрашивается по курсору nextCursor.
+    Поддерживает условные запросы по ETag тела (If-None-Match). Last-Modified не отправляется:
+    время изменения товаров страницы не меняется при удалении товара с нее.
     """
 
-    products = sqlalchemy.Product.fetch_all()
-    return pydantic.ProductListModel.model_validate(products)
+    key = str(request.url)
+    entry = responses.product_responses.get(key)
+
+    if entry is None:
+        rows = await sqlalchemy.Product.fetch_rows(
+            session,
+            join={'seller': SELLER_ROW_COLUMNS},
+            limit=pagination.limit + 1,
+            after=pagination.after
+        )
+
+        products, next_cursor = sqlalchemy.Product.paginate(rows, pagination.limit)
+        await attach_stock(session, products)
+        await attach_variants(session, products)
+        body = FastJSONResponse(pydantic.ProductPageModel(items=products, next_cursor=next_cursor)).body
+
+        entry = responses.product_responses.put(
+            key,
+            body,
+            tags=[responses.PRODUCT_LIST_TAG, *[product['id'] for product in products]]
+        )
+
+    return responses.conditional_response(request, entry)
+
+
+@router.get('/search/', name='Поиск товаров')
+async def search_products_endpoint(
+        session: SessionType,
+        pagination: PaginationType,
+        q: typing.Annotated[str, fastapi.Query(min_length=1, max_length=256)]
+):
+    """
+    Ищет товары по заголовку и описанию, выводит страницу результатов по убыванию релевантности.
+    Поддерживает "фразы", исключение слов через минус и or. Следующая страница - по курсору nextCursor.
+    """
+
+    # Ключ страницы поиска - (rank, id); ID проверен при разборе курсора, ранг - число
+    if pagination.after is not None and (
+            len(pagination.after) != 2
+            or isinstance(pagination.after[0], bool)
+            or not isinstance(pagination.after[0], (int, float))
+    ):
+        raise INVALID_CURSOR_EXCEPTION
+
+    products = await sqlalchemy.Product.search(
+        session,
+        q,
+        limit=pagination.limit + 1,
+        after=pagination.after,
+        join={'seller': SELLER_ROW_COLUMNS}
+    )
+
+    products, next_cursor = sqlalchemy.Product.paginate(products, pagination.limit, order_by='rank')
+    await attach_stock(session, products)
+    await attach_variants(session, products)
+
+    return FastJSONResponse(pydantic.ProductPageModel(items=products, next_cursor=next_cursor))
 
 
 @router.post('/create/', name='Создание товара')
-async def create_product_endpoint(user: UserType, product: pydantic.ProductCreateModel):
+async def create_product_endpoint(session: SessionType, user: UserType, product: pydantic.ProductCreateModel):
     """"
     Создает товар от имени авторизованного пользователя
     """
 
-    product = sqlalchemy.Product().create(
+    product = await sqlalchemy.Product.create(
+        session,
         seller_id=user.id,
-        **product.model_dump()
+        load=PRODUCT_LOAD_PLAN,
+        **product_values(product)
     )
 
-    return pydantic.ProductModel.model_validate(product)
+    responses.invalidate_product(product.id)
+
+    return FastJSONResponse(pydantic.ProductModel.model_validate(product))
 
 
 @router.delete('/{product_id}/delete/', name='Удаление товара')
-async def delete_product_endpoint(user: UserType, product_id: int):
+async def delete_product_endpoint(session: SessionType, user: UserType, product_id: int):
     """
     Удаляет товар по его ID. Только для владельца указанного товара.
     """
 
-    product = sqlalchemy.Product.fetch_one(id=product_id)
+    product = await sqlalchemy.Product.fetch_one(session, id=product_id, load=PRODUCT_LOAD_PLAN)
 
     if not product:
         raise PRODUCT_NOT_FOUND
 
-    product = pydantic.ProductModel.model_validate(product)
+    product = await product_model(session, product)
     if not user_is_product_creator(user, product):
         raise IS_NOT_PRODUCT_OWNER
 
-    sqlalchemy.Product.delete(id=product.id)
-    return product
+    await sqlalchemy.Product.delete(session, id=product.id)
+    responses.invalidate_product(product.id)
+    return FastJSONResponse(product)
 
 
 @router.get('/{product_id}/', name='Просмотр товара')
-async def get_product_endpoint(product_id: int):
+async def get_product_endpoint(request: fastapi.Request, session: SessionType, product_id: int):
     """
-    Выводит товар по его ID
+    Выводит товар по его ID.
+    Условный запрос с актуальным ETag получает 304 по одной версии товара, без выборки продавца.
     """
 
-    product = sqlalchemy.Product.fetch_one(id=product_id)
+    key = request.url.path
+    entry = responses.product_responses.get(key)
 
-    if not product:
-        raise PRODUCT_NOT_FOUND
+    if entry is None:
+        if 'if-none-match' in request.headers:
+            versions = await sqlalchemy.Product.fetch_rows(
+                session,
+                columns=['id', 'version', 'date_updated', 'stock_shards', 'quantity_available'],
+                limit=1,
+                id=product_id
+            )
 
-    product = pydantic.ProductModel.model_validate(product)
-    return product
+            await attach_stock(session, versions)
+
+            if versions and responses.is_not_modified(request, product_etag(versions[0])):
+                return responses.not_modified_response(product_etag(versions[0]), product_last_modified(versions[0]))
+
+        product = await fetch_product_row(session, product_id)
+
+        if product is None:
+            raise PRODUCT_NOT_FOUND
+
+        entry = responses.product_responses.put(
+            key,
+            FastJSONResponse(pydantic.ProductModel.model_validate(product)).body,
+            etag=product_etag(product),
+            last_modified=product_last_modified(product),
+            tags=[product['id']]
+        )
+
+    return responses.conditional_response(request, entry)
 
 
 @router.patch('/{product_id}/update/', name='Обновление товара')
-async def get_product_endpoint(user: UserType, product_id: int, product: pydantic.ProductCreateModel):
+async def get_product_endpoint(session: SessionType, user: UserType, product_id: int, product: pydantic.ProductCreateModel):
     """
     Обновляет товар по его ID. Только для владельцев указанного товара.
     """
 
-    product_fetched = sqlalchemy.Product.fetch_one(id=product_id)
+    product_fetched = await sqlalchemy.Product.fetch_one(session, id=product_id, load=PRODUCT_LOAD_PLAN)
 
     if not product_fetched:
         raise PRODUCT_NOT_FOUND
@@ -99,8 +351,60 @@ async def get_product_endpoint(user: UserType, product_id: int, product: pydanti
     if not user_is_product_creator(user, product_validated):
         raise IS_NOT_PRODUCT_OWNER
 
-    product = sqlalchemy.Product.update(product_id, **product.model_dump(exclude_unset=True))
-    return product
+    values = product_values(product, exclude_unset=True)
+
+    # Кол-во товара с разделенным остатком хранится в шардах, а не в quantityAvailable
+    if product_fetched.stock_shards and 'quantity_available' in values:
+        raise STOCK_IS_SHARDED
+
+    product = await sqlalchemy.Product.update(
+        session,
+        product_id,
+        load=PRODUCT_LOAD_PLAN,
+        **values
+    )
+
+    responses.invalidate_product(product_id)
+
+    return FastJSONResponse(await product_model(session, product))
+
+
+@router.post('/{product_id}/stock/shard/', name='Разделение остатка товара на шарды')
+async def shard_product_stock_endpoint(
+        session: SessionType,
+        user: UserType,
+        product_id: int,
+        shards: typing.Annotated[int, fastapi.Query(ge=2, le=MAX_STOCK_SHARDS)]
+):
+    """
+    Делит остаток "горячего" товара на shards частей, чтобы одновременные покупки не ждали
+    блокировку одной строки товара. Только для владельца товара и администраторов.
+    """
+
+    await fetch_managed_product(session, user, product_id)
+
+    if not await sqlalchemy.Product.shard_stock(session, product_id, shards):
+        raise STOCK_CANNOT_BE_SHARDED
+
+    responses.invalidate_product(product_id)
+
+    return FastJSONResponse(pydantic.ProductModel.model_validate(await fetch_product_row(session, product_id)))
+
+
+@router.post('/{product_id}/stock/unshard/', name='Объединение остатка товара')
+async def unshard_product_stock_endpoint(session: SessionType, user: UserType, product_id: int):
+    """
+    Собирает остаток товара из шардов обратно в строку товара. Только для владельца товара и администраторов.
+    """
+
+    await fetch_managed_product(session, user, product_id)
+
+    if await sqlalchemy.Product.unshard_stock(session, product_id) is None:
+        raise STOCK_IS_NOT_SHARDED
+
+    responses.invalidate_product(product_id)
+
+    return FastJSONResponse(pydantic.ProductModel.model_validate(await fetch_product_row(session, product_id)))
 
 
 
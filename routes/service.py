@@ -0,0 +1,19 @@
+import fastapi
+from models import sqlalchemy
+from auth import UserType, handle_role
+
+router = fastapi.APIRouter(
+    prefix='/service',
+    tags=['Служебное']
+)
+
+
+@router.get('/database-pool/', name='Состояние пула соединений с БД')
+async def get_database_pool_endpoint(user: UserType):
+    """
+    Выводит кол-во занятых, свободных и ожидающих соединений пула текущего процесса.
+    Только для администраторов.
+    """
+
+    handle_role(user, sqlalchemy.UserRoles.ADMIN)
+    return sqlalchemy.pool_status()
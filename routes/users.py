@@ -1,13 +1,18 @@
 import fastapi
+from sqlalchemy.exc import IntegrityError
 from models import sqlalchemy, pydantic
+from dependencies import SessionType
 from auth import (
     authenticate_user,
     get_user,
-    create_password_hash,
+    hash_password,
     create_token,
     UserType,
-    handle_role
+    handle_role,
+    revoke_user_tokens,
+    decode_email_verification_token
 )
+import jobs
 
 router = fastapi.APIRouter(
     prefix='/users',
@@ -30,6 +35,11 @@ USER_ALREADY_EXISTS_EXCEPTION = fastapi.HTTPException(
     detail='Пользователь с данной почтой уже существует.'
 )
 
+INVALID_VERIFICATION_TOKEN_EXCEPTION = fastapi.HTTPException(
+    status_code=fastapi.status.HTTP_400_BAD_REQUEST,
+    detail='Ссылка подтверждения почты недействительна или устарела.'
+)
+
 
 @router.get('/{user_id}/', name='Просмотр пользователя')
 async def get_user_endpoint():
@@ -46,7 +56,7 @@ async def append_user_endpoint(
 
 
 @router.post('/token/', name='Получение токена авторизации')
-async def get_token_endpoint(form_data: pydantic.UserLoginModel):
+async def get_token_endpoint(session: SessionType, form_data: pydantic.UserLoginModel):
     """
     Генерирует Bearer-токен для авторизации.
     """
@@ -54,47 +64,90 @@ async def get_token_endpoint(form_data: pydantic.UserLoginModel):
     if not form_data:
         raise INCORRECT_LOGIN_DATA_EXCEPTION
 
-    user = authenticate_user(form_data.email, form_data.password)
+    user = await authenticate_user(session, form_data.email, form_data.password)
     if not user:
         raise INCORRECT_LOGIN_DATA_EXCEPTION
 
     return {'user': user, 'token': create_token(user)}
 
 
+@router.post('/logout/', name='Выход со всех устройств')
+async def logout_endpoint(session: SessionType, user: UserType):
+    """
+    Отзывает все выданные пользователю токены.
+    """
+
+    await revoke_user_tokens(session, user.id)
+    return {'detail': True}
+
+
 @router.post('/register/', name='Регистрация пользователя')
-async def register_user_endpoint(form_data: pydantic.UserRegisterModel):
+async def register_user_endpoint(session: SessionType, form_data: pydantic.UserRegisterModel):
     """
     Регистрирует пользователя в БД.
+    Письмо подтверждения почты отправляется фоновым заданием и не задерживает ответ.
     """
 
     if not form_data:
         raise INCORRECT_REGISTRATION_DATA_EXCEPTION
 
     email = form_data.email
-    if get_user(email):
+    if await get_user(session, email):
         raise USER_ALREADY_EXISTS_EXCEPTION
 
     password = form_data.password
-    password_hash = create_password_hash(password)
+    password_hash = await hash_password(password)
+
+    # Проверка выше не исключает одновременной регистрации с той же почтой: ее отсекает уникальный индекс
+    try:
+        created_user = await sqlalchemy.User.create(
+            session,
+            email=form_data.email,
+            password_hash=password_hash,
+            first_name=form_data.first_name,
+            last_name=form_data.last_name
+        )
+    except IntegrityError:
+        await session.rollback()
+        raise USER_ALREADY_EXISTS_EXCEPTION
 
-    created_user = sqlalchemy.User.create(
-        email=form_data.email,
-        password_hash=password_hash,
-        first_name=form_data.first_name,
-        last_name=form_data.last_name
-    )
+    await jobs.enqueue(session, 'send_verification_email', user_id=created_user.id)
 
     return pydantic.UserModel.model_validate(obj=created_user)
 
 
+@router.get('/email/verify/', name='Подтверждение почты по ссылке')
+@router.post('/email/verify/', name='Подтверждение почты')
+async def verify_email_endpoint(session: SessionType, token: str):
+    """
+    Подтверждает почту пользователя по токену из письма подтверждения.
+    GET - для перехода по ссылке из письма, повторный переход ничего не меняет.
+    """
+
+    verification = decode_email_verification_token(token)
+    if verification is None:
+        raise INVALID_VERIFICATION_TOKEN_EXCEPTION
+
+    user_id, email = verification
+
+    user = await sqlalchemy.User.fetch_one(session, id=user_id, email=email)
+    if user is None:
+        raise INVALID_VERIFICATION_TOKEN_EXCEPTION
+
+    if not user.email_verified:
+        await sqlalchemy.User.update(session, user.id, email_verified=True)
+
+    return {'detail': True}
+
+
 @router.post('/registration/email/', name='Проверка почты на регистрацию')
-async def validate_registration_email_endpoint(form_data: pydantic.EmailCheckModel):
+async def validate_registration_email_endpoint(session: SessionType, form_data: pydantic.EmailCheckModel):
     """
     Проверка почты на ее занятость другим пользователем.
     Данная функция нужна для валидации поля почты на клиенте.
     """
 
-    if get_user(form_data.email):
+    if await get_user(session, form_data.email):
         return {'detail': False}
 
     return {'detail': True}
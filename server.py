@@ -0,0 +1,225 @@
+"""
+Запуск сервера для продакшена: python -m server.
+
+Запускает SERVER_WORKERS процессов uvicorn (по умолчанию по числу доступных ядер в пределах
+DATABASE_CONNECTION_BUDGET) с uvloop и httptools,
+если они установлены. Процессы запускаются через spawn, поэтому каждый сам создает движки БД,
+соединения шины событий и пулы в lifespan приложения и ничего не наследует от родителя.
+Упавший процесс запускается заново.
+
+SIGTERM/SIGINT: сигнал получают сразу все процессы, и они останавливаются параллельно: перестают
+принимать соединения, завершают потоки событий, дожидаются текущих запросов (не дольше
+SERVER_GRACEFUL_TIMEOUT секунд) и выполняют остановку приложения (см. main.lifespan).
+Время остановки не зависит от числа процессов; процессы, не успевшие за shutdown_timeout(), завершаются принудительно.
+"""
+
+import os
+import math
+import time
+import signal
+import logging
+import threading
+import uvicorn
+from uvicorn._subprocess import get_subprocess
+import settings
+import migrations
+import events
+from models import sqlalchemy
+
+# Сообщения супервизора выводятся через настройки журнала uvicorn
+logger = logging.getLogger('uvicorn.error')
+
+# Соединения с БД процесса сервера вне пула: LISTEN событий сделок, чата сделок и версий учетных данных
+LISTEN_CONNECTIONS = 3
+
+# Интервал (секунды) проверки процессов сервера супервизором и пауза перед перезапуском упавшего процесса
+WORKER_CHECK_INTERVAL = 1
+
+# Запас (секунды) на закрытие пулов и соединений после завершения запросов и заданий при остановке
+SHUTDOWN_MARGIN = 5
+
+
+def available_cpus() -> int:
+    """
+    Кол-во ядер, доступных процессу: с учетом привязки к ядрам и квоты CPU контейнера (cgroup v2 cpu.max)
+    """
+
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as file:
+            quota, period = file.read().split()
+
+        if quota != 'max':
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+
+    except (OSError, ValueError):
+        pass
+
+    return max(1, cpus)
+
+
+def worker_count() -> int:
+    """
+    SERVER_WORKERS или, если он не задан, число доступных ядер, но не больше, чем позволяет
+    DATABASE_CONNECTION_BUDGET: каждому процессу нужны LISTEN_CONNECTIONS соединений и хотя бы два в пуле
+    """
+
+    if settings.SERVER_WORKERS:
+        return settings.SERVER_WORKERS
+
+    cpus = available_cpus()
+    workers = max(1, min(cpus, settings.DATABASE_CONNECTION_BUDGET // (LISTEN_CONNECTIONS + 2)))
+
+    if workers < cpus:
+        logger.warning(
+            'Запускается %s процессов сервера вместо %s по числу ядер: больше не позволяет '
+            'DATABASE_CONNECTION_BUDGET=%s', workers, cpus, settings.DATABASE_CONNECTION_BUDGET
+        )
+
+    return workers
+
+
+def shutdown_timeout() -> float:
+    """
+    Время, за которое процессы сервера должны остановиться: завершить запросы, затем фоновые задания
+    """
+
+    return settings.SERVER_GRACEFUL_TIMEOUT + settings.JOB_SHUTDOWN_TIMEOUT + SHUTDOWN_MARGIN
+
+
+def size_worker_resources(workers: int) -> None:
+    """
+    Делит ресурсы между процессами сервера через окружение, которое они читают при запуске:
+    соединения с БД - из DATABASE_CONNECTION_BUDGET, процессы обработки изображений - из ядер.
+    Заданные в окружении явно настройки не меняются, но сумма соединений всех процессов
+    проверяется: при превышении бюджета сервер не запускается.
+    """
+
+    connections = settings.DATABASE_CONNECTION_BUDGET // workers - LISTEN_CONNECTIONS
+
+    if connections >= 2:
+        pool_size = max(1, connections // 3)
+        os.environ.setdefault('DATABASE_POOL_SIZE', str(pool_size))
+        os.environ.setdefault('DATABASE_MAX_OVERFLOW', str(connections - pool_size))
+        os.environ.setdefault('JOB_WORKERS', str(min(settings.JOB_WORKERS, pool_size)))
+
+    os.environ.setdefault('IMAGE_WORKERS', str(max(1, available_cpus() // workers)))
+
+    pool_size = int(os.environ.get('DATABASE_POOL_SIZE', settings.DATABASE_POOL_SIZE))
+    max_overflow = int(os.environ.get('DATABASE_MAX_OVERFLOW', settings.DATABASE_MAX_OVERFLOW))
+    total = workers * (pool_size + max_overflow + LISTEN_CONNECTIONS)
+
+    if total > settings.DATABASE_CONNECTION_BUDGET:
+        raise SystemExit(
+            f'{workers} процессов сервера откроют до {total} соединений с БД '
+            f'при DATABASE_CONNECTION_BUDGET={settings.DATABASE_CONNECTION_BUDGET}: '
+            f'уменьшите SERVER_WORKERS, DATABASE_POOL_SIZE или DATABASE_MAX_OVERFLOW'
+        )
+
+
+class WorkerServer(uvicorn.Server):
+    """
+    Процесс сервера, который при остановке сначала завершает потоки событий (SSE):
+    сами они не заканчиваются и держали бы остановку до SERVER_GRACEFUL_TIMEOUT
+    """
+
+    async def shutdown(self, sockets=None):
+        events.event_bus.close_subscriptions()
+        await super().shutdown(sockets=sockets)
+
+
+class Supervisor:
+    """
+    Родительский процесс сервера: держит общий сокет, запускает процессы сервера,
+    перезапускает упавшие и останавливает все процессы одновременно
+    """
+
+    def __init__(self, config: uvicorn.Config, workers: int):
+        self.config = config
+        self.workers = workers
+        self.socket = None
+        self.processes = []
+        self.should_exit = threading.Event()
+
+    def spawn(self):
+        process = get_subprocess(self.config, target=WorkerServer(self.config).run, sockets=[self.socket])
+        process.start()
+        return process
+
+    def handle_exit(self, sig, frame):
+        self.should_exit.set()
+
+    def run(self):
+        self.socket = self.config.bind_socket()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self.handle_exit)
+
+        logger.info('Запуск %s процессов сервера', self.workers)
+        self.processes = [self.spawn() for _ in range(self.workers)]
+
+        while not self.should_exit.wait(WORKER_CHECK_INTERVAL):
+            for index, process in enumerate(self.processes):
+                if process.is_alive() or self.should_exit.is_set():
+                    continue
+
+                logger.warning('Процесс сервера %s завершился с кодом %s, запуск нового', process.pid, process.exitcode)
+                process.join()
+                self.processes[index] = self.spawn()
+
+        self.shutdown()
+
+    def shutdown(self):
+        for process in self.processes:
+            process.terminate()
+
+        deadline = time.monotonic() + shutdown_timeout()
+
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+
+        for process in self.processes:
+            if process.is_alive():
+                logger.warning('Процесс сервера %s не остановился за %s с и завершается принудительно', process.pid, shutdown_timeout())
+                process.kill()
+                process.join()
+
+        self.socket.close()
+
+
+def run():
+    if settings.DATABASE_BOOTSTRAP_ON_STARTUP:
+        migrations.bootstrap()
+        sqlalchemy.get_engine().dispose()
+
+    # Миграции применяются один раз здесь, а не в каждом процессе сервера:
+    # процессы запускаются через spawn и читают настройки из окружения заново
+    os.environ['DATABASE_BOOTSTRAP_ON_STARTUP'] = 'False'
+
+    workers = worker_count()
+    size_worker_resources(workers)
+
+    config = uvicorn.Config(
+        'main:app',
+        host=settings.HOST,
+        port=settings.PORT,
+        workers=workers,
+        loop=settings.SERVER_LOOP,
+        http=settings.SERVER_HTTP,
+        backlog=settings.SERVER_BACKLOG,
+        timeout_keep_alive=settings.SERVER_KEEP_ALIVE,
+        timeout_graceful_shutdown=settings.SERVER_GRACEFUL_TIMEOUT,
+        limit_concurrency=settings.SERVER_LIMIT_CONCURRENCY or None,
+        access_log=settings.SERVER_ACCESS_LOG,
+        server_header=False,
+    )
+
+    Supervisor(config, workers).run()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,196 @@
+import os
+import re
+import uuid
+import typing
+import asyncio
+import hashlib
+import settings
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+URL_PATTERN = re.compile(r'^/attachments/([0-9a-f]{64})/$')
+RANGE_PATTERN = re.compile(r'^(\d*)-(\d*)$', re.ASCII)
+MEDIA_TYPE_PATTERN = re.compile(r'^[a-z0-9!#$&^_.+-]+/[a-z0-9!#$&^_.+-]+$')
+
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+# Типы, которые отдаются для показа в браузере. Остальные (в т.ч. text/html и image/svg+xml,
+# в которых может быть исполняемый код) отдаются только на скачивание.
+INLINE_CONTENT_TYPES = frozenset({
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'image/webp',
+})
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+class EmptyAttachment(Exception):
+    pass
+
+
+class StoredBlob(typing.NamedTuple):
+    digest: str
+    size: int
+
+
+class AttachmentStore:
+    """
+    Хранилище файлов на диске с адресацией по содержимому: файл лежит по пути из своего SHA-256,
+    поэтому одинаковое содержимое хранится один раз. Файл пишется во временный файл блоками
+    по chunk_size и атомарно переносится на место, так что одновременные загрузки одного
+    содержимого не мешают друг другу, а память на загрузку не зависит от размера файла.
+    """
+
+    def __init__(self, root: str, chunk_size: int):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def temporary_path(self) -> str:
+        return os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+
+    async def save(self, chunks: typing.AsyncIterator[bytes], max_size: int) -> StoredBlob:
+        """
+        Записывает поток блоков в хранилище. Если поток длиннее max_size, выбрасывает AttachmentTooLarge,
+        если пуст - EmptyAttachment; в обоих случаях в хранилище ничего не попадает.
+        """
+
+        temporary_path = self.temporary_path()
+        await asyncio.to_thread(os.makedirs, os.path.dirname(temporary_path), exist_ok=True)
+
+        file = await asyncio.to_thread(open, temporary_path, 'wb')
+        digest = hashlib.sha256()
+        buffer = bytearray()
+        size = 0
+
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise AttachmentTooLarge()
+
+                digest.update(chunk)
+                buffer += chunk
+
+                # Запись крупными блоками: один переход в поток на chunk_size байт, а не на каждый блок запроса
+                if len(buffer) >= self.chunk_size:
+                    await asyncio.to_thread(file.write, bytes(buffer))
+                    buffer.clear()
+
+            if not size:
+                raise EmptyAttachment()
+
+            if buffer:
+                await asyncio.to_thread(file.write, bytes(buffer))
+
+            await asyncio.to_thread(file.close)
+
+        except BaseException:
+            await asyncio.to_thread(file.close)
+            await asyncio.to_thread(os.remove, temporary_path)
+            raise
+
+        blob = StoredBlob(digest=digest.hexdigest(), size=size)
+        await asyncio.to_thread(self.commit, temporary_path, self.path(blob.digest))
+        return blob
+
+    @staticmethod
+    def commit(temporary_path: str, path: str) -> None:
+        if os.path.exists(path):
+            os.remove(temporary_path)
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temporary_path, path)
+
+    async def read(self, digest: str, start: int, end: int) -> typing.AsyncIterator[bytes]:
+        """
+        Читает байты start..end (включительно) файла блоками по chunk_size
+        """
+
+        file = await asyncio.to_thread(open, self.path(digest), 'rb')
+
+        try:
+            await asyncio.to_thread(file.seek, start)
+            remaining = end - start + 1
+
+            while remaining > 0:
+                chunk = await asyncio.to_thread(file.read, min(self.chunk_size, remaining))
+                if not chunk:
+                    return
+
+                remaining -= len(chunk)
+                yield chunk
+
+        finally:
+            await asyncio.to_thread(file.close)
+
+
+def digest_from_url(url: str) -> typing.Optional[str]:
+    """
+    SHA-256 файла хранилища по ссылке на него (None для внешних ссылок)
+    """
+
+    match = URL_PATTERN.match(url)
+    return match.group(1) if match else None
+
+
+def normalize_content_type(header: typing.Optional[str]) -> str:
+    """
+    Тип содержимого из заголовка Content-Type без параметров, в нижнем регистре.
+    Для отсутствующего или некорректного заголовка - application/octet-stream.
+    """
+
+    media_type = (header or '').split(';', 1)[0].strip().lower()
+
+    if not MEDIA_TYPE_PATTERN.match(media_type):
+        return DEFAULT_CONTENT_TYPE
+
+    return media_type
+
+
+def parse_range(header: str, size: int) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Разбирает заголовок Range с одним диапазоном байт в (начало, конец включительно).
+    Для нескольких диапазонов или некорректного заголовка выводит None: по RFC 9110 он игнорируется
+    и файл отдается целиком. Для корректного диапазона за пределами файла выбрасывает ValueError (416).
+    """
+
+    unit, _, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+
+    match = RANGE_PATTERN.match(ranges.strip())
+    if match is None:
+        return None
+
+    first, last = match.groups()
+
+    if not first:
+        if not last:
+            return None
+
+        suffix = int(last)
+        if not suffix:
+            raise ValueError(header)
+
+        return max(0, size - suffix), size - 1
+
+    start = int(first)
+    end = int(last) if last else size - 1
+
+    if end < start:
+        return None
+
+    if start >= size:
+        raise ValueError(header)
+
+    return start, min(end, size - 1)
+
+
+attachment_store = AttachmentStore(settings.ATTACHMENTS_DIR, settings.ATTACHMENT_CHUNK_SIZE)